@@ -0,0 +1,152 @@
+"""
+Compares the extraction of the inventory fields from a libvirt domain
+description using the precompiled extractor with the default parser and
+ElementPath queries, as was done before.
+
+Usage: python benchmarks/domain_xml.py [iterations]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from lxml import etree
+
+from ipd.libvirt.inventory import domain_fields
+
+
+DOMAIN_XML = """\
+<domain type='kvm' id='12'>
+  <name>prj-42</name>
+  <uuid>4dea22b3-1d52-d8f3-2516-782e98ab3fa0</uuid>
+  <memory unit='KiB'>1048576</memory>
+  <currentMemory unit='KiB'>1048576</currentMemory>
+  <vcpu placement='static'>2</vcpu>
+  <resource>
+    <partition>/machine</partition>
+  </resource>
+  <os>
+    <type arch='x86_64' machine='pc-i440fx-1.5'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+    <pae/>
+  </features>
+  <cpu mode='custom' match='exact'>
+    <model fallback='allow'>SandyBridge</model>
+    <vendor>Intel</vendor>
+    <feature policy='require' name='pbe'/>
+    <feature policy='require' name='tm2'/>
+    <feature policy='require' name='est'/>
+    <feature policy='require' name='vmx'/>
+    <feature policy='require' name='osxsave'/>
+  </cpu>
+  <clock offset='utc'/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>restart</on_crash>
+  <devices>
+    <emulator>/usr/bin/kvm</emulator>
+    <disk type='volume' device='disk'>
+      <driver name='qemu' type='qcow2' cache='none'/>
+      <source pool='ipd-images' volume='prj-42'/>
+      <target dev='vda' bus='virtio'/>
+      <alias name='virtio-disk0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x05'
+               function='0x0'/>
+    </disk>
+    <controller type='usb' index='0'>
+      <alias name='usb0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01'
+               function='0x2'/>
+    </controller>
+    <controller type='pci' index='0' model='pci-root'>
+      <alias name='pci.0'/>
+    </controller>
+    <interface type='network'>
+      <mac address='52:54:00:3d:4c:a1'/>
+      <source network='default'/>
+      <target dev='vnet0'/>
+      <model type='virtio'/>
+      <alias name='net0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x03'
+               function='0x0'/>
+    </interface>
+    <serial type='pty'>
+      <source path='/dev/pts/3'/>
+      <target port='0'/>
+      <alias name='serial0'/>
+    </serial>
+    <console type='pty' tty='/dev/pts/3'>
+      <source path='/dev/pts/3'/>
+      <target type='serial' port='0'/>
+      <alias name='serial0'/>
+    </console>
+    <input type='mouse' bus='ps2'/>
+    <graphics type='vnc' port='5901' autoport='yes' listen='0.0.0.0'
+              passwd='secret'>
+      <listen type='address' address='0.0.0.0'/>
+    </graphics>
+    <video>
+      <model type='cirrus' vram='9216' heads='1'/>
+      <alias name='video0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x02'
+               function='0x0'/>
+    </video>
+    <memballoon model='virtio'>
+      <alias name='balloon0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x04'
+               function='0x0'/>
+    </memballoon>
+  </devices>
+  <seclabel type='dynamic' model='apparmor' relabel='yes'>
+    <label>libvirt-4dea22b3-1d52-d8f3-2516-782e98ab3fa0</label>
+    <imagelabel>libvirt-4dea22b3-1d52-d8f3-2516-782e98ab3fa0</imagelabel>
+  </seclabel>
+</domain>
+"""
+
+
+def tree_fields(xml):
+    tree = etree.fromstring(xml)
+    macs = [e.get('address') for e in tree.iterfind('devices/interface/mac')]
+    vnc_port = None
+    for graphics in tree.iterfind('devices/graphics'):
+        if graphics.get('type') == 'vnc':
+            vnc_port = graphics.get('port')
+            break
+    disks = []
+    for source in tree.iterfind('devices/disk/source'):
+        disks.append(source.get('file') or source.get('dev') or
+                     source.get('volume'))
+    return domain_fields.record(disks, macs, vnc_port)
+
+
+def timeit(func, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        func(DOMAIN_XML)
+    return (time.time() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    assert tree_fields(DOMAIN_XML) == domain_fields.extract(DOMAIN_XML)
+
+    print('{} bytes domain description'.format(len(DOMAIN_XML)))
+    funcs = [('tree', tree_fields), ('extractor', domain_fields.extract)]
+    timings = {name: [] for name, _ in funcs}
+    # Interleave the runs, so that both see the same system load
+    for _ in range(7):
+        for name, func in funcs:
+            timings[name].append(timeit(func, iterations))
+    for name, _ in funcs:
+        print('{:<10} {:.1f} us (best of 7)'.format(name, min(timings[name])))
+
+
+if __name__ == '__main__':
+    main()
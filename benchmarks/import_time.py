@@ -0,0 +1,63 @@
+"""
+Measures the time needed to import the metadata proxy entry point, and the
+generated libvirt protocol module, in fresh interpreters. Also reports how
+long it takes to build the models of all the protocol structures, which used
+to be done when importing the module.
+
+Usage: python benchmarks/import_time.py [runs]
+"""
+
+from __future__ import print_function
+
+import subprocess
+import sys
+
+
+TIMED_IMPORT = '''
+import time
+start = time.time()
+import {module}
+print(time.time() - start)
+'''
+
+MATERIALIZE = '''
+import time
+from ipd.libvirt import remote, types
+structs = [v for v in vars(remote).values()
+           if isinstance(v, types.ComplexType)]
+start = time.time()
+for struct in structs:
+    struct.model
+print(time.time() - start)
+'''
+
+
+def run(source):
+    output = subprocess.check_output([sys.executable, '-c', source])
+    return float(output.strip())
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    # Make sure the bytecode is cached before timing anything
+    run(TIMED_IMPORT.format(module='ipd.scripts.metaproxy'))
+
+    for module in ['ipd.libvirt.remote', 'ipd.scripts.metaproxy']:
+        timings = [run(TIMED_IMPORT.format(module=module))
+                   for _ in range(runs)]
+        print('import {:<25} {:.1f} ms (median of {})'.format(
+            module, median(timings) * 1000, runs))
+
+    timings = [run(MATERIALIZE) for _ in range(runs)]
+    print('{:<32} {:.1f} ms (median of {})'.format(
+        'build all structure models', median(timings) * 1000, runs))
+
+
+if __name__ == '__main__':
+    main()
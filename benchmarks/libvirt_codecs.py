@@ -0,0 +1,116 @@
+"""
+Checks that the codecs written by ``gen-libvirt-protocol --codecs`` are wire
+compatible with the ones compiled at runtime, by generating them for all the
+structures of the checked-in remote module and comparing the encoding and
+decoding of random values. Also reports the time needed to compile all
+codecs at runtime, which the generated module saves.
+
+Usage: python benchmarks/libvirt_codecs.py [rounds]
+"""
+
+from __future__ import print_function
+
+import random
+import struct
+import sys
+import time
+from cStringIO import StringIO
+
+from ipd.libvirt import remote, types
+from ipd.scripts.genproto import CodecWriter
+
+
+def sample(type):
+    """
+    Returns a random value of the given type.
+    """
+    if isinstance(type, types.ComplexType):
+        return type.model(*[sample(t) for _, t in type.fields])
+    if isinstance(type, types.Union):
+        case, name, arm = random.choice(type.arms)
+        return type.model(case, None if arm is None else sample(arm))
+    if isinstance(type, types.Enum):
+        return random.choice(sorted(type.ids))
+    if isinstance(type, types.Optional):
+        return random.choice([None, sample(type.type)])
+    if isinstance(type, types.FixedLengthArray):
+        return [sample(type.items_type) for _ in range(type.length)]
+    if isinstance(type, types.VariableLengthArray):
+        length = random.randint(0, min(3, type.maxlength))
+        return [sample(type.items_type) for _ in range(length)]
+    if isinstance(type, (types.FixedLengthString, types.FixedLengthData)):
+        return ''.join(chr(random.randint(0, 255))
+                       for _ in range(type.length))
+    if type in (types.string, types.opaque):
+        # Never empty, as empty optional values are encoded as missing
+        return ''.join(chr(random.randint(32, 126))
+                       for _ in range(random.randint(1, 12)))
+    fmt = type.fixed_format
+    if fmt in ('f', 'd'):
+        # Only values which survive the round trip through the format
+        value, = struct.unpack('>' + fmt, struct.pack('>' + fmt,
+                                                     random.random()))
+        return value
+    if fmt is not None:
+        bits = struct.calcsize(fmt) * 8
+        if fmt.isupper():
+            return random.randint(0, 2 ** bits - 1)
+        return random.randint(-2 ** (bits - 1), 2 ** (bits - 1) - 1)
+    raise NotImplementedError(type)
+
+
+def encode(pack, value):
+    stream = types.Packer()
+    pack(stream, value)
+    return str(stream.get_buffer())
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    names = {k: v for k, v in types.TYPES.iteritems()
+             if not isinstance(v, types.TypeFactoryMeta)}
+    structs = []
+    for name, value in sorted(vars(remote).iteritems()):
+        if isinstance(value, (types.ComplexType, types.Enum, types.Union)):
+            names[name] = value
+        if isinstance(value, (types.ComplexType, types.Union)):
+            structs.append((name, value))
+
+    start = time.time()
+    compiled = {name: (type._compile_pack(), type._compile_unpack())
+                for name, type in structs}
+    print('runtime compilation of {} structures: {:.1f} ms'.format(
+        len(structs), (time.time() - start) * 1000))
+
+    fh = StringIO()
+    CodecWriter(names).write(fh, structs)
+    namespace = dict(vars(remote), struct=struct, Type=types.Type)
+    code = compile(fh.getvalue(), '<generated codecs>', 'exec')
+    exec(code, namespace)
+    print('generated source: {} lines'.format(
+        fh.getvalue().count('\n')))
+
+    checked, skipped = 0, 0
+    for name, type in structs:
+        pack, unpack = compiled[name]
+        for _ in range(rounds):
+            try:
+                value = sample(type)
+                expected = encode(pack, value)
+            except NotImplementedError:
+                skipped += 1
+                break
+            data = encode(type.pack, value)
+            assert data == expected, name
+            assert unpack(types.Unpacker(data)) == value, name
+            assert type.unpack(types.Unpacker(data)) == value, name
+        else:
+            checked += 1
+
+    print('{} structures wire compatible, {} skipped (not implemented)'.format(
+        checked, skipped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Feeds a multi-megabyte libvirt reply to the protocol in TCP segment sized
+chunks, comparing the stock Twisted length prefixed receiver (which
+concatenates the pending data on each chunk) with the libvirt one.
+
+Usage: python benchmarks/libvirt_framing.py
+"""
+
+from __future__ import print_function
+
+import struct
+import time
+
+from twisted.protocols import basic
+
+from ipd.libvirt.protocol import PrefixInt32StringReceiver
+
+
+SEGMENT_SIZE = 1460
+
+
+class Counter(object):
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def makeConnection(self, transport):
+        pass
+
+    def stringReceived(self, string):
+        self.received += len(string)
+
+
+class StockReceiver(Counter, basic.Int32StringReceiver):
+    pass
+
+
+class LibvirtReceiver(Counter, PrefixInt32StringReceiver):
+    pass
+
+
+def feed(receiver, data):
+    receiver.received = 0
+    start = time.time()
+    for i in xrange(0, len(data), SEGMENT_SIZE):
+        receiver.dataReceived(data[i:i + SEGMENT_SIZE])
+    return time.time() - start
+
+
+def main():
+    print('{:<12} {:>12} {:>12}'.format('reply size', 'stock (s)',
+                                        'libvirt (s)'))
+    for size in (1, 2, 4, 8):
+        payload = 'x' * (size * 1024 * 1024)
+        stock = feed(StockReceiver(),
+                     struct.pack('!I', len(payload)) + payload)
+        libvirt = feed(LibvirtReceiver(),
+                       struct.pack('!I', len(payload) + 4) + payload)
+        print('{:<12} {:>12.3f} {:>12.3f}'.format(
+            '{} MiB'.format(size), stock, libvirt))
+
+
+if __name__ == '__main__':
+    main()
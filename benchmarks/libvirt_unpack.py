@@ -0,0 +1,97 @@
+"""
+Compares decoding libvirt replies through xdrlib with the unpacker of
+ipd.libvirt.types, both on the received frame and on a memoryview of it.
+
+Usage: python benchmarks/libvirt_unpack.py
+"""
+
+from __future__ import print_function
+
+import timeit
+import xdrlib
+
+from ipd.libvirt import remote, types
+from ipd.libvirt.protocol import LibvirtProtocol
+
+
+HEADER_LENGTH = LibvirtProtocol.header_length
+
+
+def make_frame(type, value):
+    packer = types.Packer(HEADER_LENGTH)
+    type.pack(packer, value)
+    return str(packer.get_buffer())
+
+
+def list_all_domains(count):
+    domains = [
+        remote.nonnull_domain.model('instance-{:05d}'.format(i), 'u' * 16, i)
+        for i in range(count)
+    ]
+    ret = remote.connect_list_all_domains_ret
+    return ret, ret.model(domains, count)
+
+
+def xml_desc(size):
+    ret = remote.domain_get_xml_desc_ret
+    return ret, ret.model('<domain>{}</domain>'.format('x' * size))
+
+
+def capabilities(size):
+    ret = remote.connect_get_capabilities_ret
+    return ret, ret.model('<capabilities>{}</capabilities>'.format('x' * size))
+
+
+def memory_stats(count):
+    stat = remote.domain_memory_stat.model
+    ret = remote.domain_memory_stats_ret
+    return ret, ret.model([stat(i % 8, i * 4096) for i in range(count)])
+
+
+def vcpus(count):
+    info = remote.vcpu_info.model
+    ret = remote.domain_get_vcpus_ret
+    return ret, ret.model([info(i, 1, i * 1000000, i % 4)
+                           for i in range(count)], '\xff' * count)
+
+
+PAYLOADS = [
+    ('connect_list_all_domains (2000)', list_all_domains(2000)),
+    ('domain_get_xml_desc (64 KiB)', xml_desc(64 * 1024)),
+    ('connect_get_capabilities (1 MiB)', capabilities(1024 * 1024)),
+    ('domain_memory_stats (1024)', memory_stats(1024)),
+    ('domain_get_vcpus (256)', vcpus(256)),
+]
+
+
+def decode_xdrlib(type, frame):
+    return type.unpack(xdrlib.Unpacker(frame[HEADER_LENGTH:]))
+
+
+def decode_unpacker(type, frame):
+    return type.unpack(types.Unpacker(frame, HEADER_LENGTH))
+
+
+def decode_memoryview(type, frame):
+    return type.unpack(types.Unpacker(memoryview(frame), HEADER_LENGTH))
+
+
+DECODERS = [decode_xdrlib, decode_unpacker, decode_memoryview]
+
+
+def main(number=50, repeat=3):
+    print('{:<35} {:>12} {:>12} {:>12}'.format(
+        'payload (ms per reply)', 'xdrlib', 'unpacker', 'memoryview'))
+    for name, (type, value) in PAYLOADS:
+        frame = make_frame(type, value)
+        results = [decode(type, frame) for decode in DECODERS]
+        assert results.count(results[0]) == len(results)
+        timings = []
+        for decode in DECODERS:
+            timer = timeit.Timer(lambda: decode(type, frame))
+            timings.append(min(timer.repeat(repeat, number)) / number * 1000)
+        print('{:<35} {:>12.3f} {:>12.3f} {:>12.3f}'.format(name, *timings))
+
+
+if __name__ == '__main__':
+    main()
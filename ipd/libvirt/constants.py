@@ -19,5 +19,37 @@ class Enum(object):
         return key < len(self._keys)
 
 
+# Driver feature enabling keepalive pings from the server
+DRV_FEATURE_PROGRAM_KEEPALIVE = 10
+
 packet_type = Enum('CALL', 'REPLY', 'EVENT', 'STREAM')
 status = Enum('OK', 'ERROR', 'CONTINUE')
+
+# Domain events which can be subscribed to (virDomainEventID), the event
+# with ID X is delivered by the domain_event_X procedure
+domain_event_id = Enum('LIFECYCLE', 'REBOOT', 'RTC_CHANGE', 'WATCHDOG',
+                       'IO_ERROR', 'GRAPHICS', 'IO_ERROR_REASON',
+                       'CONTROL_ERROR', 'BLOCK_JOB', 'DISK_CHANGE',
+                       'TRAY_CHANGE', 'PMWAKEUP', 'PMSUSPEND',
+                       'BALLOON_CHANGE', 'PMSUSPEND_DISK', 'DEVICE_REMOVED')
+
+# Events reported by the domain lifecycle event (virDomainEventType)
+domain_event_lifecycle = Enum('DEFINED', 'UNDEFINED', 'STARTED', 'SUSPENDED',
+                              'RESUMED', 'STOPPED', 'SHUTDOWN', 'PMSUSPENDED',
+                              'CRASHED')
+
+# States of a domain (virDomainState)
+domain_state = Enum('NOSTATE', 'RUNNING', 'BLOCKED', 'PAUSED', 'SHUTDOWN',
+                    'SHUTOFF', 'CRASHED', 'PMSUSPENDED')
+
+# Filters for connect_list_all_domains (virConnectListAllDomainsFlags)
+LIST_DOMAINS_RUNNING = 1 << 4
+LIST_DOMAINS_PAUSED = 1 << 5
+LIST_DOMAINS_SHUTOFF = 1 << 6
+LIST_DOMAINS_OTHER = 1 << 7
+
+# Codes of remote errors (virErrorNumber) reporting unsupported features
+ERR_NO_SUPPORT = 3
+ERR_CONFIG_UNSUPPORTED = 67
+ERR_ARGUMENT_UNSUPPORTED = 74
+ERR_OPERATION_UNSUPPORTED = 84
@@ -24,6 +24,21 @@ class ProcedureNotFound(LibvirtError):
     pass
 
 
+class NoPendingCall(LibvirtError):
+    pass
+
+
+class CallTimeout(LibvirtError):
+    def __init__(self, procedure, timeout):
+        super(CallTimeout, self).__init__(procedure, timeout)
+        self.procedure = procedure
+        self.timeout = timeout
+
+    def __str__(self):
+        return 'No reply to {} after {} seconds'.format(self.procedure,
+                                                        self.timeout)
+
+
 class RemoteError(LibvirtError):
     def __init__(self, error):
         self.__dict__.update(error._asdict())
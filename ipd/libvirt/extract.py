@@ -0,0 +1,71 @@
+"""
+Extraction of a fixed set of fields from XML documents, such as the
+descriptions of libvirt domains, into compact records.
+
+Fields are selected with a small subset of XPath, relative to the root
+element::
+
+    uuid                                   text of the uuid element
+    devices/interface/mac/@address         address attribute of mac
+    devices/graphics[@type='vnc']/@port    predicates on attribute values
+    devices/disk/source/@file|@dev         any of the attributes
+
+Each path is compiled once to an XPath expression returning plain strings,
+and documents are parsed with a shared parser which drops whitespace-only
+text and comments, none of which the fields need.
+"""
+
+import re
+from collections import namedtuple
+
+from lxml import etree
+
+
+_STEP = re.compile(r"^[\w.-]+(?:\[@[\w.-]+='[^']*'\])?$")
+
+
+class Field(object):
+    def __init__(self, path, multiple=False):
+        self.path = path
+        self.multiple = multiple
+        steps = path.split('/')
+        if steps[-1].startswith('@'):
+            names = [a.lstrip('@') for a in steps.pop().split('|')]
+            if len(names) == 1:
+                value = '@' + names[0]
+            else:
+                value = '@*[{}]'.format(' or '.join(
+                    "name()='{}'".format(n) for n in names))
+        else:
+            value = 'text()'
+        for step in steps:
+            if _STEP.match(step) is None:
+                raise ValueError('Unsupported step {!r} in path {!r}'.format(
+                    step, path))
+        self._find = etree.XPath('/'.join(steps + [value]),
+                                 smart_strings=False)
+
+    def extract(self, root):
+        values = self._find(root)
+        if self.multiple:
+            return values
+        elif values:
+            return values[0]
+
+
+class Extractor(object):
+    """
+    Extracts the given fields (keyword arguments mapping names to Field
+    instances) from XML documents, returning them as a namedtuple. Missing
+    fields are set to None, or to an empty list for multiple fields.
+    """
+
+    parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+
+    def __init__(self, typename, **fields):
+        self._fields = [f for _, f in sorted(fields.items())]
+        self.record = namedtuple(typename, sorted(fields))
+
+    def extract(self, xml):
+        root = etree.fromstring(xml, self.parser)
+        return self.record(*[f.extract(root) for f in self._fields])
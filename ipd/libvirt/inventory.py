@@ -0,0 +1,322 @@
+import hashlib
+from collections import namedtuple
+
+from twisted.application import service
+from twisted.internet import defer, task
+from twisted.python import failure
+
+from ipd.libvirt import constants
+from ipd.libvirt.extract import Extractor, Field
+
+from structlog import get_logger
+logger = get_logger()
+
+
+DomainRecord = namedtuple('DomainRecord', [
+    'uuid', 'name', 'id', 'state', 'macs', 'vnc_port', 'disks',
+])
+
+
+# Filters used to list the domains of a hypervisor by state
+STATE_FILTERS = [
+    ('running', constants.LIST_DOMAINS_RUNNING),
+    ('paused', constants.LIST_DOMAINS_PAUSED),
+    ('shutoff', constants.LIST_DOMAINS_SHUTOFF),
+    ('other', constants.LIST_DOMAINS_OTHER),
+]
+
+
+def state_name(state):
+    """
+    Maps a domain_state value to the name of the filter listing it.
+    """
+    states = constants.domain_state
+    return {
+        states.RUNNING: 'running',
+        states.PAUSED: 'paused',
+        states.SHUTOFF: 'shutoff',
+    }.get(state, 'other')
+
+
+# Fields of a DomainRecord read from the XML description of a domain
+domain_fields = Extractor(
+    'DomainFields',
+    macs=Field('devices/interface/mac/@address', multiple=True),
+    vnc_port=Field("devices/graphics[@type='vnc']/@port"),
+    disks=Field('devices/disk/source/@file|@dev|@volume', multiple=True),
+)
+
+
+class DomainInventory(service.Service, object):
+    """
+    Keeps a snapshot of the domains defined on a single hypervisor.
+
+    The snapshot is refreshed every refresh_interval seconds by listing the
+    domains in each state, which takes a constant number of calls; the XML
+    description of a domain is only fetched (at most concurrency at a time)
+    for new domains and for domains which changed state or id since the last
+    refresh, and only parsed again if it changed. Domain lifecycle events
+    update the affected domain as soon as they are received.
+
+    Lookups for unknown domains trigger an early refresh, at most once every
+    min_refresh_interval seconds; lookups made sooner wait for a refresh
+    scheduled at the end of the interval.
+
+    Callbacks registered with subscribe are called with the uuid of each
+    domain whose record changed or which was removed.
+    """
+
+    refresh_interval = 60
+    min_refresh_interval = 5
+    concurrency = 8
+
+    def __init__(self, libvirt_pool, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.pool = libvirt_pool
+        self._records = {}
+        self._by_mac = {}
+        # Parsed XML descriptions by domain uuid, with the hash of the XML
+        self._parsed = {}
+        self._refreshing = None
+        self._last_refresh = None
+        # Deferreds waiting for the refresh scheduled by lookups, or None
+        self._scheduled = None
+        self._events = None
+        self._listeners = []
+        self._semaphore = defer.DeferredSemaphore(self.concurrency)
+        self._refresher = task.LoopingCall(self.refresh)
+        self._refresher.clock = reactor
+
+    def startService(self):
+        super(DomainInventory, self).startService()
+        self._refresher.start(self.refresh_interval, now=True)
+
+    def stopService(self):
+        super(DomainInventory, self).stopService()
+        if self._refresher.running:
+            self._refresher.stop()
+
+    def get(self, uuid):
+        """
+        Returns the record of the domain with the given (raw) uuid, or None.
+        """
+        return self._records.get(uuid)
+
+    def get_by_mac(self, mac):
+        return self._by_mac.get(mac)
+
+    def records(self):
+        return self._records.values()
+
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        self._listeners.remove(callback)
+
+    def _changed(self, uuid):
+        for callback in list(self._listeners):
+            try:
+                callback(uuid)
+            except Exception:
+                reason = failure.Failure()
+                logger.msg('inventory.listener_failed',
+                           error=reason.getErrorMessage(),
+                           traceback=reason.getTraceback())
+
+    @defer.inlineCallbacks
+    def lookup(self, uuid=None, mac=None):
+        """
+        Returns a deferred fired with the record of the domain with the given
+        uuid or MAC address, refreshing the snapshot if the domain is not
+        known yet. Fires with None if the domain does not exist.
+        """
+        find = (lambda: self.get(uuid)) if mac is None else (
+            lambda: self.get_by_mac(mac))
+        record = find()
+        if record is None:
+            if self._refreshing is not None or self._refresh_allowed():
+                yield self.refresh()
+            else:
+                yield self._refresh_later()
+            record = find()
+        defer.returnValue(record)
+
+    def _refresh_allowed(self):
+        return (self._last_refresh is None or
+                self._reactor.seconds() - self._last_refresh >=
+                self.min_refresh_interval)
+
+    def _refresh_later(self):
+        """
+        Returns a deferred fired once a refresh, started as soon as
+        min_refresh_interval elapsed since the last one, finished.
+        """
+        if self._scheduled is None:
+            self._scheduled = []
+            delay = (self._last_refresh + self.min_refresh_interval -
+                     self._reactor.seconds())
+            self._reactor.callLater(delay, self._scheduled_refresh)
+        d = defer.Deferred()
+        self._scheduled.append(d)
+        return d
+
+    def _scheduled_refresh(self):
+        waiters, self._scheduled = self._scheduled, None
+
+        def refreshed(_):
+            for d in waiters:
+                d.callback(None)
+
+        self.refresh().addCallback(refreshed)
+
+    def refresh(self):
+        """
+        Refreshes the whole snapshot. Concurrent calls share the same
+        refresh.
+        """
+        if self.running and self._events is None:
+            self._listen_events()
+        d = defer.Deferred()
+        if self._refreshing is not None:
+            self._refreshing.append(d)
+            return d
+        self._refreshing = [d]
+        self._last_refresh = self._reactor.seconds()
+        refreshed = self.pool.run(self._list_domains, retry=True)
+        refreshed.addCallback(self._update_all)
+        refreshed.addErrback(self._refresh_failed)
+        refreshed.addCallback(self._refreshed)
+        return d
+
+    def _refresh_failed(self, reason):
+        logger.msg('inventory.refresh_failed', error=reason.getErrorMessage())
+
+    def _refreshed(self, _):
+        waiters, self._refreshing = self._refreshing, None
+        for d in waiters:
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def _list_domains(self, virt):
+        listed = []
+
+        def store(res, state):
+            listed.extend((domain, state) for domain in res.domains)
+
+        dl = []
+        for state, flags in STATE_FILTERS:
+            d = virt.connect_list_all_domains(1, flags)
+            d.addCallback(store, state)
+            dl.append(d)
+        yield defer.gatherResults(dl, consumeErrors=True)
+        defer.returnValue(listed)
+
+    @defer.inlineCallbacks
+    def _update_all(self, listed):
+        seen = set()
+        dl = []
+        for domain, state in listed:
+            seen.add(domain.uuid)
+            record = self._records.get(domain.uuid)
+            if (record is None or record.state != state or
+                    record.id != domain.id):
+                dl.append(self._semaphore.run(self._update, domain, state))
+        for uuid in set(self._records) - seen:
+            self._forget(uuid)
+        yield defer.DeferredList(dl)
+        logger.msg('inventory.refreshed', domains=len(self._records),
+                   updated=len(dl))
+
+    def update_domain(self, domain):
+        """
+        Fetches the state and description of the given domain and updates
+        its record. Returns a deferred fired with the new record.
+        """
+        def get_state(virt):
+            return virt.domain_get_state(domain, 0)
+
+        d = self.pool.run(get_state, retry=True)
+        d.addCallback(lambda res: self._update(domain, state_name(res.state)))
+        return d
+
+    @defer.inlineCallbacks
+    def _update(self, domain, state):
+        res = yield self.pool.run(
+            lambda virt: virt.domain_get_xml_desc(domain, 0), retry=True)
+        digest = hashlib.sha1(res.xml).digest()
+        try:
+            cached_digest, fields = self._parsed[domain.uuid]
+        except KeyError:
+            cached_digest = None
+        if cached_digest != digest:
+            fields = domain_fields.extract(res.xml)
+            self._parsed[domain.uuid] = digest, fields
+        record = DomainRecord(domain.uuid, domain.name, domain.id, state,
+                              fields.macs, fields.vnc_port, fields.disks)
+        self._store(record)
+        defer.returnValue(record)
+
+    def _store(self, record):
+        previous = self._remove(record.uuid)
+        self._records[record.uuid] = record
+        for mac in record.macs:
+            self._by_mac[mac] = record
+        if previous is not None and previous != record:
+            self._changed(record.uuid)
+
+    def _forget(self, uuid):
+        self._parsed.pop(uuid, None)
+        if self._remove(uuid) is not None:
+            self._changed(uuid)
+
+    def _remove(self, uuid):
+        record = self._records.pop(uuid, None)
+        if record is not None:
+            for mac in record.macs:
+                if self._by_mac.get(mac) is record:
+                    del self._by_mac[mac]
+        return record
+
+    def _listen_events(self):
+        def subscribe(virt):
+            d = virt.subscribe(constants.domain_event_id.LIFECYCLE,
+                               self.domain_event_lifecycle)
+            d.addCallback(lambda _: virt)
+            return d
+
+        self._events = self.pool.run(subscribe)
+        self._events.addCallbacks(self._listening, self._listen_failed)
+
+    def _listening(self, virt):
+        logger.msg('inventory.listening')
+        d = virt.notify_disconnect()
+        d.addCallback(self._events_lost)
+
+    def _listen_failed(self, reason):
+        logger.msg('inventory.listen_failed', error=reason.getErrorMessage())
+        self._events = None
+
+    def _events_lost(self, _):
+        logger.msg('inventory.events_lost')
+        self._events = None
+        if self.running:
+            # Events may have been missed while reconnecting
+            self.refresh()
+
+    def domain_event_lifecycle(self, event):
+        """
+        Updates the snapshot for the domain_event_lifecycle_msg event.
+        """
+        if event.event == constants.domain_event_lifecycle.UNDEFINED:
+            logger.msg('inventory.forget', domain=event.dom.name)
+            self._forget(event.dom.uuid)
+        else:
+            lifecycle = constants.domain_event_lifecycle[event.event]
+            logger.msg('inventory.update', domain=event.dom.name,
+                       lifecycle=lifecycle)
+            d = self.update_domain(event.dom)
+            d.addErrback(self._refresh_failed)
+            return d
@@ -0,0 +1,183 @@
+from twisted.application import service
+from twisted.internet import defer, task, error as net_error
+from twisted.python import failure
+
+from ipd.libvirt import constants
+from ipd.utils import timeout
+
+from structlog import get_logger
+logger = get_logger()
+
+
+class LibvirtConnectionPool(service.Service, object):
+    """
+    Keeps a number of opened and authenticated connections to a single
+    libvirt daemon and hands them out to callers.
+
+    As calls are multiplexed on a connection, each connection can be shared
+    by up to calls_per_connection callers at the same time. The optional
+    factory is used to build the protocol of each connection and can be
+    used to limit the number of calls in flight and to set call timeouts.
+
+    Idle connections are kept alive by the keepalive program and checked by
+    pinging them at regular intervals; connections which are lost or do not
+    answer are dropped and replaced by new ones.
+    """
+
+    check_interval = 30
+    ping_timeout = 10
+
+    def __init__(self, endpoint, size=4, calls_per_connection=1,
+                 factory=None, reactor=None):
+        super(LibvirtConnectionPool, self).__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._endpoint = endpoint
+        self.size = size
+        self.calls_per_connection = calls_per_connection
+        self._factory = factory
+        self._connections = set()
+        # One entry per free slot, a connection appears at most
+        # calls_per_connection times
+        self._idle = []
+        self._connecting = 0
+        self._waiters = []
+        self._checker = task.LoopingCall(self.check_connections)
+
+    def startService(self):
+        logger.msg('libvirt.pool.starting', size=self.size)
+        super(LibvirtConnectionPool, self).startService()
+        self._checker.start(self.check_interval, now=False)
+        self._fill()
+
+    def stopService(self):
+        logger.msg('libvirt.pool.stopping')
+        super(LibvirtConnectionPool, self).stopService()
+        if self._checker.running:
+            self._checker.stop()
+        dl = [self._close(client) for client in list(self._connections)]
+        return defer.DeferredList(dl)
+
+    def _fill(self):
+        missing = self.size - len(self._connections) - self._connecting
+        for _ in range(missing):
+            self._open_connection()
+
+    @defer.inlineCallbacks
+    def _open_connection(self):
+        self._connecting += 1
+        client = None
+        try:
+            client = yield self._endpoint.connect(self._factory)
+            # Makes the daemon send keepalive pings on this connection
+            yield client.connect_supports_feature(
+                constants.DRV_FEATURE_PROGRAM_KEEPALIVE)
+        except Exception:
+            reason = failure.Failure()
+            self._connecting -= 1
+            logger.msg('libvirt.pool.connection_failed',
+                       error=reason.getErrorMessage())
+            if client is not None:
+                client.transport.loseConnection()
+            # Nothing left to serve the waiters
+            if not self._connecting and not self._connections:
+                waiters, self._waiters = self._waiters, []
+                for d in waiters:
+                    d.errback(reason)
+        else:
+            self._connecting -= 1
+            logger.msg('libvirt.pool.connected')
+            self._connections.add(client)
+            d = client.notify_disconnect()
+            d.addCallback(lambda _: self._connection_lost(client))
+            for _ in range(self.calls_per_connection):
+                self._put(client)
+
+    def _connection_lost(self, client):
+        logger.msg('libvirt.pool.connection_lost')
+        self._discard(client)
+        if self._waiters or self.running:
+            self._fill()
+
+    def _discard(self, client):
+        self._connections.discard(client)
+        self._idle = [c for c in self._idle if c is not client]
+
+    def _put(self, client):
+        if self._waiters:
+            self._waiters.pop(0).callback(client)
+        else:
+            self._idle.append(client)
+
+    @defer.inlineCallbacks
+    def _close(self, client):
+        try:
+            yield timeout(self._reactor, client.connect_close(),
+                          self.ping_timeout)
+        except Exception:
+            pass
+        client.transport.loseConnection()
+
+    def acquire(self):
+        """
+        Returns a deferred fired with a connection as soon as one is
+        available. The connection has to be given back with release.
+        """
+        if self._idle:
+            return defer.succeed(self._idle.pop())
+        d = defer.Deferred(self._waiters.remove)
+        self._waiters.append(d)
+        if len(self._connections) + self._connecting < self.size:
+            self._open_connection()
+        return d
+
+    def release(self, client):
+        if client in self._connections:
+            self._put(client)
+
+    @defer.inlineCallbacks
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func with a connection from the pool as first argument and
+        returns its (deferred) result, releasing the connection afterwards.
+
+        If retry is given as a true keyword argument and the connection is
+        lost while func is running, func is called a second time on a new
+        connection. This is only safe for read-only calls, as the lost calls
+        may have been carried out by the server.
+        """
+        retry = kwargs.pop('retry', False)
+        for attempt in range(2):
+            client = yield self.acquire()
+            try:
+                result = yield func(client, *args, **kwargs)
+            except (net_error.ConnectionLost, net_error.ConnectionDone):
+                if attempt or not retry:
+                    raise
+                logger.msg('libvirt.pool.retrying')
+            else:
+                defer.returnValue(result)
+            finally:
+                self.release(client)
+
+    def check_connections(self):
+        """
+        Pings all idle connections and drops the ones not answering.
+        """
+        idle = [c for c in self._connections
+                if self._idle.count(c) == self.calls_per_connection]
+        dl = [self._check(client) for client in idle]
+        d = defer.DeferredList(dl)
+        d.addCallback(lambda _: self._fill())
+        return d
+
+    def _check(self, client):
+        d = timeout(self._reactor, client.ping(), self.ping_timeout)
+        d.addErrback(self._check_failed, client)
+        return d
+
+    def _check_failed(self, reason, client):
+        logger.msg('libvirt.pool.unhealthy', error=reason.type.__name__)
+        self._discard(client)
+        client.transport.loseConnection()
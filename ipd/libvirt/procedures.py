@@ -1,5 +1,5 @@
 from twisted.internet import defer
-from ipd.libvirt import error, constants
+from ipd.libvirt import error, constants, streams
 
 from structlog import get_logger
 logger = get_logger()
@@ -11,14 +11,47 @@ class ProcedureBase(object):
     args = None
     ret = None
 
+    _stream = None
+
     def __init__(self, program):
         self._program = program
-        self._pending = defer.Deferred()
+        self._pending = defer.Deferred(self._cancel)
+        self._serial = None
+        self._timer = None
         self._log = program._log.bind(procedure=self.name)
 
+    def _cancel(self, d):
+        self._program.cancel_call(self)
+
     def __call__(self, *args, **kwargs):
         return self._program.call(self, args, kwargs)
 
+    def upload(self, source, *args, **kwargs):
+        """
+        Calls a procedure opening a stream to the server (e.g.
+        storage_vol_upload) and sends the content of source (a FilePath, a
+        filename or a file object) over it. Returns a deferred fired once
+        the whole content was accepted by the server.
+        """
+        return self._stream_call(streams.UploadStream(self, source),
+                                 args, kwargs)
+
+    def download(self, target, *args, **kwargs):
+        """
+        Calls a procedure opening a stream from the server (e.g.
+        storage_vol_download) and writes the received data to target (a
+        FilePath, a filename, a file object or an IConsumer). Returns a
+        deferred fired once all data was received.
+        """
+        return self._stream_call(streams.DownloadStream(self, target),
+                                 args, kwargs)
+
+    def _stream_call(self, stream, args, kwargs):
+        self._stream = stream
+        d = self._program.call(self, args, kwargs)
+        d.addCallbacks(stream.call_succeeded, stream.call_failed)
+        return stream.finished
+
     def handle_CALL(self, status, payload):
         self._log.msg('libvirt.recv.call')
         raise error.FeatureNotSupported(
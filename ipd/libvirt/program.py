@@ -1,3 +1,8 @@
+import collections
+
+from twisted.internet import defer
+from twisted.python import failure
+
 from ipd.libvirt import error, constants, remote
 
 from structlog import get_logger
@@ -5,12 +10,28 @@ logger = get_logger()
 
 
 class Program(object):
+    """
+    Base class for the programs spoken over a libvirt connection.
+
+    Calls are multiplexed on the connection: any number of calls can wait
+    for their reply at the same time, each one being identified by its
+    serial. If the protocol defines a max_in_flight limit, further calls are
+    queued and sent in the order they were made as soon as replies arrive.
+    If the protocol defines a call_timeout, calls which did not get a reply
+    in time (including the time spent in the queue) fail with CallTimeout.
+    """
+
     id = None
     version = None
 
-    def __init__(self, protocol):
+    def __init__(self, protocol, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
         self._pending_calls = {}
+        self._queued_calls = collections.deque()
+        self._streams = {}
         self._protocol = protocol
+        self._clock = clock
         self._log = logger.new(program=self.__class__.__name__)
 
     def version_supported(self, version):
@@ -22,15 +43,26 @@ class Program(object):
     def get_procedure(self, procedure_id, packet_type, serial):
         if packet_type == constants.packet_type.REPLY:
             try:
-                procedure = self._pending_calls.pop((procedure_id, serial))
+                procedure = self._pending_calls[procedure_id, serial]
             except KeyError:
-                raise error.NoPendingCall(procedure, serial)
+                raise error.NoPendingCall(procedure_id, serial)
         else:
             klass = self.get_procedure_class(procedure_id)
             procedure = klass(self)
 
         return procedure
 
+    def connection_lost(self, reason):
+        pending = self._pending_calls.values()
+        pending.extend(p for p, _, _ in self._queued_calls)
+        self._pending_calls = {}
+        self._queued_calls.clear()
+        for procedure in pending:
+            self._stop_timer(procedure)
+            procedure._pending.errback(reason)
+        for stream in self._streams.values():
+            stream.connection_lost(reason)
+
     def packet_received(self, protocol, header, payload):
         ver, procedure, packet_type, serial, status = header
 
@@ -40,7 +72,19 @@ class Program(object):
         if packet_type not in constants.packet_type:
             raise error.UnknownPacketType(packet_type)
 
-        procedure = self.get_procedure(procedure, packet_type, serial)
+        if packet_type == constants.packet_type.STREAM:
+            self.stream_packet_received(procedure, serial, status, payload)
+            return
+
+        try:
+            procedure = self.get_procedure(procedure, packet_type, serial)
+        except error.NoPendingCall:
+            # Reply to a call which timed out or was cancelled
+            self._log.msg('libvirt.recv.unexpected_reply', serial=serial)
+            return
+
+        if packet_type == constants.packet_type.REPLY:
+            self._call_finished(procedure)
 
         packet_type_name = constants.packet_type[packet_type]
         func = getattr(procedure, 'handle_' + packet_type_name)
@@ -48,32 +92,207 @@ class Program(object):
 
     def call(self, procedure, args=None, kwargs=None):
         self._log.msg('libvirt.call', procedure=procedure.name)
-        serial = self._protocol.next_serial()
-        packet = self._protocol.make_packet(
-            self.id, self.version, procedure.id,
-            constants.packet_type.CALL, serial, constants.status.OK
-        )
-        procedure.pack_args(packet, args, kwargs)
-        self._protocol.send_packet(packet)
-        self._pending_calls[procedure.id, serial] = procedure
+        timeout = self._protocol.call_timeout
+        if timeout is not None:
+            procedure._timer = self._clock.callLater(
+                timeout, self._call_timed_out, procedure, timeout)
+        self._queued_calls.append((procedure, args, kwargs))
+        self._send_queued_calls()
         return procedure._pending
 
+    def stream_packet_received(self, procedure_id, serial, status, payload):
+        try:
+            stream = self._streams[procedure_id, serial]
+        except KeyError:
+            # Data for an aborted stream
+            self._log.msg('libvirt.recv.unexpected_stream', serial=serial)
+        else:
+            stream.packet_received(status, payload)
+
+    def close_stream(self, stream):
+        self._streams.pop((stream._procedure.id, stream.serial), None)
+
+    def cancel_call(self, procedure):
+        """
+        Forgets about the given call, whether it was already sent or not.
+        """
+        self._call_finished(procedure)
+
+    @property
+    def in_flight(self):
+        return len(self._pending_calls)
+
+    @property
+    def queued(self):
+        return len(self._queued_calls)
+
+    def _send_queued_calls(self):
+        limit = self._protocol.max_in_flight
+        while self._queued_calls and (limit is None or
+                                      len(self._pending_calls) < limit):
+            procedure, args, kwargs = self._queued_calls.popleft()
+            serial = self._protocol.next_serial()
+            packet = self._protocol.make_packet(
+                self.id, self.version, procedure.id,
+                constants.packet_type.CALL, serial, constants.status.OK
+            )
+            try:
+                procedure.pack_args(packet, args, kwargs)
+            except Exception:
+                self._stop_timer(procedure)
+                procedure._pending.errback()
+                continue
+            self._protocol.send_packet(packet)
+            procedure._serial = serial
+            self._pending_calls[procedure.id, serial] = procedure
+            if procedure._stream is not None:
+                procedure._stream.opened(serial)
+                self._streams[procedure.id, serial] = procedure._stream
+
+    def _stop_timer(self, procedure):
+        if procedure._timer is not None:
+            if procedure._timer.active():
+                procedure._timer.cancel()
+            procedure._timer = None
+
+    def _call_finished(self, procedure):
+        self._stop_timer(procedure)
+        if procedure._serial is None:
+            for i, (queued, _, _) in enumerate(self._queued_calls):
+                if queued is procedure:
+                    del self._queued_calls[i]
+                    break
+        else:
+            self._pending_calls.pop((procedure.id, procedure._serial), None)
+        self._send_queued_calls()
+
+    def _call_timed_out(self, procedure, timeout):
+        procedure._timer = None
+        self._log.msg('libvirt.call.timeout', procedure=procedure.name)
+        self._call_finished(procedure)
+        procedure._pending.errback(error.CallTimeout(procedure.name, timeout))
+
 
 class RemoteProgram(Program):
+    """
+    The main libvirt program.
+
+    Domain events are dispatched to the listeners registered with
+    subscribe; the messages of events nobody listens to are not decoded.
+    """
+
     id = remote.PROGRAM
     version = remote.PROTOCOL_VERSION
 
+    def __init__(self, protocol, clock=None):
+        super(RemoteProgram, self).__init__(protocol, clock)
+        self._event_listeners = {}
+        # Listeners added and deferreds waiting for the registration in
+        # progress, by procedure id
+        self._registering = {}
+
     def get_procedure_class(self, procedure_id):
         try:
             return remote.PROCEDURE_BY_ID[procedure_id]
         except KeyError:
             raise error.ProcedureNotFound(self.id, procedure_id)
 
+    def get_event_procedure(self, event_id):
+        name = 'domain_event_' + constants.domain_event_id[event_id].lower()
+        return remote.PROCEDURE_BY_NAME[name]
+
+    def get_event_type(self, procedure_id):
+        procedure = self.get_procedure_class(procedure_id)
+        return getattr(remote, procedure.name + '_msg')
+
+    def packet_received(self, protocol, header, payload):
+        ver, procedure, packet_type, serial, status = header
+        if packet_type == constants.packet_type.EVENT:
+            if not self.version_supported(ver):
+                raise error.VersionNotSupported(self.id, ver)
+            self.event_received(procedure, payload)
+        else:
+            super(RemoteProgram, self).packet_received(protocol, header,
+                                                       payload)
+
+    def event_received(self, procedure_id, payload):
+        listeners = self._event_listeners.get(procedure_id)
+        if not listeners:
+            self._log.msg('libvirt.recv.event.ignored', procedure=procedure_id)
+            return
+        event = self.get_event_type(procedure_id).unpack(payload)
+        for callback in list(listeners):
+            try:
+                callback(event)
+            except Exception:
+                reason = failure.Failure()
+                self._log.msg('libvirt.event.failed', procedure=procedure_id,
+                              error=reason.getErrorMessage(),
+                              traceback=reason.getTraceback())
+
+    @defer.inlineCallbacks
+    def subscribe(self, event_id, callback):
+        """
+        Calls callback with the decoded message of each event_id domain
+        event received on this connection. The server is asked to send the
+        events when the first listener for event_id is added; listeners
+        added in the meantime wait for the registration, and are removed
+        with the first one if it fails.
+        """
+        procedure_id = self.get_event_procedure(event_id).id
+        listeners = self._event_listeners.setdefault(procedure_id, [])
+        listeners.append(callback)
+        if procedure_id in self._registering:
+            added, waiting = self._registering[procedure_id]
+            added.append(callback)
+            d = defer.Deferred()
+            waiting.append(d)
+            yield d
+        elif len(listeners) == 1:
+            added, waiting = [callback], []
+            self._registering[procedure_id] = added, waiting
+            register = remote.ConnectDomainEventRegisterAny(self)
+            try:
+                yield register(event_id)
+            except Exception:
+                reason = failure.Failure()
+                del self._registering[procedure_id]
+                for listener in added:
+                    if listener in listeners:
+                        listeners.remove(listener)
+                for d in waiting:
+                    d.errback(reason)
+                reason.raiseException()
+            del self._registering[procedure_id]
+            for d in waiting:
+                d.callback(None)
+
+    @defer.inlineCallbacks
+    def unsubscribe(self, event_id, callback):
+        procedure_id = self.get_event_procedure(event_id).id
+        listeners = self._event_listeners.get(procedure_id, [])
+        listeners.remove(callback)
+        if not listeners:
+            deregister = remote.ConnectDomainEventDeregisterAny(self)
+            yield deregister(event_id)
+
 
 class KeepaliveProgram(Program):
     id = 0x6b656570
     version = 1
 
+    PING = 1
+    PONG = 2
+
+    def __init__(self, protocol, clock=None):
+        super(KeepaliveProgram, self).__init__(protocol, clock)
+        self._waiting_pongs = []
+
+    def connection_lost(self, reason):
+        waiting, self._waiting_pongs = self._waiting_pongs, []
+        for d in waiting:
+            d.errback(reason)
+
     def packet_received(self, protocol, header, payload):
         ver, procedure, packet_type, serial, status = header
 
@@ -83,10 +302,28 @@ class KeepaliveProgram(Program):
         if packet_type != constants.packet_type.EVENT:
             raise error.UnknownPacketType(packet_type)
 
-        if procedure != 1:
+        if procedure == self.PING:
+            self._log.msg('libvirt.keepalive.ping')
+            self._send(self.PONG)
+        elif procedure == self.PONG:
+            self._log.msg('libvirt.keepalive.pong')
+            waiting, self._waiting_pongs = self._waiting_pongs, []
+            for d in waiting:
+                d.callback(None)
+        else:
             raise error.ProcedureNotFound(procedure)
 
-        self._log.msg('libvirt.keepalive.ping')
+    def _send(self, procedure):
         header = self._protocol.make_packet(
-            self.id, self.version, 2, constants.packet_type.EVENT)
+            self.id, self.version, procedure, constants.packet_type.EVENT)
         self._protocol.send_packet(header)
+
+    def ping(self):
+        """
+        Sends a ping to the server. Returns a deferred fired when the next
+        pong is received.
+        """
+        d = defer.Deferred(self._waiting_pongs.remove)
+        self._waiting_pongs.append(d)
+        self._send(self.PING)
+        return d
@@ -1,69 +1,84 @@
 import struct
-import xdrlib
 
 from twisted.protocols import basic
-from twisted.internet import protocol
+from twisted.internet import protocol, defer
 
-from ipd.libvirt import error, program, remote, constants
+from ipd.libvirt import error, program, remote, constants, types
 
 from structlog import get_logger
 logger = get_logger()
 
 
-class Packer(xdrlib.Packer):
-    def __init__(self, initial=''):
-        self._initial = initial
-        xdrlib.Packer.__init__(self)
+class PrefixIntNStringReceiver(basic.IntNStringReceiver):
+    """
+    Receiver for strings prefixed by their length, where the length includes
+    the prefix itself.
 
-    def reset(self):
-        xdrlib.Packer.reset(self)
-        # This only works because this class has the same name as its base
-        self.__buf.write(self._initial)
+    Received chunks are accumulated in a list and only joined once a whole
+    string is available, instead of concatenating the pending data on each
+    chunk. Strings are delivered to stringReceived as memoryview slices of
+    the received data.
+    """
 
+    _chunks = None
+    _offset = 0
+    _buffered = 0
 
-class PrefixIntNStringReceiver(basic.IntNStringReceiver):
     def dataReceived(self, data):
-        alldata = self._unprocessed + data
-        currentOffset = 0
+        if self._chunks is None:
+            self._chunks = []
+        if data:
+            self._chunks.append(data)
+            self._buffered += len(data)
+
         prefixLength = self.prefixLength
-        fmt = self.structFormat
-        self._unprocessed = alldata
 
-        while len(alldata) >= (currentOffset + prefixLength) and not self.paused:
-            messageStart = currentOffset + prefixLength
-            length, = struct.unpack(fmt, alldata[currentOffset:messageStart])
+        while self._buffered >= prefixLength and not self.paused:
+            length = self._peek_length()
             if length > self.MAX_LENGTH:
-                self._unprocessed = alldata
-                self._compatibilityOffset = currentOffset
                 self.lengthLimitExceeded(length)
                 return
-            messageEnd = currentOffset + length
-            if len(alldata) < messageEnd:
+            if self._buffered < length:
                 break
+            self._deliver_strings()
 
-            # Here we have to slice the working buffer so we can send just the
-            # netstring into the stringReceived callback.
-            packet = alldata[messageStart:messageEnd]
-            currentOffset = messageEnd
-            self._compatibilityOffset = currentOffset
-            self.stringReceived(packet)
+    def _peek_length(self):
+        prefixLength = self.prefixLength
+        if len(self._chunks[0]) - self._offset < prefixLength:
+            # The prefix itself is split across chunks
+            self._chunks = [''.join(self._chunks)[self._offset:]]
+            self._offset = 0
+        length, = struct.unpack_from(self.structFormat, self._chunks[0],
+                                     self._offset)
+        return length
+
+    def _deliver_strings(self):
+        if len(self._chunks) == 1:
+            alldata, currentOffset = self._chunks[0], self._offset
+        else:
+            self._chunks[0] = self._chunks[0][self._offset:]
+            alldata, currentOffset = ''.join(self._chunks), 0
 
-            # Check to see if the backwards compat "recvd" attribute got written
-            # to by application code.  If so, drop the current data buffer and
-            # switch to the new buffer given by that attribute's value.
-            if 'recvd' in self.__dict__:
-                alldata = self.__dict__.pop('recvd')
-                self._unprocessed = alldata
-                self._compatibilityOffset = currentOffset = 0
-                if alldata:
-                    continue
-                return
+        view = memoryview(alldata)
+        prefixLength = self.prefixLength
+        fmt = self.structFormat
+        end = len(alldata)
+
+        while end - currentOffset >= prefixLength and not self.paused:
+            length, = struct.unpack_from(fmt, alldata, currentOffset)
+            if length > self.MAX_LENGTH or end - currentOffset < length:
+                break
+            packet = view[currentOffset + prefixLength:currentOffset + length]
+            currentOffset += length
+            self.stringReceived(packet)
 
-        # Slice off all the data that has been processed, avoiding holding onto
-        # memory to store it, and update the compatibility attributes to reflect
-        # that change.
-        self._unprocessed = alldata[currentOffset:]
-        self._compatibilityOffset = 0
+        if currentOffset == end:
+            self._chunks = []
+            self._offset = 0
+        else:
+            self._chunks = [alldata]
+            self._offset = currentOffset
+        self._buffered = end - currentOffset
 
     def sendString(self, string):
         if len(string) >= 2 ** (8 * self.prefixLength):
@@ -80,17 +95,33 @@ class PrefixInt32StringReceiver(PrefixIntNStringReceiver,
 
 
 class LibvirtProtocol(PrefixInt32StringReceiver):
+    # Maximum size of a message accepted by libvirtd (VIR_NET_MESSAGE_MAX)
+    MAX_LENGTH = 16 * 1024 * 1024
+
     header_format = '>IIiiIi'
     header_length = struct.calcsize(header_format)
+    header_struct = struct.Struct(header_format)
+
+    # Maximum number of calls waiting for a reply at the same time, further
+    # calls are queued (None for no limit)
+    max_in_flight = None
+
+    # Seconds after which a call without reply fails (None for no timeout)
+    call_timeout = None
+
+    # Provider of callLater used to time out the calls (None for the reactor)
+    clock = None
 
     def __init__(self):
         self._log = logger.new()
         self._current_serial = 0
         self._waiting = {}
         self._programs = {}
+        self._disconnected = None
+        self._disconnect_waiters = []
 
     def register_program(self, program_factory):
-        prog = program_factory(self)
+        prog = program_factory(self, self.clock)
         self._programs[prog.id] = prog
         return prog
 
@@ -104,6 +135,38 @@ class LibvirtProtocol(PrefixInt32StringReceiver):
         self._remote = self.register_program(program.RemoteProgram)
         self._keepalive = self.register_program(program.KeepaliveProgram)
 
+    def connectionLost(self, reason):
+        self._log.msg('libvirt.disconnected')
+        self._disconnected = reason
+        waiters, self._disconnect_waiters = self._disconnect_waiters, []
+        for d in waiters:
+            d.callback(None)
+        for prog in self._programs.itervalues():
+            prog.connection_lost(reason)
+
+    def notify_disconnect(self):
+        """
+        Returns a deferred fired once the connection is lost.
+        """
+        if self._disconnected is not None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._disconnect_waiters.append(d)
+        return d
+
+    def ping(self):
+        return self._keepalive.ping()
+
+    def subscribe(self, event_id, callback):
+        """
+        Registers callback for the domain events of type event_id (one of
+        constants.domain_event_id) received on this connection.
+        """
+        return self._remote.subscribe(event_id, callback)
+
+    def unsubscribe(self, event_id, callback):
+        return self._remote.unsubscribe(event_id, callback)
+
     def stringReceived(self, string):
         header, payload = self._unpack_packet(string)
         try:
@@ -113,19 +176,31 @@ class LibvirtProtocol(PrefixInt32StringReceiver):
         program.packet_received(self, header[1:], payload)
 
     def _unpack_packet(self, data):
-        header = struct.unpack(self.header_format, data[:self.header_length])
-        payload = xdrlib.Unpacker(data[self.header_length:])
+        header = struct.unpack_from(self.header_format, data)
+        payload = types.Unpacker(data, self.header_length)
         return header, payload
 
     def make_packet(self, program, version, procedure, type, serial=0,
                     status=constants.status.OK):
-        header = struct.pack('>IIiiIi', program, version, procedure, type,
-                             serial, status)
-        packet = Packer(header)
+        """
+        Returns a packer whose buffer already contains the header of the
+        packet and has room for the length prefix, so that the arguments
+        can be packed in place and the whole packet sent as is.
+        """
+        packet = types.Packer(self.prefixLength + self.header_length)
+        self.header_struct.pack_into(packet.get_buffer(), self.prefixLength,
+                                     program, version, procedure, type,
+                                     serial, status)
         return packet
 
     def send_packet(self, packet):
-        self.sendString(packet.get_buffer())
+        data = packet.get_buffer()
+        if len(data) >= 2 ** (8 * self.prefixLength):
+            raise basic.StringTooLongError(
+                'Try to send %s bytes whereas maximum is %s' % (
+                len(data), 2 ** (8 * self.prefixLength)))
+        struct.pack_into(self.structFormat, data, 0, len(data))
+        self.transport.write(str(data))
 
 
 class MagicLibvirtProtocol(LibvirtProtocol):
@@ -133,10 +208,22 @@ class MagicLibvirtProtocol(LibvirtProtocol):
         try:
             procedure = remote.PROCEDURE_BY_NAME[name]
         except KeyError:
-            raise
+            raise AttributeError(name)
         else:
             return procedure(self._remote)
 
 
 class LibvirtFactory(protocol.Factory):
     protocol = MagicLibvirtProtocol
+
+    def __init__(self, max_in_flight=None, call_timeout=None, clock=None):
+        self.max_in_flight = max_in_flight
+        self.call_timeout = call_timeout
+        self.clock = clock
+
+    def buildProtocol(self, addr):
+        proto = protocol.Factory.buildProtocol(self, addr)
+        proto.max_in_flight = self.max_in_flight
+        proto.call_timeout = self.call_timeout
+        proto.clock = self.clock
+        return proto
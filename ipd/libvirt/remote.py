@@ -7,14 +7,21 @@ the next time that the generation script is run!
   Generated on:  2014-01-17T11:55:24.499890
   Command line:  gen-libvirt-protocol ../../temp/libvirt/src/remote/remote_protocol.x ipd/libvirt/remote.py
 
+Edited by hand afterwards, as remote_protocol.x was not available to run
+the script again: the typed_param_value union (the value of typed_param,
+previously not_implemented) was added and the imports were restricted to
+the types in use, the way the script now generates them.
+
 """
 
 from ipd.libvirt.procedures import ProcedureBase
-from ipd.libvirt.types import char, short, int, hyper
+from ipd.libvirt.types import char, int, hyper
+from ipd.libvirt.types import double
 from ipd.libvirt.types import uchar, ushort, uint, uhyper
-from ipd.libvirt.types import fstring, string, fopaque, opaque
+from ipd.libvirt.types import string, fopaque, opaque
 from ipd.libvirt.types import farray, array, optional
-from ipd.libvirt.types import not_implemented, compound, enum
+from ipd.libvirt.types import compound, enum
+from ipd.libvirt.types import union
 
 
 PROGRAM = 0x20008086
@@ -94,9 +101,19 @@ vcpu_info = compound('vcpu_info', [
     ('cpu', int),
 ])
 
+typed_param_value = union('typed_param_value', ('type', int), [
+    (1, 'i', int),
+    (2, 'ui', uint),
+    (3, 'l', hyper),
+    (4, 'ul', uhyper),
+    (5, 'd', double),
+    (6, 'b', int),
+    (7, 's', string),
+])
+
 typed_param = compound('typed_param', [
     ('field', string),
-    ('value', not_implemented),
+    ('value', typed_param_value),
 ])
 
 node_get_cpu_stats = compound('node_get_cpu_stats', [
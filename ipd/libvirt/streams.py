@@ -0,0 +1,217 @@
+"""
+Data streams attached to a remote call, as used by storage_vol_upload and
+storage_vol_download.
+
+Once the call opening the stream got its reply, the data is exchanged as
+STREAM packets sharing the procedure and serial of the call: chunks of data
+are sent with the CONTINUE status, the server marks the end of downloaded
+data with an empty CONTINUE packet and a packet with the OK status (answered
+by the peer with another OK packet) closes the stream. An ERROR packet
+carries a remote error and aborts the stream.
+"""
+
+from twisted.internet import defer, interfaces
+from twisted.protocols import basic
+from twisted.python import failure
+from twisted.python.filepath import FilePath
+from zope.interface import implementer
+
+from ipd.libvirt import constants, error
+
+
+class Stream(object):
+    # Maximum amount of data in a single packet
+    # (VIR_NET_MESSAGE_LEGACY_PAYLOAD_MAX)
+    chunk_size = 262120
+
+    def __init__(self, procedure):
+        self._procedure = procedure
+        self._program = procedure._program
+        self._protocol = self._program._protocol
+        self._log = procedure._log
+        self.serial = None
+        self.finished = defer.Deferred(self._cancel)
+        self._closing = False
+        self._active = True
+
+    def opened(self, serial):
+        """
+        Called once the call opening the stream was sent.
+        """
+        self.serial = serial
+
+    def call_succeeded(self, response):
+        pass
+
+    def call_failed(self, reason):
+        self._done(reason)
+
+    def connection_lost(self, reason):
+        self._done(reason)
+
+    def send(self, status, data=''):
+        packet = self._protocol.make_packet(
+            self._program.id, self._program.version, self._procedure.id,
+            constants.packet_type.STREAM, self.serial, status)
+        packet.pack_raw(data)
+        self._protocol.send_packet(packet)
+
+    def packet_received(self, status, payload):
+        if status == constants.status.CONTINUE:
+            self.data_received(payload.unpack_remaining())
+        elif status == constants.status.OK:
+            # Confirmation of the close request
+            self._done(None)
+        else:
+            reason = self._procedure.unpack_err(payload)
+            self._log.msg('libvirt.stream.error', error=str(reason))
+            self._done(failure.Failure(reason))
+
+    def data_received(self, data):
+        raise error.FeatureNotSupported(
+            'Stream does not accept incoming data.')
+
+    def close(self):
+        """
+        Asks the peer to close the stream; finished fires when it did.
+        """
+        if not self._closing:
+            self._closing = True
+            self.send(constants.status.OK)
+
+    def _cancel(self, d):
+        pending = self._procedure._pending
+        if not pending.called:
+            pending.cancel()
+        elif self._active:
+            self.send(constants.status.ERROR)
+        self._stop()
+
+    def _stop(self):
+        if self._active:
+            self._active = False
+            self._program.close_stream(self)
+            self._stopped()
+
+    def _done(self, result):
+        self._stop()
+        if not self.finished.called:
+            if result is None:
+                self._log.msg('libvirt.stream.finished')
+                self.finished.callback(None)
+            else:
+                self.finished.errback(result)
+
+    def _stopped(self):
+        pass
+
+
+def _open(target, mode):
+    if isinstance(target, FilePath):
+        return target.open(mode)
+    elif isinstance(target, basestring):
+        return open(target, mode + 'b')
+    return target
+
+
+class UploadStream(Stream):
+    """
+    Sends the content of a file (a FilePath, a filename or a file object)
+    to the server. Chunks are read from the file only when the transport
+    is ready to send more data.
+
+    As the file is registered as a producer on the transport of the
+    connection, only one upload at a time can run on a connection.
+    """
+
+    def __init__(self, procedure, source):
+        super(UploadStream, self).__init__(procedure)
+        self._source = source
+        self._file = None
+        self._sender = None
+
+    def call_succeeded(self, response):
+        if not self._active:
+            return
+        self._log.msg('libvirt.stream.upload')
+        self._file = _open(self._source, 'r')
+        self._sender = basic.FileSender()
+        self._sender.CHUNK_SIZE = self.chunk_size
+        d = self._sender.beginFileTransfer(self._file, self)
+        d.addCallbacks(self._data_sent, self._send_failed)
+
+    def registerProducer(self, producer, streaming):
+        self._protocol.transport.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._protocol.transport.unregisterProducer()
+
+    def write(self, data):
+        self.send(constants.status.CONTINUE, data)
+
+    def _data_sent(self, _):
+        self._sender = None
+        self.close()
+
+    def _send_failed(self, reason):
+        # The sender was stopped, either by _stopped or by the transport
+        # losing the connection, in which case connection_lost follows.
+        self._sender = None
+
+    def _stopped(self):
+        if self._sender is not None:
+            sender, self._sender = self._sender, None
+            sender.stopProducing()
+            self.unregisterProducer()
+        if self._file is not None and self._file is not self._source:
+            self._file.close()
+
+
+@implementer(interfaces.IPushProducer)
+class DownloadStream(Stream):
+    """
+    Writes the data received from the server to a file (a FilePath, a
+    filename or a file object) or to an IConsumer.
+
+    A consumer can pause the stream, which stops reading from the
+    connection (and thus delays the replies to any other call made on it)
+    until it is resumed.
+    """
+
+    def __init__(self, procedure, target):
+        super(DownloadStream, self).__init__(procedure)
+        self._target = target
+        self._paused = False
+        if interfaces.IConsumer.providedBy(target):
+            self._file = target
+            target.registerProducer(self, True)
+        else:
+            self._file = _open(target, 'w')
+
+    def data_received(self, data):
+        if data:
+            self._file.write(data)
+        else:
+            # End of the data
+            self.close()
+
+    def pauseProducing(self):
+        self._paused = True
+        self._protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        self._protocol.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.finished.cancel()
+
+    def _stopped(self):
+        if self._paused:
+            self.resumeProducing()
+        if self._file is self._target:
+            if interfaces.IConsumer.providedBy(self._target):
+                self._target.unregisterProducer()
+        else:
+            self._file.close()
+        self._file = None
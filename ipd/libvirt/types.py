@@ -1,20 +1,345 @@
 import xdrlib
 import struct
+import operator
+import itertools
 from collections import namedtuple
 
 
+class CodeBuilder(object):
+    """
+    Accumulates the source code of a specialized codec function together with
+    the namespace it has to be executed in.
+
+    If a resolver is given, it is called with each object the code refers to
+    and has to return an expression evaluating to it in the scope the source
+    will be executed in (this is used to write the source to a module).
+    """
+
+    def __init__(self, resolver=None):
+        self.level = 0
+        self._lines = []
+        self._names = itertools.count()
+        self._bound = {}
+        self._resolver = resolver
+        self._resolved = []
+        self.namespace = {'struct': struct}
+
+    def emit(self, line):
+        self._lines.append('    ' * self.level + line)
+
+    def indent(self):
+        self.level += 1
+
+    def dedent(self):
+        self.level -= 1
+
+    def name(self, prefix):
+        return '{}{}'.format(prefix, next(self._names))
+
+    def bind(self, obj, prefix='_t'):
+        """
+        Makes the given object available to the generated code and returns
+        the name under which it can be referenced.
+        """
+        try:
+            return self._bound[id(obj)]
+        except KeyError:
+            if self._resolver is not None:
+                name = self._bound[id(obj)] = self._resolver(obj)
+                # Keep the object alive, so that its id is not reused
+                self._resolved.append(obj)
+            else:
+                name = self._bound[id(obj)] = self.name(prefix)
+                self.namespace[name] = obj
+            return name
+
+    def source(self):
+        return '\n'.join(self._lines) + '\n'
+
+    def build(self, name, filename='<codec>'):
+        code = compile(self.source(), filename, 'exec')
+        exec(code, self.namespace)
+        return self.namespace[name]
+
+
+class Packer(object):
+    """
+    XDR packer encoding values in place at the end of a growable bytearray.
+
+    A number of bytes can be reserved at the beginning of the buffer, to be
+    filled in once all values have been packed (e.g. a length prefix).
+    Implements the same interface as xdrlib.Packer, except that get_buffer
+    returns the bytearray itself instead of a copy of its content.
+    """
+
+    _int = struct.Struct('>i')
+    _uint = struct.Struct('>I')
+    _hyper = struct.Struct('>q')
+    _uhyper = struct.Struct('>Q')
+    _float = struct.Struct('>f')
+    _double = struct.Struct('>d')
+
+    def __init__(self, reserved=0):
+        self._reserved = reserved
+        self.reset()
+
+    def reset(self):
+        self._buf = bytearray(self._reserved)
+
+    def get_buffer(self):
+        return self._buf
+
+    def pack_raw(self, data):
+        self._buf += data
+
+    def pack_int(self, x):
+        self._buf += self._int.pack(x)
+
+    def pack_uint(self, x):
+        self._buf += self._uint.pack(x)
+
+    def pack_hyper(self, x):
+        self._buf += self._hyper.pack(x)
+
+    def pack_uhyper(self, x):
+        self._buf += self._uhyper.pack(x)
+
+    def pack_float(self, x):
+        self._buf += self._float.pack(x)
+
+    def pack_double(self, x):
+        self._buf += self._double.pack(x)
+
+    pack_enum = pack_int
+
+    def pack_bool(self, x):
+        self._buf += '\0\0\0\1' if x else '\0\0\0\0'
+
+    def pack_fstring(self, n, s):
+        if n < 0:
+            raise ValueError('fstring size must be nonnegative')
+        data = s[:n]
+        self._buf += data
+        self._buf += '\0' * ((n + 3) // 4 * 4 - len(data))
+
+    pack_fopaque = pack_fstring
+
+    def pack_string(self, s):
+        n = len(s)
+        self.pack_uint(n)
+        self.pack_fstring(n, s)
+
+    pack_opaque = pack_string
+    pack_bytes = pack_string
+
+    def pack_farray(self, n, items, pack_item):
+        if len(items) != n:
+            raise ValueError('wrong array size')
+        for item in items:
+            pack_item(item)
+
+    def pack_array(self, items, pack_item):
+        n = len(items)
+        self.pack_uint(n)
+        self.pack_farray(n, items, pack_item)
+
+
+class Unpacker(object):
+    """
+    XDR unpacker decoding values directly out of the received data (a string
+    or a memoryview of it) by means of struct.unpack_from, without copying or
+    slicing the buffer for each value. Only strings and opaque data are
+    copied out of the buffer.
+
+    Implements the same interface as xdrlib.Unpacker; positions are always
+    relative to the beginning of the buffer, also if a starting position is
+    given.
+    """
+
+    _int = struct.Struct('>i')
+    _uint = struct.Struct('>I')
+    _hyper = struct.Struct('>q')
+    _uhyper = struct.Struct('>Q')
+    _float = struct.Struct('>f')
+    _double = struct.Struct('>d')
+
+    def __init__(self, data, position=0):
+        self.reset(data, position)
+
+    def reset(self, data, position=0):
+        self._buf = data
+        self._pos = position
+        self._is_view = isinstance(data, memoryview)
+
+    def get_position(self):
+        return self._pos
+
+    def set_position(self, position):
+        self._pos = position
+
+    def get_buffer(self):
+        return self._buf
+
+    def unpack_remaining(self):
+        """
+        Returns the raw data left in the buffer (e.g. the data carried by a
+        stream packet).
+        """
+        data = self._buf[self._pos:]
+        self._pos = len(self._buf)
+        if self._is_view:
+            data = data.tobytes()
+        return data
+
+    def done(self):
+        if self._pos < len(self._buf):
+            raise xdrlib.Error('unextracted data remains')
+
+    def _unpack(self, s):
+        try:
+            value, = s.unpack_from(self._buf, self._pos)
+        except struct.error:
+            raise EOFError
+        self._pos += s.size
+        return value
+
+    def unpack_int(self):
+        return self._unpack(self._int)
+
+    def unpack_uint(self):
+        return self._unpack(self._uint)
+
+    def unpack_hyper(self):
+        return self._unpack(self._hyper)
+
+    def unpack_uhyper(self):
+        return self._unpack(self._uhyper)
+
+    def unpack_float(self):
+        return self._unpack(self._float)
+
+    def unpack_double(self):
+        return self._unpack(self._double)
+
+    unpack_enum = unpack_int
+
+    def unpack_bool(self):
+        return bool(self._unpack(self._int))
+
+    def unpack_fstring(self, n):
+        if n < 0:
+            raise ValueError('fstring size must be nonnegative')
+        i = self._pos
+        j = i + (n + 3) // 4 * 4
+        if j > len(self._buf):
+            raise EOFError
+        self._pos = j
+        if self._is_view:
+            return self._buf[i:i + n].tobytes()
+        return self._buf[i:i + n]
+
+    unpack_fopaque = unpack_fstring
+
+    def unpack_string(self):
+        i = self._pos + 4
+        try:
+            n, = self._uint.unpack_from(self._buf, self._pos)
+        except struct.error:
+            raise EOFError
+        j = i + (n + 3) // 4 * 4
+        if j > len(self._buf):
+            raise EOFError
+        self._pos = j
+        if self._is_view:
+            return self._buf[i:i + n].tobytes()
+        return self._buf[i:i + n]
+
+    unpack_opaque = unpack_string
+    unpack_bytes = unpack_string
+
+    def unpack_farray(self, n, unpack_item):
+        return [unpack_item() for _ in xrange(n)]
+
+    def unpack_array(self, unpack_item):
+        return self.unpack_farray(self.unpack_uint(), unpack_item)
+
+
+class lazy(object):
+    """
+    Non-data descriptor calling the decorated factory the first time the
+    attribute is accessed on an instance, and caching the returned value on
+    the instance under the name of the factory, or the given name if the
+    descriptor is assigned to another attribute.
+    """
+
+    def __init__(self, factory, name=None):
+        self._factory = factory
+        self._name = name or factory.__name__
+        self.__doc__ = factory.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self._factory(instance)
+        setattr(instance, self._name, value)
+        return value
+
+
 class TypeBase(object):
+    # Format (without byte order prefix) of the struct encoding values of
+    # this type if they are always encoded on the same number of bytes and
+    # aligned to 4 bytes, None otherwise.
+    fixed_format = None
+
     def pack(self, stream, value):
         raise NotImplementedError()
 
     def unpack(self, stream):
         raise NotImplementedError()
 
+    def emit_unpack(self, gen):
+        """
+        Returns an expression decoding a value of this type from the stream.
+        """
+        return '{}.unpack(stream)'.format(gen.bind(self))
+
+    def emit_pack(self, gen, expr):
+        """
+        Returns a statement encoding the value of the given expression.
+        """
+        return '{}.pack(stream, {})'.format(gen.bind(self), expr)
+
+    def emit_unpack_fixed(self, gen, values):
+        """
+        Returns an expression building a value of this type out of the raw
+        values decoded by the fixed_format struct.
+        """
+        return next(values)
+
+    def emit_pack_fixed(self, gen, expr):
+        """
+        Returns the expressions to be passed to the fixed_format struct to
+        encode the value of the given expression.
+        """
+        return [expr]
+
 
 class Type(TypeBase):
-    def __init__(self, packer, unpacker):
+    def __init__(self, packer, unpacker, fixed_format=None, name=None):
         self.pack = packer
         self.unpack = unpacker
+        self.fixed_format = fixed_format
+        self.name = name
+
+    def emit_unpack(self, gen):
+        if self.name is None:
+            return super(Type, self).emit_unpack(gen)
+        return 'stream.unpack_{}()'.format(self.name)
+
+    def emit_pack(self, gen, expr):
+        if self.name is None:
+            return super(Type, self).emit_pack(gen, expr)
+        return 'stream.pack_{}({})'.format(self.name, expr)
 
 
 class TypeFactoryMeta(type):
@@ -25,33 +350,30 @@ class TypeFactory(TypeBase):
     __metaclass__ = TypeFactoryMeta
 
 
-class CustomSimpleType(TypeBase):
-    def __init__(self, fmt):
-        self.fmt = fmt
-        self.length = struct.calcsize(fmt)
+def make_xdr_type(name, fixed_format=None):
+    pack = 'pack_{}'.format(name)
 
-    def pack(self, stream, value):
-        stream.get_buffer().write(struct.pack(self.fmt, value))
+    def packer(stream, value):
+        getattr(stream, pack)(value)
 
-    def unpack(self, stream):
-        i = stream.get_position()
-        j = i + self.length
-        stream.set_position(j)
-        data = stream.get_buffer()[i:j]
-        if len(data) < self.length:
-            raise EOFError
-        return struct.unpack(self.fmt, data)[0]
+    unpacker = operator.methodcaller('unpack_{}'.format(name))
+    return Type(packer, unpacker, fixed_format, name)
+
+
+def padded_format(length):
+    padding = (4 - length % 4) % 4
+    return '{}s{}'.format(length, 'x' * padding)
 
 
-def make_xdr_type(name):
-    packer = getattr(xdrlib.Packer, 'pack_{}'.format(name))
-    unpacker = getattr(xdrlib.Unpacker, 'unpack_{}'.format(name))
-    return Type(packer, unpacker)
+def values_count(fmt):
+    s = struct.Struct('>' + fmt)
+    return len(s.unpack('\0' * s.size))
 
 
 class FixedLengthString(TypeFactory):
     def __init__(self, length):
         self.length = length
+        self.fixed_format = padded_format(length)
 
     def pack(self, stream, s):
         stream.pack_fstring(self.length, s)
@@ -63,6 +385,7 @@ class FixedLengthString(TypeFactory):
 class FixedLengthData(TypeFactory):
     def __init__(self, length):
         self.length = length
+        self.fixed_format = padded_format(length)
 
     def pack(self, stream, s):
         stream.pack_fopaque(self.length, s)
@@ -72,10 +395,28 @@ class FixedLengthData(TypeFactory):
 
 
 class ComplexType(TypeFactory):
+    """
+    A structure, encoded as the sequence of its fields.
+
+    The pack and unpack methods are compiled on first use into functions
+    specialized for this structure, which merge consecutive fixed size
+    fields into a single struct call and only delegate to the field types
+    for the variable length ones.
+    """
+
     def __init__(self, name, fields):
         self.name = name
         self.fields = fields
-        self.model = namedtuple(name, [f[0] for f in fields])
+
+    @lazy
+    def model(self):
+        """
+        The namedtuple holding the decoded values. Creating a namedtuple
+        class is expensive, and most of the structures defined by the
+        protocol are never used by a given process, so this is only done
+        when the structure is first used.
+        """
+        return namedtuple(self.name, [f[0] for f in self.fields])
 
     def __repr__(self):
         return '{}({})'.format(self.name, ', '.join(f[0] for f in self.fields))
@@ -83,41 +424,219 @@ class ComplexType(TypeFactory):
     def __str__(self):
         return self.name
 
-    def unpack(self, stream):
-        values = (type.unpack(stream) for _, type in self.fields)
-        return self.model(*values)
+    @property
+    def fixed_format(self):
+        formats = [type.fixed_format for _, type in self.fields]
+        if formats and None not in formats:
+            return ''.join(formats)
 
-    def pack(self, stream, value):
+    def emit_unpack_fixed(self, gen, values):
+        fields = [type.emit_unpack_fixed(gen, values)
+                  for _, type in self.fields]
+        return '{}({})'.format(gen.bind(self.model, '_m'), ', '.join(fields))
+
+    def emit_pack_fixed(self, gen, expr):
+        exprs = []
         for name, type in self.fields:
-            type.pack(stream, getattr(value, name))
+            exprs += type.emit_pack_fixed(gen, '{}.{}'.format(expr, name))
+        return exprs
+
+    def _field_runs(self):
+        """
+        Groups the fields in runs of consecutive fixed size fields and
+        single variable length fields. Yields (is_fixed, fields) tuples.
+        """
+        key = lambda field: field[1].fixed_format is not None
+        for fixed, fields in itertools.groupby(self.fields, key):
+            if fixed:
+                yield True, list(fields)
+            else:
+                for field in fields:
+                    yield False, [field]
+
+    def emit_unpack_function(self, gen, name='unpack'):
+        gen.emit('def {}(stream):'.format(name))
+        gen.indent()
+        gen.emit('buf = stream.get_buffer()')
+        gen.emit('pos = stream.get_position()')
+        gen.emit('try:')
+        gen.indent()
+        if not self.fields:
+            gen.emit('pass')
+        values = []
+        for fixed, fields in self._field_runs():
+            if fixed:
+                fmt = ''.join(type.fixed_format for _, type in fields)
+                s = struct.Struct('>' + fmt)
+                raw = [gen.name('_v') for _ in range(values_count(fmt))]
+                gen.emit('{}, = {}.unpack_from(buf, pos)'.format(
+                    ', '.join(raw), gen.bind(s, '_s')))
+                gen.emit('pos += {}'.format(s.size))
+                raw = iter(raw)
+                for _, type in fields:
+                    values.append(type.emit_unpack_fixed(gen, raw))
+            else:
+                (_, type), = fields
+                value = gen.name('_f')
+                gen.emit('stream.set_position(pos)')
+                gen.emit('{} = {}'.format(value, type.emit_unpack(gen)))
+                gen.emit('pos = stream.get_position()')
+                values.append(value)
+        gen.dedent()
+        gen.emit('except struct.error:')
+        gen.emit('    raise EOFError')
+        gen.emit('stream.set_position(pos)')
+        gen.emit('return {}({})'.format(gen.bind(self.model, '_m'),
+                                        ', '.join(values)))
+        gen.dedent()
+
+    def emit_pack_function(self, gen, name='pack'):
+        gen.emit('def {}(stream, value):'.format(name))
+        gen.indent()
+        if not self.fields:
+            gen.emit('pass')
+        for fixed, fields in self._field_runs():
+            if fixed:
+                fmt = ''.join(type.fixed_format for _, type in fields)
+                s = struct.Struct('>' + fmt)
+                exprs = []
+                for name, type in fields:
+                    exprs += type.emit_pack_fixed(gen, 'value.' + name)
+                gen.emit('stream.pack_raw({}.pack({}))'.format(
+                    gen.bind(s, '_s'), ', '.join(exprs)))
+            else:
+                (field, type), = fields
+                gen.emit(type.emit_pack(gen, 'value.' + field))
+        gen.dedent()
+
+    def _compile_unpack(self):
+        gen = CodeBuilder()
+        self.emit_unpack_function(gen)
+        return gen.build('unpack', '<unpack {}>'.format(self.name))
+
+    def _compile_pack(self):
+        gen = CodeBuilder()
+        self.emit_pack_function(gen)
+        return gen.build('pack', '<pack {}>'.format(self.name))
+
+    unpack = lazy(_compile_unpack, 'unpack')
+    pack = lazy(_compile_pack, 'pack')
+
+
+class ArrayBase(TypeFactory):
+    """
+    Base class for arrays, whose pack and unpack methods are compiled on
+    first use depending on the type of the items.
+
+    Arrays of fixed size items are decoded by one struct call per item (or
+    one for the whole array in case of scalar items) without going through
+    the stream for each item.
+    """
+
+    length = None
+
+    def _emit_length(self, gen):
+        raise NotImplementedError()
 
+    def _is_scalar(self, raw):
+        probe = CodeBuilder()
+        item = self.items_type.emit_unpack_fixed(probe, iter([raw]))
+        return item == raw and not probe.source().strip()
+
+    def emit_unpack_function(self, gen, name='unpack'):
+        gen.emit('def {}(stream):'.format(name))
+        gen.indent()
+        self._emit_length(gen)
+        fmt = self.items_type.fixed_format
+        if fmt is None:
+            gen.emit('return [{} for _ in xrange(n)]'.format(
+                self.items_type.emit_unpack(gen)))
+            gen.dedent()
+            return
+
+        s = struct.Struct('>' + fmt)
+        raw = [gen.name('_v') for _ in range(values_count(fmt))]
+        gen.emit('buf = stream.get_buffer()')
+        gen.emit('pos = stream.get_position()')
+        gen.emit('try:')
+        gen.indent()
+
+        if len(fmt) == 1 and self._is_scalar(raw[0]):
+            # Scalar items, decode the whole array at once
+            gen.emit("items = list(struct.unpack_from('>{{}}{}'.format(n), "
+                     "buf, pos))".format(fmt))
+            gen.emit('pos += {} * n'.format(s.size))
+        else:
+            gen.emit('items = []')
+            gen.emit('append = items.append')
+            gen.emit('for _ in xrange(n):')
+            gen.indent()
+            gen.emit('{}, = {}.unpack_from(buf, pos)'.format(
+                ', '.join(raw), gen.bind(s, '_s')))
+            gen.emit('pos += {}'.format(s.size))
+            item = self.items_type.emit_unpack_fixed(gen, iter(raw))
+            gen.emit('append({})'.format(item))
+            gen.dedent()
+
+        gen.dedent()
+        gen.emit('except struct.error:')
+        gen.emit('    raise EOFError')
+        gen.emit('stream.set_position(pos)')
+        gen.emit('return items')
+        gen.dedent()
+
+    def emit_pack_function(self, gen, name='pack'):
+        gen.emit('def {}(stream, items):'.format(name))
+        gen.indent()
+        gen.emit('n = len(items)')
+        if self.length is None:
+            gen.emit('stream.pack_uint(n)')
+        else:
+            gen.emit('if n != {}:'.format(self.length))
+            gen.emit("    raise ValueError('wrong array size')")
 
-class FixedLengthArray(TypeFactory):
+        fmt = self.items_type.fixed_format
+        if fmt is None:
+            gen.emit('for item in items:')
+            gen.emit('    ' + self.items_type.emit_pack(gen, 'item'))
+        else:
+            s = struct.Struct('>' + fmt)
+            exprs = self.items_type.emit_pack_fixed(gen, 'item')
+            gen.emit('pack = {}.pack'.format(gen.bind(s, '_s')))
+            gen.emit('for item in items:')
+            gen.emit('    stream.pack_raw(pack({}))'.format(', '.join(exprs)))
+        gen.dedent()
+
+    def _compile_unpack(self):
+        gen = CodeBuilder()
+        self.emit_unpack_function(gen)
+        return gen.build('unpack')
+
+    def _compile_pack(self):
+        gen = CodeBuilder()
+        self.emit_pack_function(gen)
+        return gen.build('pack')
+
+    unpack = lazy(_compile_unpack, 'unpack')
+    pack = lazy(_compile_pack, 'pack')
+
+
+class FixedLengthArray(ArrayBase):
     def __init__(self, items_type, length):
         self.items_type = items_type
         self.length = length
 
-    def pack(self, stream, items):
-        packer = lambda item: self.items_type.pack(stream, item)
-        stream.pack_farray(self.length, items, packer)
-
-    def unpack(self, stream):
-        unpacker = lambda: self.items_type.unpack(stream)
-        return stream.unpack_farray(self.length, unpacker)
+    def _emit_length(self, gen):
+        gen.emit('n = {}'.format(self.length))
 
 
-class VariableLengthArray(TypeFactory):
+class VariableLengthArray(ArrayBase):
     def __init__(self, items_type, maxlength):
         self.maxlength = maxlength
         self.items_type = items_type
 
-    def pack(self, stream, items):
-        packer = lambda item: self.items_type.pack(stream, item)
-        stream.pack_array(items, packer)
-
-    def unpack(self, stream):
-        unpacker = lambda: self.items_type.unpack(stream)
-        return stream.unpack_array(unpacker)
+    def _emit_length(self, gen):
+        gen.emit('n = stream.unpack_uint()')
 
 
 class Optional(TypeFactory):
@@ -137,8 +656,110 @@ class Optional(TypeFactory):
         else:
             return None
 
+    def emit_unpack(self, gen):
+        return '({} if stream.unpack_bool() else None)'.format(
+            self.type.emit_unpack(gen))
+
+    def emit_pack(self, gen, expr):
+        return ('(stream.pack_bool(True), {}) if {} else '
+                'stream.pack_bool(False)'.format(
+                    self.type.emit_pack(gen, expr), expr))
+
+
+class Union(TypeFactory):
+    """
+    A discriminated union, encoded as the discriminant followed by the value
+    of the arm selected by it.
+
+    Arms are given as (case, name, type) tuples, type being None for void
+    arms; the optional default arm as a (name, type) tuple. Values are
+    represented by a model holding the discriminant and the value of the
+    selected arm (None for void arms).
+
+    The pack and unpack methods are compiled on first use and test the
+    discriminant against each case in turn.
+    """
+
+    def __init__(self, name, discriminant, arms, default=None):
+        self.name = name
+        self.discriminant = discriminant
+        self.arms = arms
+        self.default = default
+
+    @lazy
+    def model(self):
+        return namedtuple(self.name, [self.discriminant[0], 'value'])
+
+    def __str__(self):
+        return self.name
+
+    def _branches(self):
+        """
+        Yields (condition, type) tuples, with the conditions ready to be
+        used in an if/elif chain on the discriminant d.
+        """
+        for case, _, type in self.arms:
+            yield 'd == {!r}'.format(case), type
+        if self.default is not None:
+            yield None, self.default[1]
+
+    def emit_unpack_function(self, gen, name='unpack'):
+        gen.emit('def {}(stream):'.format(name))
+        gen.indent()
+        gen.emit('d = {}'.format(self.discriminant[1].emit_unpack(gen)))
+        keyword = 'if'
+        for condition, type in self._branches():
+            if condition is None:
+                gen.emit('else:')
+            else:
+                gen.emit('{} {}:'.format(keyword, condition))
+            value = 'None' if type is None else type.emit_unpack(gen)
+            gen.emit('    value = {}'.format(value))
+            keyword = 'elif'
+        if self.default is None:
+            gen.emit('else:')
+            gen.emit("    raise ValueError('unknown {} discriminant %r' % d)"
+                     .format(self.name))
+        gen.emit('return {}(d, value)'.format(gen.bind(self.model, '_m')))
+        gen.dedent()
+
+    def emit_pack_function(self, gen, name='pack'):
+        gen.emit('def {}(stream, value):'.format(name))
+        gen.indent()
+        gen.emit('d, value = value')
+        gen.emit(self.discriminant[1].emit_pack(gen, 'd'))
+        keyword = 'if'
+        for condition, type in self._branches():
+            if condition is None:
+                gen.emit('else:')
+            else:
+                gen.emit('{} {}:'.format(keyword, condition))
+            gen.emit('    ' + ('pass' if type is None else
+                                type.emit_pack(gen, 'value')))
+            keyword = 'elif'
+        if self.default is None:
+            gen.emit('else:')
+            gen.emit("    raise ValueError('unknown {} discriminant %r' % d)"
+                     .format(self.name))
+        gen.dedent()
+
+    def _compile_unpack(self):
+        gen = CodeBuilder()
+        self.emit_unpack_function(gen)
+        return gen.build('unpack', '<unpack {}>'.format(self.name))
+
+    def _compile_pack(self):
+        gen = CodeBuilder()
+        self.emit_pack_function(gen)
+        return gen.build('pack', '<pack {}>'.format(self.name))
+
+    unpack = lazy(_compile_unpack, 'unpack')
+    pack = lazy(_compile_pack, 'pack')
+
 
 class Enum(TypeFactory):
+    fixed_format = 'i'
+
     def __init__(self, name, values):
         self.name = name
         self.values = values
@@ -152,18 +773,27 @@ class Enum(TypeFactory):
     def __str__(self):
         return self.name
 
+    def emit_unpack_fixed(self, gen, values):
+        value = next(values)
+        gen.emit('assert {} in {}'.format(value, gen.bind(self.ids, '_ids')))
+        return value
+
+    def emit_pack_fixed(self, gen, expr):
+        return ['{}.to_id({})'.format(gen.bind(self, '_e'), expr)]
+
     def key(self, id):
         return self._id_to_key[id]
 
     def id(self, key):
         return self._key_to_id[key]
 
+    def to_id(self, v):
+        if v in self._id_to_key:
+            return v
+        return self.id(v)
+
     def pack(self, stream, v):
-        if isinstance(v, int):
-            assert v in self.ids
-        else:
-            v = self.id(v)
-        return stream.pack_enum(v)
+        return stream.pack_enum(self.to_id(v))
 
     def unpack(self, stream):
         v = stream.unpack_enum()
@@ -174,14 +804,17 @@ class Enum(TypeFactory):
         return iter(self.values)
 
 
-int = make_xdr_type('int')
-uint = make_xdr_type('uint')
-hyper = make_xdr_type('hyper')
-uhyper = make_xdr_type('uhyper')
-char = CustomSimpleType('>b')
-uchar = CustomSimpleType('>B')
-short = CustomSimpleType('>h')
-ushort = CustomSimpleType('>H')
+int = make_xdr_type('int', 'i')
+uint = make_xdr_type('uint', 'I')
+hyper = make_xdr_type('hyper', 'q')
+uhyper = make_xdr_type('uhyper', 'Q')
+float = make_xdr_type('float', 'f')
+double = make_xdr_type('double', 'd')
+# XDR encodes all the integer types smaller than int on 4 bytes
+char = make_xdr_type('int', 'i')
+uchar = make_xdr_type('uint', 'I')
+short = make_xdr_type('int', 'i')
+ushort = make_xdr_type('uint', 'I')
 string = make_xdr_type('string')
 opaque = make_xdr_type('opaque')
 
@@ -189,8 +822,9 @@ fstring = FixedLengthString
 fopaque = FixedLengthData
 farray = FixedLengthArray
 array = VariableLengthArray
-not_implemented = TypeBase
+not_implemented = TypeBase()
 compound = ComplexType
+union = Union
 enum = Enum
 optional = Optional
 
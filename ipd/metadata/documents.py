@@ -0,0 +1,46 @@
+"""
+Rendering of the metadata documents served to an instance.
+
+All the documents of an instance are rendered at once, from its metadata
+and user data, into immutable bodies with an entity tag, so that requests
+only have to look them up by path.
+"""
+
+import hashlib
+import json
+from collections import namedtuple
+
+
+Document = namedtuple('Document', ['body', 'etag', 'content_type'])
+
+
+def document(body, content_type='text/plain'):
+    etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+    return Document(body, etag, content_type)
+
+
+def render_documents(metadata, userdata):
+    """
+    Returns a dict mapping the paths of the EC2 (relative to the API
+    version) and OpenStack (relative to openstack/<version>) documents to
+    their Document.
+    """
+    keys = metadata['public_keys']
+    docs = {
+        'meta-data/hostname': document(str(metadata['hostname'])),
+        'meta-data/instance-id': document(str(metadata['uuid'])),
+        'meta-data/public-keys': document('\n'.join(
+            '{}={}'.format(i, name) for i, (name, _) in enumerate(keys))),
+        'user-data': document(userdata),
+        'user_data': document(userdata),
+        'meta_data.json': document(json.dumps(dict(
+            metadata,
+            uuid=str(metadata['uuid']),
+            public_keys={name: key.toString('OPENSSH')
+                         for name, key in keys},
+        )), 'application/json'),
+    }
+    for i, (_, key) in enumerate(keys):
+        path = 'meta-data/public-keys/{}/openssh-key'.format(i)
+        docs[path] = document(key.toString('OPENSSH'))
+    return docs
@@ -1,6 +1,10 @@
 from uuid import UUID
 
 from twisted.internet import defer
+from twisted.python import failure
+
+from ipd.metadata.documents import render_documents
+from ipd.utils import DeferredCache
 
 
 USER_DATA = """#cloud-config
@@ -17,22 +21,61 @@ phone_home:
 KEY_NAME = 'ipd'
 
 
+class DomainNotFound(Exception):
+    pass
+
+
 class MetadataManager(object):
+    """
+    Serves the metadata of the instances running on the registered hosts.
+
+    Domain lookups are cached by (host, domain uuid) for cache_ttl seconds,
+    as cloud-init fetches several metadata keys in quick succession, and
+    invalidated when the inventory of the host reports a change to the
+    domain. So are the rendered documents served to each instance.
+
+    Instance data written during the same reactor iteration (e.g. by the
+    phone home requests of instances booted together) is merged by instance
+    and sent at once on a single redis connection. Each write is announced
+    on the channel named after the key of the instance data, with the
+    status of the instance (if set) as message.
+    """
 
-    def __init__(self, redis_connector, ssh_key):
+    cache_size = 1024
+    cache_ttl = 60
+
+    def __init__(self, redis_connector, ssh_key, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
         self._libvirt_hosts = {}
         self._ssh_key = ssh_key
         self._redis = redis_connector
+        self.cache = DeferredCache(self.cache_size, self.cache_ttl, reactor)
+        self.documents = DeferredCache(self.cache_size, self.cache_ttl,
+                                       reactor)
+        self._writes = {}
 
-    def register_host(self, hostname, endpoint):
-        self._libvirt_hosts[hostname] = endpoint
+    def register_host(self, hostname, inventory):
+        self._libvirt_hosts[hostname] = inventory
+        inventory.subscribe(
+            lambda uuid: self.invalidate(hostname, UUID(bytes=uuid)))
+
+    def invalidate(self, host, domain_uuid):
+        self.cache.invalidate((host, domain_uuid))
+        self.documents.invalidate((host, domain_uuid))
 
-    @defer.inlineCallbacks
     def _get_domain_by_uuid(self, host, domain_uuid):
-        client = yield self._libvirt_hosts[host].connect()
-        res = yield client.domain_lookup_by_uuid(domain_uuid.bytes)
-        yield client.connect_close()
-        defer.returnValue(res.dom)
+        return self.cache.get((host, domain_uuid), self._lookup_domain, host,
+                              domain_uuid)
+
+    @defer.inlineCallbacks
+    def _lookup_domain(self, host, domain_uuid):
+        inventory = self._libvirt_hosts[host]
+        domain = yield inventory.lookup(uuid=domain_uuid.bytes)
+        if domain is None:
+            raise DomainNotFound(domain_uuid)
+        defer.returnValue(domain)
 
     @defer.inlineCallbacks
     def get_metadata_for_uuid(self, host, domain_uuid):
@@ -52,6 +95,22 @@ class MetadataManager(object):
         userdata = USER_DATA.format(hostname=domain.name)
         defer.returnValue(userdata)
 
+    @defer.inlineCallbacks
+    def _render_documents(self, host, domain_uuid):
+        metadata = yield self.get_metadata_for_uuid(host, domain_uuid)
+        userdata = yield self.get_userdata_for_uuid(host, domain_uuid)
+        defer.returnValue(render_documents(metadata, userdata))
+
+    def get_document_for_uuid(self, host, domain_uuid, path):
+        """
+        Returns a deferred fired with the Document at the given path for the
+        domain, or with None if there is no such document.
+        """
+        d = self.documents.get((host, domain_uuid), self._render_documents,
+                               host, domain_uuid)
+        d.addCallback(lambda documents: documents.get(path))
+        return d
+
     @defer.inlineCallbacks
     def get_instancedata_for_uuid(self, domain_uuid):
         key = 'instancedata:{}'.format(domain_uuid)
@@ -59,8 +118,38 @@ class MetadataManager(object):
         data = yield redis.hgetall(key)
         defer.returnValue(data)
 
-    @defer.inlineCallbacks
     def add_instancedata_for_uuid(self, domain_uuid, data):
         key = 'instancedata:{}'.format(domain_uuid)
-        redis = yield self._redis()
-        yield redis.hmset(key, data)
+        if not self._writes:
+            self._reactor.callLater(0, self._flush_writes)
+        fields, waiters = self._writes.setdefault(key, ({}, []))
+        fields.update(data)
+        d = defer.Deferred()
+        waiters.append(d)
+        return d
+
+    @defer.inlineCallbacks
+    def _flush_writes(self):
+        writes, self._writes = self._writes, {}
+        try:
+            redis = yield self._redis()
+        except Exception:
+            reason = failure.Failure()
+            for _, waiters in writes.itervalues():
+                for d in waiters:
+                    d.errback(reason)
+            return
+        for key, (fields, waiters) in writes.iteritems():
+            d = redis.hmset(key, fields)
+            # Wake up whoever waits for this instance (e.g. its build)
+            d.addCallback(lambda _, key=key, status=fields.get('status', ''):
+                          redis.publish(key, status))
+            d.addBoth(_fire, waiters)
+
+
+def _fire(result, waiters):
+    for d in waiters:
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
@@ -2,7 +2,7 @@ import json
 from uuid import UUID
 
 from twisted.internet import defer
-from twisted.web import resource, server
+from twisted.web import http, resource, server
 
 
 class RecursiveResource(resource.Resource, object):
@@ -20,18 +20,12 @@ class RecursiveResource(resource.Resource, object):
         return child
 
 
-class MetadataMixin(object):
-    def __init__(self, server):
-        super(MetadataMixin, self).__init__()
-        self.meta_server = server
-
-    def get_metadata_from_request(self, request):
-        h = request.requestHeaders
-        hypervisor = h.getRawHeaders('X-Tenant-ID')[0]
-        domain_uuid = UUID(hex=h.getRawHeaders('X-Instance-ID')[0])
-        #domain_ip = h.getRawHeaders('X-Forwarded-For')[0]
-
-        return self.meta_server.get_metadata_for_uuid(hypervisor, domain_uuid)
+def get_instance_from_request(request):
+    h = request.requestHeaders
+    hypervisor = h.getRawHeaders('X-Tenant-ID')[0]
+    domain_uuid = UUID(hex=h.getRawHeaders('X-Instance-ID')[0])
+    #domain_ip = h.getRawHeaders('X-Forwarded-For')[0]
+    return hypervisor, domain_uuid
 
 
 class DelayedRendererMixin(object):
@@ -55,78 +49,48 @@ class DelayedRendererMixin(object):
         return server.NOT_DONE_YET
 
 
-class UserdataResource(DelayedRendererMixin, resource.Resource, object):
-    isLeaf = True
-    def __init__(self, server):
-        super(UserdataResource, self).__init__()
-        self.meta_server = server
-
-    def get_userdata_from_request(self, request):
-        h = request.requestHeaders
-        hypervisor = h.getRawHeaders('X-Tenant-ID')[0]
-        domain_uuid = UUID(hex=h.getRawHeaders('X-Instance-ID')[0])
-        #domain_ip = h.getRawHeaders('X-Forwarded-For')[0]
-
-        return self.meta_server.get_userdata_for_uuid(hypervisor, domain_uuid)
+class DocumentResource(DelayedRendererMixin, resource.Resource, object):
+    """
+    Serves one of the precomputed metadata documents of the requesting
+    instance, answering conditional requests matching its entity tag with
+    a 304 response.
+    """
 
-    def _delayed_renderer(self, request):
-        return self.get_userdata_from_request(request)
-
-
-class AtomResource(DelayedRendererMixin, MetadataMixin, resource.Resource,
-                   object):
-    def _delayed_renderer(self, request):
-        d = self.get_metadata_from_request(request)
-        d.addCallback(self.get_value)
-        return d
-
-    def get_value(self, metadata):
-        raise NotImplementedError()
-
-
-class KeyedAtomResource(AtomResource):
     isLeaf = True
 
-    def __init__(self, server, key):
-        super(KeyedAtomResource, self).__init__(server)
-        self._key = key
+    def __init__(self, server, path):
+        super(DocumentResource, self).__init__()
+        self.meta_server = server
+        self._path = path
 
-    def get_value(self, metadata):
-        val = metadata
-        for k in self._key:
-            val = val[k]
-        return str(val)
+    def _delayed_renderer(self, request):
+        hypervisor, domain_uuid = get_instance_from_request(request)
+        return self.meta_server.get_document_for_uuid(hypervisor, domain_uuid,
+                                                      self._path)
+
+    def finish_write(self, document, request):
+        if document is None:
+            request.setResponseCode(404)
+            request.write('404: Not found')
+        else:
+            request.setHeader('content-type', document.content_type)
+            if request.setETag(document.etag) is not http.CACHED:
+                request.write(document.body)
+        request.finish()
 
 
-class KeysResource(AtomResource):
+class KeysResource(DocumentResource):
     isLeaf = False
 
-    formats = {
-        'openssh-key': 'OPENSSH'
-    }
-
-    def get_value(self, metadata):
-        keys = ('{}={}'.format(i, k[0])
-                for i, k in enumerate(metadata['public_keys']))
-        return '\n'.join(keys)
+    def __init__(self, server):
+        super(KeysResource, self).__init__(server, 'meta-data/public-keys')
 
     def getChild(self, name, request):
         if not name:
             return self
-        key = int(name)
-        fmt = self.formats[request.postpath[0]]
-        return KeyRenderer(self.meta_server, key, fmt)
-
-
-class KeyRenderer(KeyedAtomResource):
-    def __init__(self, server, key, fmt):
-        super(KeyedAtomResource, self).__init__(server)
-        self._key = key
-        self._format = fmt
-
-    def get_value(self, metadata):
-        key = metadata['public_keys'][self._key][1]
-        return key.toString(self._format)
+        fmt = request.postpath[0] if request.postpath else ''
+        return DocumentResource(self.meta_server, '{}/{}/{}'.format(
+            self._path, name, fmt))
 
 
 class IndexResource(RecursiveResource):
@@ -151,11 +115,13 @@ class EC2MetadataAPI(IndexResource):
     def __init__(self, server):
         super(EC2MetadataAPI, self).__init__()
         meta = IndexResource()
-        meta.putChild('hostname', KeyedAtomResource(server, ['hostname']))
-        meta.putChild('instance-id', KeyedAtomResource(server, ['uuid']))
+        meta.putChild('hostname',
+                      DocumentResource(server, 'meta-data/hostname'))
+        meta.putChild('instance-id',
+                      DocumentResource(server, 'meta-data/instance-id'))
         meta.putChild('public-keys', KeysResource(server))
         self.putChild('meta-data', meta)
-        self.putChild('user-data', UserdataResource(server))
+        self.putChild('user-data', DocumentResource(server, 'user-data'))
 
 
 class OpenstackMetadataAPI(IndexResource):
@@ -164,24 +130,9 @@ class OpenstackMetadataAPI(IndexResource):
 
     def __init__(self, server):
         super(OpenstackMetadataAPI, self).__init__()
-        self.putChild('meta_data.json', OpenstackMetadata(server))
-        self.putChild('user_data', UserdataResource(server))
-
-
-class OpenstackMetadata(DelayedRendererMixin, MetadataMixin, resource.Resource,
-                        object):
-    isLeaf = True
-
-    @defer.inlineCallbacks
-    def _delayed_renderer(self, request):
-        metadata = yield self.get_metadata_from_request(request)
-        metadata['uuid'] = str(metadata['uuid'])
-        metadata['public_keys'] = {
-            k: v.toString('OPENSSH')
-            for k, v in metadata['public_keys']
-        }
-
-        defer.returnValue(json.dumps(metadata))
+        self.putChild('meta_data.json',
+                      DocumentResource(server, 'meta_data.json'))
+        self.putChild('user_data', DocumentResource(server, 'user_data'))
 
 
 class APIVersionsIndex(RecursiveResource):
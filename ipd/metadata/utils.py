@@ -1,69 +1,164 @@
-import re
-from collections import namedtuple
+import socket
+import struct
 
-from lxml import etree
 from twisted.internet import defer
 
 import structlog
 logger = structlog.get_logger()
 
 
-ARPEntry = namedtuple('ARPEntry',
-                      ['ip', 'type', 'flags', 'mac', 'mask', 'device'])
+# Flag of the complete entries of /proc/net/arp
+ATF_COM = 0x02
 
 
-def load_arp_table():
+def load_neighbours():
+    """
+    Returns the IPv4 neighbours of the host as a dict mapping IP addresses
+    to MAC addresses, as read from /proc/net/arp.
+    """
+    neighbours = {}
     with open('/proc/net/arp', 'r') as fh:
-        entries = fh.read().strip().split('\n')[1:]
-        entries = (re.split('\s+', e) for e in entries)
-        entries = [ARPEntry(*e) for e in entries]
-    return entries
-
-
-def get_mac_by_ip(ip_address):
-    for entry in load_arp_table():
-        if entry.ip == ip_address:
-            return entry.mac
+        next(fh)
+        for line in fh:
+            ip, _, flags, mac = line.split(None, 4)[:4]
+            if int(flags, 16) & ATF_COM:
+                neighbours[ip] = mac
+    return neighbours
+
+
+# rtnetlink constants (linux/netlink.h, linux/rtnetlink.h, linux/neighbour.h)
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+
+nlmsghdr = struct.Struct('=IHHII')
+ndmsg = struct.Struct('=BBHiHBB')
+rtattr = struct.Struct('=HH')
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _neighbour(message, offset, end):
+    family, _, _, _, state, _, _ = ndmsg.unpack_from(message, offset)
+    if state & (NUD_INCOMPLETE | NUD_FAILED | NUD_NOARP):
+        return None, None
+    ip, mac = None, None
+    offset += _align(ndmsg.size)
+    while offset + rtattr.size <= end:
+        length, type = rtattr.unpack_from(message, offset)
+        if length < rtattr.size:
+            break
+        value = message[offset + rtattr.size:offset + length]
+        if type == NDA_DST:
+            ip = socket.inet_ntoa(value)
+        elif type == NDA_LLADDR:
+            mac = ':'.join('{:02x}'.format(ord(c)) for c in value)
+        offset += _align(length)
+    return ip, mac
+
+
+def load_neighbours_netlink():
+    """
+    Returns the same mapping as load_neighbours, but dumps the neighbour
+    table of the kernel through an rtnetlink socket instead of having it
+    formatted as text.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        request = ndmsg.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0)
+        sock.send(nlmsghdr.pack(nlmsghdr.size + len(request), RTM_GETNEIGH,
+                                NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + request)
+        neighbours = {}
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + nlmsghdr.size <= len(data):
+                length, type, _, _, _ = nlmsghdr.unpack_from(data, offset)
+                if type == NLMSG_DONE:
+                    return neighbours
+                elif type == NLMSG_ERROR:
+                    raise socket.error('rtnetlink neighbour dump failed')
+                elif type == RTM_NEWNEIGH:
+                    ip, mac = _neighbour(data, offset + nlmsghdr.size,
+                                         offset + length)
+                    if ip is not None and mac is not None:
+                        neighbours[ip] = mac
+                offset += _align(length)
+    finally:
+        sock.close()
+
+
+class ARPCache(object):
+    """
+    Maps IP addresses to MAC addresses, reading the neighbour table of the
+    host at most once every min_refresh_interval seconds when an address
+    is missing, and anyway when the table is older than max_age seconds
+    (addresses can be reused by other instances).
+
+    The table is read from /proc/net/arp by default; pass
+    load_neighbours_netlink as loader to dump it through rtnetlink.
+    """
+
+    max_age = 5
+    min_refresh_interval = 0.2
+
+    def __init__(self, loader=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._loader = loader or load_neighbours
+        self._neighbours = {}
+        self._loaded = None
+
+    def refresh(self):
+        self._neighbours = self._loader()
+        self._loaded = self._reactor.seconds()
+
+    def get_mac(self, ip_address):
+        now = self._reactor.seconds()
+        age = None if self._loaded is None else now - self._loaded
+        if age is None or age >= self.max_age:
+            self.refresh()
+        elif (ip_address not in self._neighbours and
+                age >= self.min_refresh_interval):
+            self.refresh()
+        return self._neighbours.get(ip_address)
 
 
 class DomainResolver(object):
+    """
+    Maps the IP addresses of the instances to their libvirt domain, using
+    the ARP table of the host and the domain inventory of the hypervisor.
+    """
+
     class DomainNotFound(Exception):
         pass
 
-    def __init__(self, libvirt_endpoint):
-        self._libvirt_endpoint = libvirt_endpoint
-
-    @defer.inlineCallbacks
-    def _load_mac_addresses(self):
-        addresses = {}
-
-        def extract_macs(response, domain):
-            xml = etree.fromstring(response.xml)
-            macs = xml.iterfind("devices/interface/mac")
-            macs = [e.get('address') for e in macs]
-            for addr in macs:
-                addresses[addr] = domain
-
-        virt = yield self._libvirt_endpoint.connect()
-        res = yield virt.connect_list_all_domains(1, 0)
-        dl = []
-
-        for domain in res.domains:
-            d = virt.domain_get_xml_desc(domain, 0)
-            d.addCallback(extract_macs, domain)
-            dl.append(d)
-
-        yield defer.DeferredList(dl)
-        yield virt.connect_close()
-        self._mac_to_uuid = addresses
+    def __init__(self, inventory, arp_cache=None):
+        self._inventory = inventory
+        if arp_cache is None:
+            arp_cache = ARPCache()
+        self._arp = arp_cache
 
     @defer.inlineCallbacks
     def get_domain_by_ip(self, ip_address):
-        yield self._load_mac_addresses()
-        mac_address = get_mac_by_ip(ip_address)
-        try:
-            domain = self._mac_to_uuid[mac_address]
-        except KeyError:
+        mac_address = self._arp.get_mac(ip_address)
+        domain = None
+        if mac_address is not None:
+            domain = yield self._inventory.lookup(mac=mac_address)
+        if domain is None:
             logger.msg('domainresolver.notfound', mac=mac_address,
                        ip=ip_address)
             raise DomainResolver.DomainNotFound()
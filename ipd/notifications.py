@@ -0,0 +1,125 @@
+"""
+Delivery of the messages published on redis channels to callbacks, over a
+single subscriber connection shared by all the listeners of a process.
+"""
+
+from twisted.internet import defer, endpoints
+from twisted.internet.protocol import Factory
+from twisted.python import failure
+
+from txredis.client import RedisSubscriber
+
+from structlog import get_logger
+logger = get_logger()
+
+
+class NotificationsProtocol(RedisSubscriber):
+    def messageReceived(self, channel, message):
+        self.factory.notifications.message_received(channel, message)
+
+    def channelSubscribed(self, channel, subscriptions):
+        self.factory.notifications.channel_subscribed(channel)
+
+    def connectionLost(self, reason):
+        RedisSubscriber.connectionLost(self, reason)
+        self.factory.notifications.connection_lost(self, reason)
+
+
+class Notifications(object):
+    """
+    Calls the callbacks subscribed to a channel with each message published
+    on it. The connection is established on the first subscription and, if
+    lost, again on the next one, subscribing to all the channels which still
+    have listeners (messages published in between are lost).
+    """
+
+    def __init__(self, reactor, host, port):
+        self._endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port)
+        self._factory = Factory()
+        self._factory.protocol = NotificationsProtocol
+        self._factory.notifications = self
+        self._protocol = None
+        self._connecting = None
+        self._listeners = {}
+        self._subscribing = {}
+
+    def _connect(self):
+        if self._protocol is not None:
+            return defer.succeed(self._protocol)
+        if self._connecting is None:
+            self._connecting = []
+            d = self._endpoint.connect(self._factory)
+            d.addBoth(self._connected)
+        d = defer.Deferred()
+        self._connecting.append(d)
+        return d
+
+    def _connected(self, result):
+        waiters, self._connecting = self._connecting, None
+        if not isinstance(result, failure.Failure):
+            self._protocol = result
+            logger.msg('notifications.connected')
+            channels = [c for c in self._listeners if c not in
+                        self._subscribing]
+            if channels:
+                # Channels subscribed to before the connection was lost
+                result.subscribe(*channels)
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def connection_lost(self, protocol, reason):
+        if protocol is self._protocol:
+            logger.msg('notifications.connection_lost',
+                       error=reason.getErrorMessage())
+            self._protocol = None
+        subscribing, self._subscribing = self._subscribing, {}
+        for waiters in subscribing.itervalues():
+            for d in waiters:
+                d.errback(reason)
+
+    @defer.inlineCallbacks
+    def subscribe(self, channel, callback):
+        """
+        Calls callback with each message published on channel. Returns a
+        deferred fired once the server confirmed the subscription.
+        """
+        protocol = yield self._connect()
+        listeners = self._listeners.setdefault(channel, [])
+        listeners.append(callback)
+        if len(listeners) == 1 or channel in self._subscribing:
+            d = defer.Deferred()
+            if channel not in self._subscribing:
+                self._subscribing[channel] = []
+                protocol.subscribe(channel)
+            self._subscribing[channel].append(d)
+            try:
+                yield d
+            except Exception:
+                self.unsubscribe(channel, callback)
+                raise
+
+    def unsubscribe(self, channel, callback):
+        listeners = self._listeners.get(channel, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners:
+            self._listeners.pop(channel, None)
+            if self._protocol is not None:
+                self._protocol.unsubscribe(channel)
+
+    def channel_subscribed(self, channel):
+        for d in self._subscribing.pop(channel, []):
+            d.callback(None)
+
+    def message_received(self, channel, message):
+        for callback in list(self._listeners.get(channel, [])):
+            try:
+                callback(message)
+            except Exception:
+                reason = failure.Failure()
+                logger.msg('notifications.listener_failed', channel=channel,
+                           error=reason.getErrorMessage(),
+                           traceback=reason.getTraceback())
@@ -1,15 +1,14 @@
 from twisted.web.client import getPage
+import functools
 import yaml
 import time
-from lxml import etree
 from urlparse import urlparse, urlunparse
-from twisted.internet import defer, reactor
+from uuid import UUID
+from twisted.internet import defer
 from twisted.application import service
-from twisted.python.filepath import FilePath
-from ipd.utils import generate_password
+from twisted.python import failure
 from structlog import get_logger
-from ipd.libvirt import error
-from ipd import ssh
+from ipd.projects.pipeline import Pipeline, Stage
 
 logger = get_logger()
 
@@ -22,27 +21,31 @@ class StopBuildingSentinel(object):
     pass
 
 
-class DomainNotFound(Exception):
-    pass
-
-
 class Builder(service.Service, object):
-    def __init__(self, manager, hosts, redis_connector):
-        self._hosts = hosts
+    def __init__(self, manager, redis_connector, scheduler, launcher,
+                 warm_pool):
         self._manager = manager
         self._redis = redis_connector
-
-        self._hosts_queue = defer.DeferredQueue()
-        for h in hosts:
-            self._hosts_queue.put(h)
+        self._scheduler = scheduler
+        self._launcher = launcher
+        self._warm_pool = warm_pool
 
         self._stop_building = defer.Deferred()
         self._builds = defer.DeferredQueue()
+        # Builds queued or running
+        self._pending = set()
 
     def startService(self):
         logger.msg('builder.starting_service')
         super(Builder, self).startService()
+        for base_domain in self._launcher.templates.base_domains():
+            self._launcher.volumes.prewarm(base_domain)
         self.start_building()
+        d = self.resume_builds()
+        d.addErrback(self._resume_failed)
+
+    def _resume_failed(self, reason):
+        logger.msg('builder.resume_failed', error=reason.getErrorMessage())
 
     @defer.inlineCallbacks
     def stopService(self):
@@ -50,159 +53,181 @@ class Builder(service.Service, object):
         yield self.stop_building()
         yield super(Builder, self).stopService()
 
+    def _stages(self, build_id):
+        return [
+            Stage('instance', functools.partial(self._get_instance, build_id),
+                  persistent=False),
+            Stage('connect', functools.partial(self._connect, build_id),
+                  requires=['instance'], persistent=False),
+            Stage('workdir', self._create_workdir, requires=['connect']),
+            # - Git checkout
+            # - Exec install
+            # - Exec start
+            # - Start routing
+        ]
+
     @defer.inlineCallbacks
-    def start_build(self, build_id, host_key):
+    def start_build(self, build_id):
+        """
+        Runs the stages of the build which did not finish yet. The state of
+        the build holds the fields of its hash and, under names without
+        dots, the objects created by the stages (the instance and the ssh
+        connection).
+        """
         redis = yield self._redis()
-        build = yield redis.hgetall('build:{}'.format(build_id))
+        state = yield redis.hgetall('build:{}'.format(build_id))
+        start = time.time()
 
         logger.msg(
             'builder.build_started',
             build_id=build_id,
-            host=host_key,
-            project=build['project_key'],
-            commit=build['commit_id']
+            project=state['project_key'],
+            commit=state['commit_id'],
+            resumed=state['status'] == 'running',
         )
+        yield redis.hset('build:{}'.format(build_id), 'status', 'running')
 
-        start = time.time()
-
-        buildspec = yaml.load(build['buildspec'])
-
-        base_domain = buildspec['base_domain']
-
-        domain = FilePath('workdir/domains')
-        domain = domain.child('{}.xml'.format(base_domain))
-
-        volume = FilePath('workdir/volumes')
-        volume = volume.child('{}.xml'.format(base_domain))
-
-        if not domain.exists() or not volume.exists:
-            raise DomainNotFound(base_domain)
-
-        with domain.open() as fh:
-            tree = etree.parse(fh)
-
-        name = '{}-{}'.format(build['project_key'], build_id)
-        vnc_pass = generate_password(32)
-        tree.find('name').text = name
-        tree.find('devices/disk/source').attrib['volume'] = name
-        tree.find('devices/graphics').attrib['passwd'] = vnc_pass
-        domxml = etree.tostring(tree)
-
-        with volume.open() as fh:
-            tree = etree.parse(fh)
-
-        tree.find('name').text = name
-        volxml = etree.tostring(tree)
-
-        virt = yield self._hosts[host_key]()
-
-        # Create storage pool
+        pipeline = Pipeline(self._redis, build_id, self._stages(build_id))
         try:
-            res = yield virt.storage_pool_lookup_by_name('ipd-images')
-        except error.RemoteError:
-            with open('workdir/base-vm/pool.xml') as fh:
-                poolxml = fh.read()
-            res = yield virt.storage_pool_create_xml(poolxml, 0)
-        pool = res.pool
-
-        # Create base image
-        yield virt.storage_vol_create_xml(pool, volxml, 0)
-
-        # Create domain
-        res = yield virt.domain_create_xml(domxml, 0)
-
-        # Get information
-        res = yield virt.domain_get_xml_desc(res.dom, 0)
-        domxml = etree.fromstring(res.xml)
-
-        uuid = domxml.find('uuid').text
-        instancedata = {
-            'hypervisor': host_key,
-            'mac_address': domxml.find('devices/interface/mac').attrib['address'],
-            'vncport': domxml.find('devices/graphics').attrib['port'],
-            'vncpasswd': vnc_pass,
-        }
+            yield pipeline.run(state)
+        except Exception:
+            reason = failure.Failure()
+            yield self._finish(build_id, state, 'failed', start)
+            reason.raiseException()
+        yield self._finish(build_id, state, 'done', start)
 
+    @defer.inlineCallbacks
+    def _finish(self, build_id, state, status, start):
+        # The ssh connection is closed by the connection manager once idle
+        if 'instance' in state:
+            instance = state['instance']
+            if status == 'failed':
+                try:
+                    yield self._launcher.destroy(instance)
+                except Exception:
+                    reason = failure.Failure()
+                    logger.msg('builder.teardown_failed', build_id=build_id,
+                               instance=instance.name,
+                               error=reason.getErrorMessage())
+            self._scheduler.release(instance.placement)
         redis = yield self._redis()
-        key = 'instancedata:{}'.format(uuid)
-        redis.hmset(key, instancedata)
+        yield redis.hset('build:{}'.format(build_id), 'status', status)
+        yield redis.srem('builds:pending', build_id)
+        self._pending.discard(str(build_id))
+        logger.msg('builder.build_finished', build_id=build_id,
+                   status=status, duration=time.time() - start)
 
-        while True:
-            status = yield redis.hget(key, 'status')
-            if status and status['status'] == 'running':
-                break
-            d = defer.Deferred()
-            reactor.callLater(1, d.callback, None)
-            yield d
-
-        instance_data = yield redis.hgetall(key)
-
-        duration = time.time() - start
-        print 'Startup duration: {:.1f} seconds'.format(duration)
-
-        ##########
-
-        # Connect ssh
-        known_hosts = ssh.KnownHostsLists([
-            (instance_data['ip_address'], ssh.Key.fromString(instance_data['pub_key_rsa']))
-        ])
-        point = ssh.MultipleCommandsClientEndpoint.newConnection(
-            reactor, 'ubuntu', instance_data['ip_address'],
-            keys=[self._manager._key], knownHosts=known_hosts)
-
-        factory = ssh.MultipleCommandsFactory()
-        proto = yield point.connect(factory)
+    @defer.inlineCallbacks
+    def _get_instance(self, build_id, state):
+        base_domain = yaml.load(state['buildspec'])['base_domain']
+
+        instance = None
+        if 'instance.uuid' in state:
+            # Resume the build on the instance it already booted
+            instance = yield self._resume_instance(state, base_domain)
+        if instance is None:
+            instance = self._warm_pool.take(base_domain)
+        if instance is None:
+            vcpus, memory = self._launcher.requirements(base_domain)
+            placement = yield self._scheduler.place(vcpus, memory)
+            name = '{}-{}'.format(state['project_key'], build_id)
+            try:
+                instance = yield self._launcher.boot(placement, base_domain,
+                                                     name)
+            except Exception:
+                self._scheduler.release(placement)
+                raise
+            self._scheduler.started(placement)
+
+        state['instance'] = instance
+        defer.returnValue({
+            'instance.name': instance.name,
+            'instance.host': instance.host,
+            'instance.uuid': UUID(bytes=instance.uuid).hex,
+        })
 
-        out = yield proto.exec_command('uname -a')
-        print out
+    @defer.inlineCallbacks
+    def _resume_instance(self, state, base_domain):
+        host = state['instance.host']
+        if host not in self._scheduler.hosts:
+            return
+        vcpus, memory = self._launcher.requirements(base_domain)
+        placement = yield self._scheduler.place(vcpus, memory, host)
+        try:
+            instance = yield self._launcher.resume(
+                placement, base_domain, state['instance.name'],
+                UUID(state['instance.uuid']).bytes)
+        except Exception:
+            self._scheduler.release(placement)
+            raise
+        if instance is None:
+            self._scheduler.release(placement)
+        else:
+            self._scheduler.started(placement)
+        defer.returnValue(instance)
 
-        print 'Instance {} is ready'.format(name)
-        print ' - IP address: {}'.format(instance_data['ip_address'])
-        print ' - VNC host: {}'.format(instance_data['hypervisor'])
-        print ' - VNC port: {}'.format(instance_data['vncport'])
-        print ' - VNC pass: {}'.format(instance_data['vncpasswd'])
+    @defer.inlineCallbacks
+    def _connect(self, build_id, state):
+        instance = state['instance']
+        instance_data = instance.data
 
-        duration = time.time() - start
-        print 'Connect duration: {:.1f} seconds'.format(duration)
+        # Warm instances are usually connected already
+        state['ssh'] = yield self._launcher.connect(instance)
 
-        yield proto.exec_command('mkdir -p /srv')
+        out = yield state['ssh'].exec_command('uname -a')
 
-        duration = time.time() - start
-        print 'Build duration: {:.1f} seconds'.format(duration)
-        yield proto.disconnect()
-        # Basic setup
-        # - Dir creation
-        # - Git checkout
-        # - Directory change
+        logger.msg(
+            'builder.instance_ready',
+            build_id=build_id,
+            instance=instance.name,
+            ip_address=instance_data['ip_address'],
+            vnc_host=instance_data['hypervisor'],
+            vnc_port=instance_data['vncport'],
+            uname=out.strip(),
+        )
 
-        # Exec install
-        # Exec start
-        # Start routing
+    def _create_workdir(self, state):
+        d = state['ssh'].exec_command('mkdir -p /srv')
+        d.addCallback(lambda _: None)
+        return d
 
     @defer.inlineCallbacks
     def start_building(self):
-        def free_item(res, queue, item):
-            queue.put(item)
-            return res
-
         while True:
-            # Wait for the next free host
-            host_key = yield self._hosts_queue.get()
-            if isinstance(host_key, StopBuildingSentinel):
-                break
-
-            # Wait for a build
+            # Wait for a build, the scheduler limits how many of them run
+            # concurrently on each host
             build_id = yield self._builds.get()
             if isinstance(build_id, StopBuildingSentinel):
                 break
 
-            d = self.start_build(build_id, host_key)
-            d.addBoth(free_item, self._hosts_queue, host_key)
+            d = self.start_build(build_id)
+            d.addErrback(self._build_failed, build_id)
 
         self._stop_building.callback(None)
 
+    def _build_failed(self, reason, build_id):
+        logger.msg('builder.build_failed', build_id=build_id,
+                   error=reason.getErrorMessage(),
+                   traceback=reason.getTraceback())
+
+    def _enqueue(self, build_id):
+        if str(build_id) not in self._pending:
+            self._pending.add(str(build_id))
+            self._builds.put(build_id)
+
+    @defer.inlineCallbacks
+    def resume_builds(self):
+        """
+        Queues again the builds which did not finish before the last
+        shutdown.
+        """
+        redis = yield self._redis()
+        pending = yield redis.smembers('builds:pending')
+        for build_id in sorted(pending, key=int):
+            self._enqueue(build_id)
+        logger.msg('builder.builds_resumed', builds=len(pending))
+
     def stop_building(self):
-        self._hosts_queue.put(StopBuildingSentinel())
         self._builds.put(StopBuildingSentinel())
         return self._stop_building
 
@@ -224,7 +249,9 @@ class Builder(service.Service, object):
             'commit_id': commit_id,
         })
 
-        self._builds.put(build_id)
+        self._launcher.volumes.prewarm(buildspec['base_domain'])
+        yield redis.sadd('builds:pending', build_id)
+        self._enqueue(build_id)
         defer.returnValue('{}-{}'.format(project_key, build_id))
 
     @defer.inlineCallbacks
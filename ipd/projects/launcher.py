@@ -0,0 +1,164 @@
+"""
+Creation of instances of base domains, up to the moment they phone home.
+"""
+
+from collections import namedtuple
+from uuid import UUID
+
+from twisted.internet import defer, reactor
+
+from ipd import ssh
+from ipd.libvirt import remote
+from ipd.utils import generate_password, timeout
+
+from structlog import get_logger
+logger = get_logger()
+
+
+class BootTimeout(Exception):
+    pass
+
+
+Instance = namedtuple('Instance', [
+    'name', 'base_domain', 'host', 'uuid', 'placement', 'data',
+])
+
+
+class InstanceLauncher(object):
+    """
+    Boots instances of the base domains of the template cache, on the host
+    of a placement obtained from the scheduler.
+    """
+
+    # Maximum time for an instance to phone home once created
+    boot_timeout = 300
+    # User the commands are run as on the instances
+    ssh_user = 'ubuntu'
+
+    def __init__(self, hosts, redis_connector, notifications, volumes,
+                 templates, connections, key):
+        self._hosts = hosts
+        self._redis = redis_connector
+        self._notifications = notifications
+        self.volumes = volumes
+        self.templates = templates
+        self._connections = connections
+        self._key = key
+
+    def requirements(self, base_domain):
+        """
+        Returns the number of virtual CPUs and the memory (in KiB) of an
+        instance of base_domain.
+        """
+        template = self.templates.domain(base_domain)
+        return template.vcpus, template.memory
+
+    @defer.inlineCallbacks
+    def boot(self, placement, base_domain, name):
+        """
+        Creates the domain name from base_domain on the host of placement
+        and waits for it to phone home. Returns a deferred fired with the
+        Instance.
+        """
+        host = placement.host
+        vnc_pass = generate_password(32)
+        # The volume is a qcow2 overlay of the golden volume of the base
+        domxml = self.templates.domain(base_domain).template.render(
+            name=name, volume=name, passwd=vnc_pass, driver='qcow2')
+
+        # Create the volume and the domain
+        inventory = self._hosts[host]
+        yield self.volumes.provision(host, base_domain, name)
+        res = yield inventory.pool.run(
+            lambda virt: virt.domain_create_xml(domxml, 0))
+
+        # Get information
+        record = yield inventory.update_domain(res.dom)
+
+        uuid = str(UUID(bytes=record.uuid))
+        instancedata = {
+            'hypervisor': host,
+            'mac_address': record.macs[0],
+            'vncport': record.vnc_port,
+            'vncpasswd': vnc_pass,
+        }
+
+        redis = yield self._redis()
+        key = 'instancedata:{}'.format(uuid)
+        yield redis.hmset(key, instancedata)
+
+        yield self._wait_running(redis, key)
+
+        data = yield redis.hgetall(key)
+        defer.returnValue(Instance(name, base_domain, host, record.uuid,
+                                   placement, data))
+
+    @defer.inlineCallbacks
+    def resume(self, placement, base_domain, name, uuid):
+        """
+        Returns a deferred fired with the Instance of the domain with the
+        given (raw) uuid, booted earlier on the host of placement, or with
+        None if it is not running anymore.
+        """
+        record = yield self._hosts[placement.host].lookup(uuid=uuid)
+        if record is None or record.state != 'running':
+            defer.returnValue(None)
+        redis = yield self._redis()
+        data = yield redis.hgetall('instancedata:{}'.format(UUID(bytes=uuid)))
+        if data.get('status') != 'running':
+            defer.returnValue(None)
+        defer.returnValue(Instance(name, base_domain, placement.host, uuid,
+                                   placement, data))
+
+    @defer.inlineCallbacks
+    def _wait_running(self, redis, key):
+        """
+        Waits for the instance whose data is stored at key to report itself
+        as running, which is announced on the channel of the same name.
+        """
+        running = defer.Deferred()
+
+        def status_changed(status):
+            if status == 'running' and not running.called:
+                running.callback(None)
+
+        yield self._notifications.subscribe(key, status_changed)
+        try:
+            # The instance may have phoned home before the subscription
+            status = yield redis.hget(key, 'status')
+            if not status or status['status'] != 'running':
+                yield timeout(reactor, running, self.boot_timeout)
+        except defer.CancelledError:
+            raise BootTimeout(key)
+        finally:
+            self._notifications.unsubscribe(key, status_changed)
+
+    def connect(self, instance):
+        """
+        Returns a deferred fired with an SSH connection to instance, shared
+        with the other users of the instance.
+        """
+        return self._connections.connect(
+            instance.data['ip_address'], self.ssh_user, self._key,
+            ssh.Key.fromString(instance.data['pub_key_rsa']))
+
+    def is_running(self, instance):
+        """
+        Tells if the domain of instance is still known to be running.
+        """
+        record = self._hosts[instance.host].get(instance.uuid)
+        return record is not None and record.state == 'running'
+
+    @defer.inlineCallbacks
+    def destroy(self, instance):
+        """
+        Destroys the domain of instance and deletes its volume.
+        """
+        inventory = self._hosts[instance.host]
+        record = inventory.get(instance.uuid)
+        if record is not None:
+            domain = remote.nonnull_domain.model(record.name, record.uuid,
+                                                 record.id)
+            yield inventory.pool.run(
+                lambda virt: virt.domain_destroy(domain))
+        yield self.volumes.delete(instance.host, instance.name)
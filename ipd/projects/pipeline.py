@@ -0,0 +1,98 @@
+"""
+Execution of builds as a pipeline of stages whose progress is persisted in
+the redis hash of the build.
+"""
+
+from collections import namedtuple
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from structlog import get_logger
+logger = get_logger()
+
+
+class Stage(namedtuple('Stage', ['name', 'func', 'requires', 'persistent'])):
+    """
+    A step of a pipeline. func is called with the state of the build once
+    all the stages named in requires finished, and returns (possibly through
+    a deferred) a dict of values to store in the state and in the hash of
+    the build, or None.
+
+    Persistent stages are skipped when resuming a build in which they
+    already finished; the others run again, and can use the values stored
+    by their previous run to resume their work.
+    """
+
+    def __new__(cls, name, func, requires=(), persistent=True):
+        return super(Stage, cls).__new__(cls, name, func, tuple(requires),
+                                         persistent)
+
+
+class Pipeline(object):
+    """
+    Runs stages as soon as the stages they require finished, concurrently
+    if they do not depend on each other. The stages have to be given after
+    the ones they require.
+
+    The time each stage took is logged and stored in the hash of the build
+    as stage.<name>.
+    """
+
+    def __init__(self, redis_connector, build_id, stages, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._redis = redis_connector
+        self.build_id = build_id
+        self.key = 'build:{}'.format(build_id)
+        self.stages = stages
+
+    @defer.inlineCallbacks
+    def run(self, state):
+        """
+        Runs the pipeline with the given state, which is updated by the
+        stages. Returns a deferred fired once all the stages finished, or
+        failing with the failure of the first failed stage.
+        """
+        started = {}
+        for stage in self.stages:
+            requires = [started[name] for name in stage.requires]
+            d = defer.gatherResults(requires, consumeErrors=True)
+            d.addCallback(self._run_stage, stage, state)
+            started[stage.name] = d
+        try:
+            yield defer.gatherResults(started.values(), consumeErrors=True)
+        except defer.FirstError as e:
+            # Report the failure of the stage itself
+            while isinstance(e.subFailure.value, defer.FirstError):
+                e = e.subFailure.value
+            e.subFailure.raiseException()
+
+    @defer.inlineCallbacks
+    def _run_stage(self, _, stage, state):
+        field = 'stage.{}'.format(stage.name)
+        if stage.persistent and field in state:
+            logger.msg('build.stage_skipped', build_id=self.build_id,
+                       stage=stage.name)
+            return
+
+        start = self._reactor.seconds()
+        try:
+            values = yield stage.func(state)
+        except Exception:
+            reason = failure.Failure()
+            logger.msg('build.stage_failed', build_id=self.build_id,
+                       stage=stage.name,
+                       duration=self._reactor.seconds() - start,
+                       error=reason.getErrorMessage())
+            reason.raiseException()
+        duration = self._reactor.seconds() - start
+
+        values = dict(values or {})
+        values[field] = '{:.3f}'.format(duration)
+        state.update(values)
+        redis = yield self._redis()
+        yield redis.hmset(self.key, values)
+        logger.msg('build.stage_finished', build_id=self.build_id,
+                   stage=stage.name, duration=duration)
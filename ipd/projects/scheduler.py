@@ -0,0 +1,249 @@
+"""
+Placement of builds on the hypervisors, according to their capacity.
+"""
+
+from collections import namedtuple
+
+from twisted.application import service
+from twisted.internet import defer, task
+
+from structlog import get_logger
+logger = get_logger()
+
+
+Placement = namedtuple('Placement', ['host', 'vcpus', 'memory'])
+
+
+# Multipliers of the units of the memory element of domains, to KiB
+MEMORY_UNITS = {
+    'b': 1.0 / 1024, 'bytes': 1.0 / 1024,
+    'kb': 1000.0 / 1024, 'k': 1, 'kib': 1,
+    'mb': 1000.0 ** 2 / 1024, 'm': 1024, 'mib': 1024,
+    'gb': 1000.0 ** 3 / 1024, 'g': 1024 ** 2, 'gib': 1024 ** 2,
+    'tb': 1000.0 ** 4 / 1024, 't': 1024 ** 3, 'tib': 1024 ** 3,
+}
+
+
+def domain_requirements(tree):
+    """
+    Returns the number of virtual CPUs and the memory (in KiB) of the
+    domain described by the given tree.
+    """
+    vcpus = int(tree.findtext('vcpu', '1'))
+    memory = tree.find('memory')
+    unit = MEMORY_UNITS[memory.get('unit', 'KiB').lower()]
+    return vcpus, int(int(memory.text) * unit)
+
+
+class Host(object):
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.cpus = None
+        self.memory = None
+        # Memory available for new domains (free and cache), in KiB
+        self.available_memory = None
+        self.builds = []
+        # [placement, refresh] pairs of the builds whose domain was not
+        # running yet when available_memory was measured; refresh is the
+        # number of refreshes started before the domain was (None while it
+        # is booting)
+        self._unseen = []
+        self._refreshes = 0
+
+    @property
+    def known(self):
+        return self.cpus is not None
+
+    @property
+    def reserved_vcpus(self):
+        return sum(p.vcpus for p in self.builds)
+
+    @property
+    def unseen_memory(self):
+        """
+        Memory of the builds not accounted for in available_memory yet.
+        """
+        return sum(p.memory for p, _ in self._unseen)
+
+    def free_memory(self, reserve):
+        return self.available_memory - self.unseen_memory - reserve
+
+    def place(self, placement):
+        self.builds.append(placement)
+        self._unseen.append([placement, None])
+
+    def started(self, placement):
+        for entry in self._unseen:
+            if entry[0] is placement:
+                entry[1] = self._refreshes
+
+    def release(self, placement):
+        self.builds.remove(placement)
+        self._unseen = [e for e in self._unseen if e[0] is not placement]
+
+    def fits(self, vcpus, memory, cpu_overcommit, memory_reserve):
+        if not self.known:
+            return False
+        return (self.reserved_vcpus + vcpus <= self.cpus * cpu_overcommit and
+                memory <= self.free_memory(memory_reserve))
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        self._refreshes += 1
+        refresh = self._refreshes
+        virt = yield self.pool.acquire()
+        try:
+            info = yield virt.node_get_info()
+            # Ask for the number of parameters first
+            res = yield virt.node_get_memory_stats(0, -1, 0)
+            res = yield virt.node_get_memory_stats(res.nparams, -1, 0)
+        finally:
+            self.pool.release(virt)
+        stats = {p.field: p.value for p in res.params}
+        self.cpus = info.cpus
+        self.memory = info.memory
+        self.available_memory = sum(stats.get(f, 0) for f in
+                                    ('free', 'buffers', 'cached'))
+        # Forget about the domains which were running before the refresh
+        self._unseen = [e for e in self._unseen
+                        if e[1] is None or e[1] >= refresh]
+
+
+class BuildScheduler(service.Service, object):
+    """
+    Places builds on the least loaded host with enough capacity left,
+    queueing them (in order, but letting smaller builds pass) until one
+    has.
+
+    A host has enough capacity for a build if the virtual CPUs of the
+    builds running on it stay below cpu_overcommit times its CPUs, and if
+    its available memory, minus memory_reserve and the memory of the builds
+    whose domain was not running yet when it was measured, is enough for
+    the domain. The capacity of the hosts is refreshed every
+    refresh_interval seconds and after each build.
+    """
+
+    refresh_interval = 60
+    cpu_overcommit = 2
+    # Memory left to the hypervisor itself (KiB)
+    memory_reserve = 1024 * 1024
+
+    def __init__(self, hosts, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.hosts = {name: Host(name, pool) for name, pool in hosts.items()}
+        self._queue = []
+        self._refresher = task.LoopingCall(self.refresh)
+        self._refresher.clock = reactor
+        self.placed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def startService(self):
+        super(BuildScheduler, self).startService()
+        self._refresher.start(self.refresh_interval, now=True)
+
+    def stopService(self):
+        super(BuildScheduler, self).stopService()
+        if self._refresher.running:
+            self._refresher.stop()
+
+    def refresh(self):
+        return defer.DeferredList([self._refresh_host(h)
+                                   for h in self.hosts.itervalues()])
+
+    def _refresh_host(self, host):
+        d = host.refresh()
+        d.addCallbacks(self._refreshed, self._refresh_failed,
+                       callbackArgs=(host,), errbackArgs=(host,))
+        return d
+
+    def _refreshed(self, _, host):
+        logger.msg('scheduler.host_refreshed', host=host.name,
+                   cpus=host.cpus, memory=host.memory,
+                   available_memory=host.available_memory)
+        self._dispatch()
+
+    def _refresh_failed(self, reason, host):
+        logger.msg('scheduler.host_refresh_failed', host=host.name,
+                   error=reason.getErrorMessage())
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def place(self, vcpus, memory, host=None):
+        """
+        Returns a deferred fired with the Placement of a build needing the
+        given number of virtual CPUs and amount of memory (in KiB), once a
+        host (or the given one) can take it. The placement has to be
+        released once the build finished.
+        """
+        d = defer.Deferred(self._cancel)
+        self._queue.append((d, vcpus, memory, host,
+                            self._reactor.seconds()))
+        self._dispatch()
+        if not d.called:
+            logger.msg('scheduler.queued', vcpus=vcpus, memory=memory,
+                       queued=self.queued)
+        return d
+
+    def _cancel(self, d):
+        self._queue = [entry for entry in self._queue if entry[0] is not d]
+
+    def started(self, placement):
+        """
+        Tells that the domain of placement is running, so that its memory
+        is included in the available memory from the next refresh of its
+        host on.
+        """
+        self.hosts[placement.host].started(placement)
+
+    def release(self, placement):
+        host = self.hosts[placement.host]
+        host.release(placement)
+        self._refresh_host(host)
+
+    def _select(self, vcpus, memory, name=None):
+        hosts = [self.hosts[name]] if name else self.hosts.values()
+        hosts = [h for h in hosts if h.fits(
+            vcpus, memory, self.cpu_overcommit, self.memory_reserve)]
+        if hosts:
+            return max(hosts, key=lambda h: (
+                h.free_memory(self.memory_reserve) / float(h.memory),
+                -h.reserved_vcpus / float(h.cpus)))
+
+    def _dispatch(self):
+        queue, self._queue = self._queue, []
+        placed = []
+        for entry in queue:
+            d, vcpus, memory, name, requested = entry
+            host = self._select(vcpus, memory, name)
+            if host is None:
+                self._queue.append(entry)
+                continue
+            placement = Placement(host.name, vcpus, memory)
+            host.place(placement)
+            latency = self._reactor.seconds() - requested
+            self.placed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            logger.msg('scheduler.placed', host=host.name, vcpus=vcpus,
+                       memory=memory, latency=latency,
+                       builds=len(host.builds), queued=len(self._queue))
+            placed.append((d, placement))
+        for d, placement in placed:
+            d.callback(placement)
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'builds': {h.name: len(h.builds)
+                       for h in self.hosts.itervalues()},
+            'placed': self.placed,
+            'mean_latency': self.total_latency / self.placed
+            if self.placed else 0.0,
+            'max_latency': self.max_latency,
+        }
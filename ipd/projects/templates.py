@@ -0,0 +1,174 @@
+"""
+Cache of the domain and volume templates of the base domains, rendered for
+each instance by filling slots in their serialized form.
+"""
+
+import hashlib
+import os
+import re
+from collections import namedtuple
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+from lxml import etree
+from twisted.python.filepath import FilePath
+
+from ipd.projects.scheduler import domain_requirements
+
+from structlog import get_logger
+logger = get_logger()
+
+
+class DomainNotFound(Exception):
+    pass
+
+
+class InvalidTemplate(Exception):
+    pass
+
+
+class Template(object):
+    """
+    An XML document serialized once, in which the values of the slots
+    (keyword arguments mapping names to the path of an element and the name
+    of an attribute, or None for its text) are replaced by the values given
+    to render. Slots whose element is missing are ignored, and slots without
+    a value keep the value of the document.
+    """
+
+    def __init__(self, tree, **slots):
+        tree = etree.fromstring(etree.tostring(tree))
+        marker = uuid4().hex
+        self._defaults = {}
+        for name, (path, attribute) in slots.items():
+            element = tree.find(path)
+            if element is None:
+                continue
+            token = '{}-{}-'.format(marker, name)
+            if attribute is None:
+                self._defaults[name] = element.text or ''
+                element.text = token
+            else:
+                self._defaults[name] = element.get(attribute, '')
+                element.set(attribute, token)
+        # Literal parts alternate with the names of the slots
+        self._parts = re.split('{}-(\\w+?)-'.format(marker),
+                               etree.tostring(tree))
+
+    def render(self, **values):
+        parts = list(self._parts)
+        for i in range(1, len(parts), 2):
+            value = values.get(parts[i])
+            if value is None:
+                value = self._defaults[parts[i]]
+            parts[i] = escape(value, {'"': '&quot;'})
+        return ''.join(parts)
+
+
+DomainTemplate = namedtuple('DomainTemplate', [
+    'template', 'vcpus', 'memory',
+])
+
+VolumeTemplate = namedtuple('VolumeTemplate', [
+    'template', 'digest', 'format', 'capacity',
+])
+
+
+class TemplateCache(object):
+    """
+    Loads the templates of the base domains from workdir/domains and
+    workdir/volumes when first used, and again when their file changed. The
+    files are checked at most once every check_interval seconds.
+    """
+
+    check_interval = 2
+
+    parser = etree.XMLParser(remove_blank_text=True)
+
+    def __init__(self, workdir=FilePath('workdir'), reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._domains = workdir.child('domains')
+        self._volumes = workdir.child('volumes')
+        # Loaded templates by path, with the stat of the file and the time
+        # it was checked at
+        self._entries = {}
+
+    def base_domains(self):
+        """
+        Returns the names of the base domains having both a domain and a
+        volume template.
+        """
+        names = [t.basename()[:-len('.xml')]
+                 for t in self._volumes.globChildren('*.xml')]
+        return [n for n in names
+                if self._domains.child('{}.xml'.format(n)).exists()]
+
+    def domain(self, base_domain):
+        """
+        Returns the DomainTemplate of base_domain, whose template has the
+        name, volume, passwd (of VNC) and driver (of the disk) slots. A
+        driver element is added to the disk if it has none, so that the
+        format of its volume can always be given.
+        """
+        return self._get(self._domains, base_domain, self._load_domain)
+
+    def volume(self, base_domain):
+        """
+        Returns the VolumeTemplate of base_domain, whose template has the
+        name slot.
+        """
+        return self._get(self._volumes, base_domain, self._load_volume)
+
+    def _get(self, directory, base_domain, load):
+        path = directory.child('{}.xml'.format(base_domain)).path
+        now = self._reactor.seconds()
+        entry = self._entries.get(path)
+        if entry is not None and now - entry[1] < self.check_interval:
+            return entry[2]
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._entries.pop(path, None)
+            raise DomainNotFound(base_domain)
+        stat = stat.st_mtime, stat.st_size
+        if entry is None or entry[0] != stat:
+            with open(path) as fh:
+                value = load(fh.read())
+            logger.msg('templates.loaded', path=path)
+        else:
+            value = entry[2]
+        self._entries[path] = stat, now, value
+        return value
+
+    def _load_domain(self, xml):
+        tree = etree.fromstring(xml, self.parser)
+        vcpus, memory = domain_requirements(tree)
+        disk = tree.find('devices/disk')
+        if disk is None:
+            raise InvalidTemplate('domain {} has no disk'.format(
+                tree.findtext('name')))
+        if disk.find('driver') is None:
+            etree.SubElement(disk, 'driver', name='qemu', type='raw')
+        template = Template(
+            tree,
+            name=('name', None),
+            volume=('devices/disk/source', 'volume'),
+            passwd=('devices/graphics', 'passwd'),
+            driver=('devices/disk/driver', 'type'),
+        )
+        return DomainTemplate(template, vcpus, memory)
+
+    def _load_volume(self, xml):
+        tree = etree.fromstring(xml, self.parser)
+        fmt = tree.find('target/format')
+        fmt = 'raw' if fmt is None else fmt.get('type', 'raw')
+        capacity = tree.find('capacity')
+        if capacity is None:
+            raise InvalidTemplate('volume {} has no capacity'.format(
+                tree.findtext('name')))
+        capacity = etree.tostring(capacity)
+        return VolumeTemplate(Template(tree, name=('name', None)),
+                              hashlib.sha1(xml).hexdigest()[:12], fmt,
+                              capacity)
@@ -0,0 +1,153 @@
+"""
+Provisioning of the disks of the build domains as copy-on-write overlays
+of golden volumes.
+"""
+
+from collections import namedtuple
+
+from lxml import etree
+from twisted.internet import defer
+from twisted.python.filepath import FilePath
+
+from ipd.libvirt import constants, error
+from ipd.projects.templates import Template
+from ipd.utils import DeferredCache
+
+from structlog import get_logger
+logger = get_logger()
+
+
+POOL_NAME = 'ipd-images'
+
+# Errors telling that a pool cannot create overlays
+UNSUPPORTED_ERRORS = frozenset([
+    constants.ERR_NO_SUPPORT,
+    constants.ERR_CONFIG_UNSUPPORTED,
+    constants.ERR_ARGUMENT_UNSUPPORTED,
+    constants.ERR_OPERATION_UNSUPPORTED,
+])
+
+
+# The overlay and clone templates render the volumes of the instances
+Golden = namedtuple('Golden', ['vol', 'path', 'overlay', 'clone'])
+
+
+class VolumeProvisioner(object):
+    """
+    Creates the volume of each build as a qcow2 overlay backed by the golden
+    volume of its base domain, so that only the blocks written by the
+    instance are allocated.
+
+    The golden volume of a base domain is created from its volume template
+    once per host, and named after the digest of the template, so that
+    changing the template creates a new one. Known golden volumes are cached
+    for golden_ttl seconds, after which their existence is checked again.
+
+    Pools which do not support backing files (or qcow2 volumes) get a full
+    clone of the golden volume instead; other errors are not retried.
+    """
+
+    golden_ttl = 600
+
+    def __init__(self, hosts, templates, workdir=FilePath('workdir'),
+                 reactor=None):
+        self._hosts = hosts
+        self._templates = templates
+        self._pool_xml = workdir.child('base-vm').child('pool.xml')
+        self._golden = DeferredCache(ttl=self.golden_ttl, reactor=reactor)
+
+    def golden(self, host, base_domain):
+        """
+        Returns a deferred fired with the Golden volume of base_domain on
+        host, creating it if it does not exist yet.
+        """
+        template = self._templates.volume(base_domain)
+        name = 'ipd-golden-{}-{}'.format(base_domain, template.digest)
+        return self._golden.get((host, name), self._hosts[host].run,
+                                self._ensure_golden, name, template)
+
+    def prewarm(self, base_domain, hosts=None):
+        """
+        Creates the golden volume of base_domain on the given hosts (all of
+        them by default) in the background.
+        """
+        if hosts is None:
+            hosts = self._hosts.keys()
+        dl = []
+        for host in hosts:
+            d = defer.maybeDeferred(self.golden, host, base_domain)
+            d.addErrback(self._prewarm_failed, host, base_domain)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def _prewarm_failed(self, reason, host, base_domain):
+        logger.msg('volumes.prewarm_failed', host=host,
+                   base_domain=base_domain, error=reason.getErrorMessage())
+
+    @defer.inlineCallbacks
+    def _storage_pool(self, virt):
+        try:
+            res = yield virt.storage_pool_lookup_by_name(POOL_NAME)
+        except error.RemoteError:
+            with self._pool_xml.open() as fh:
+                res = yield virt.storage_pool_create_xml(fh.read(), 0)
+        defer.returnValue(res.pool)
+
+    @defer.inlineCallbacks
+    def _ensure_golden(self, virt, name, template):
+        pool = yield self._storage_pool(virt)
+        try:
+            res = yield virt.storage_vol_lookup_by_name(pool, name)
+        except error.RemoteError:
+            logger.msg('volumes.creating_golden', volume=name)
+            res = yield virt.storage_vol_create_xml(
+                pool, template.template.render(name=name), 0)
+            logger.msg('volumes.golden_created', volume=name)
+        vol = res.vol
+        res = yield virt.storage_vol_get_path(vol)
+
+        volume = etree.Element('volume')
+        etree.SubElement(volume, 'name')
+        volume.append(etree.fromstring(template.capacity))
+        target = etree.SubElement(volume, 'target')
+        etree.SubElement(target, 'format', type='qcow2')
+        clone = Template(volume, name=('name', None))
+        backing = etree.SubElement(volume, 'backingStore')
+        etree.SubElement(backing, 'path').text = res.name
+        etree.SubElement(backing, 'format', type=template.format)
+        overlay = Template(volume, name=('name', None))
+        defer.returnValue(Golden(vol, res.name, overlay, clone))
+
+    @defer.inlineCallbacks
+    def provision(self, host, base_domain, name):
+        """
+        Creates the qcow2 volume name, for a domain of base_domain, on host.
+        """
+        golden = yield self.golden(host, base_domain)
+        yield self._hosts[host].run(self._create_overlay, golden, name)
+
+    @defer.inlineCallbacks
+    def _create_overlay(self, virt, golden, name):
+        pool = yield self._storage_pool(virt)
+        try:
+            yield virt.storage_vol_create_xml(
+                pool, golden.overlay.render(name=name), 0)
+        except error.RemoteError as e:
+            if e.code not in UNSUPPORTED_ERRORS:
+                raise
+            logger.msg('volumes.overlay_unsupported', volume=name,
+                       error=str(e))
+            yield virt.storage_vol_create_xml_from(
+                pool, golden.clone.render(name=name), golden.vol, 0)
+
+    def delete(self, host, name):
+        """
+        Deletes the volume name (but not golden volumes) on host.
+        """
+        @defer.inlineCallbacks
+        def delete(virt):
+            pool = yield self._storage_pool(virt)
+            res = yield virt.storage_vol_lookup_by_name(pool, name)
+            yield virt.storage_vol_delete(res.vol, 0)
+
+        return self._hosts[host].run(delete)
@@ -0,0 +1,163 @@
+"""
+Pool of booted instances, ready to be handed to builds.
+"""
+
+from uuid import uuid4
+
+from twisted.application import service
+from twisted.internet import defer, task
+
+from structlog import get_logger
+logger = get_logger()
+
+
+class WarmPool(service.Service, object):
+    """
+    Keeps size booted (and phoned home) instances of each of the given base
+    domains on every host, so that builds do not have to wait for their
+    instance to boot.
+
+    Taken instances are replaced in the background, booting at most
+    max_booting instances at a time; missing instances (e.g. after failed
+    boots) are booted again every replenish_interval seconds. Warm
+    instances hold their placement on the scheduler, which is handed over
+    to the build taking them, as well as their SSH connection, which is
+    opened as soon as they are ready. Idle instances are destroyed when the
+    service stops.
+    """
+
+    size = 1
+    max_booting = 2
+    replenish_interval = 60
+
+    def __init__(self, launcher, scheduler, base_domains, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._launcher = launcher
+        self._scheduler = scheduler
+        self.base_domains = base_domains
+        # Idle instances and number of instances booting by base domain and
+        # host
+        self._idle = {}
+        self._booting = {}
+        self._semaphore = defer.DeferredSemaphore(self.max_booting)
+        self._replenisher = task.LoopingCall(self.replenish_all)
+        self._replenisher.clock = reactor
+        self.hits = 0
+        self.misses = 0
+
+    def startService(self):
+        super(WarmPool, self).startService()
+        self._replenisher.start(self.replenish_interval, now=True)
+
+    def stopService(self):
+        super(WarmPool, self).stopService()
+        if self._replenisher.running:
+            self._replenisher.stop()
+        idle = [i for instances in self._idle.itervalues() for i in instances]
+        self._idle.clear()
+        return defer.DeferredList([self._discard(i) for i in idle])
+
+    def replenish_all(self):
+        for base_domain in self.base_domains:
+            for host in self._scheduler.hosts:
+                self.replenish(base_domain, host)
+        # Keep the connections to the idle instances from being evicted
+        for instances in self._idle.itervalues():
+            for instance in instances:
+                self._connect(instance)
+
+    def replenish(self, base_domain, host):
+        """
+        Starts booting the instances missing in the pool of base_domain on
+        host.
+        """
+        key = base_domain, host
+        missing = (self.size - len(self._idle.get(key, [])) -
+                   self._booting.get(key, 0))
+        for _ in range(missing):
+            self._booting[key] = self._booting.get(key, 0) + 1
+            d = self._boot(base_domain, host)
+            d.addCallbacks(self._booted, self._boot_failed,
+                           errbackArgs=(key,))
+
+    @defer.inlineCallbacks
+    def _boot(self, base_domain, host):
+        vcpus, memory = self._launcher.requirements(base_domain)
+        placement = yield self._scheduler.place(vcpus, memory, host)
+        name = 'ipd-warm-{}-{}'.format(base_domain, uuid4().hex[:8])
+        try:
+            instance = yield self._semaphore.run(
+                self._launcher.boot, placement, base_domain, name)
+        except Exception:
+            self._scheduler.release(placement)
+            raise
+        self._scheduler.started(placement)
+        defer.returnValue(instance)
+
+    def _booted(self, instance):
+        key = instance.base_domain, instance.host
+        self._booting[key] -= 1
+        if not self.running:
+            return self._discard(instance)
+        self._idle.setdefault(key, []).append(instance)
+        logger.msg('warmpool.ready', instance=instance.name,
+                   host=instance.host, idle=len(self._idle[key]))
+        self._connect(instance)
+
+    def _connect(self, instance):
+        d = self._launcher.connect(instance)
+        d.addErrback(self._connect_failed, instance)
+
+    def _connect_failed(self, reason, instance):
+        logger.msg('warmpool.connect_failed', instance=instance.name,
+                   host=instance.host, error=reason.getErrorMessage())
+
+    def _boot_failed(self, reason, key):
+        self._booting[key] -= 1
+        logger.msg('warmpool.boot_failed', base_domain=key[0], host=key[1],
+                   error=reason.getErrorMessage())
+
+    def _discard(self, instance):
+        self._scheduler.release(instance.placement)
+        d = self._launcher.destroy(instance)
+        d.addErrback(self._discard_failed, instance)
+        return d
+
+    def _discard_failed(self, reason, instance):
+        logger.msg('warmpool.discard_failed', instance=instance.name,
+                   host=instance.host, error=reason.getErrorMessage())
+
+    def take(self, base_domain):
+        """
+        Returns an idle instance of base_domain, from the host with the most
+        of them, or None if there is none. The placement of the instance has
+        to be released once the build finished.
+        """
+        hosts = sorted(self._scheduler.hosts, reverse=True, key=lambda h: len(
+            self._idle.get((base_domain, h), [])))
+        for host in hosts:
+            idle = self._idle.get((base_domain, host), [])
+            while idle:
+                instance = idle.pop(0)
+                if self._launcher.is_running(instance):
+                    self.hits += 1
+                    self.replenish(base_domain, host)
+                    logger.msg('warmpool.taken', instance=instance.name,
+                               host=host, idle=len(idle))
+                    return instance
+                logger.msg('warmpool.stale', instance=instance.name,
+                           host=host)
+                self._discard(instance)
+        if base_domain in self.base_domains:
+            self.misses += 1
+            for host in self._scheduler.hosts:
+                self.replenish(base_domain, host)
+
+    def stats(self):
+        return {
+            'idle': sum(len(i) for i in self._idle.itervalues()),
+            'booting': sum(self._booting.itervalues()),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
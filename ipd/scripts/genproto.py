@@ -2,8 +2,12 @@ from __future__ import absolute_import, print_function
 import argparse
 import os
 import datetime
+import itertools
+import re
+import struct
 from pipes import quote
 from collections import namedtuple, OrderedDict
+from cStringIO import StringIO
 
 import parsley
 from ipd import logging, libvirt
@@ -15,6 +19,9 @@ logger = get_logger()
 
 def get_parser():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--codecs', action='store_true',
+                        help='also write specialized pack and unpack '
+                             'functions for each structure')
     parser.add_argument('source')
     parser.add_argument('dest')
     return parser
@@ -88,9 +95,24 @@ class TypeDefinition(namedtuple('typedef', ['alias', 'ref'])):
     def process_context(self, types, constants):
         types[self.alias] = self.ref.get_actual_type(types, constants)
 
-class Union(namedtuple('union', ['id', 'content'])):
+class Union(namedtuple('union', ['id', 'discriminant', 'arms'])):
     def process_context(self, types, constants):
-        types[self.id] = 'not_implemented'
+        name = self.id
+        if name.startswith('remote_'):
+            name = name[len('remote_'):]
+        discriminant = self.discriminant.process_context(types, constants)
+        arms, default = [], None
+        for cases, decl in self.arms:
+            if decl is None:
+                arm = (None, None)
+            else:
+                arm = decl.process_context(types, constants)
+            for case in cases:
+                if case is None:
+                    default = arm
+                else:
+                    arms.append((case.get_actual_value(constants),) + arm)
+        types[self.id] = xdrtypes.Union(name, discriminant, arms, default)
 
 class Reference(namedtuple('ref', ['id'])):
     def get_actual_value(self, constants):
@@ -105,17 +127,168 @@ class Declaration(namedtuple('declaration', ['id', 'type'])):
         return (id, type)
 
 
-def main():
-    parser = get_parser()
-    args = parser.parse_args()
-
-    logging.setup_logging()
-
+class CodecWriter(object):
+    """
+    Writes the source of specialized pack and unpack functions for the given
+    structures, to be put in the generated module after their declarations.
+    The functions are the same the types compile at runtime, but all the
+    objects they refer to are referenced by their name in the module.
+    """
+
+    def __init__(self, names):
+        # Expressions referring to the objects by their id
+        self._names = {}
+        for name, type in names.iteritems():
+            self._names[id(type)] = name
+            if isinstance(type, (xdrtypes.ComplexType, xdrtypes.Union)):
+                self._names[id(type.model)] = '{}.model'.format(name)
+            elif isinstance(type, xdrtypes.Enum):
+                self._names[id(type.ids)] = '{}.ids'.format(name)
+        self._structs = OrderedDict()
+        self._helpers = []
+        self._anonymous = itertools.count()
+        # Keep the anonymous types alive so that their ids stay unique
+        self._referenced = []
+
+    def resolve(self, obj):
+        try:
+            return self._names[id(obj)]
+        except KeyError:
+            pass
+
+        if isinstance(obj, struct.Struct):
+            name = '_struct{}'.format(len(self._structs))
+            name = self._structs.setdefault(obj.format, name)
+        elif isinstance(obj, xdrtypes.ArrayBase):
+            name = '_array{}'.format(next(self._anonymous))
+            self._names[id(obj)] = name
+            self._referenced.append(obj)
+            self._helpers.append(
+                self._functions(obj, name) +
+                '{0} = Type(_pack{0}, _unpack{0})\n'.format(name))
+        else:
+            raise ValueError(
+                'Cannot refer to {!r} from the generated code'.format(obj))
+        return name
+
+    def _functions(self, type, name):
+        gen = xdrtypes.CodeBuilder(self.resolve)
+        type.emit_unpack_function(gen, '_unpack' + name)
+        gen.emit('')
+        type.emit_pack_function(gen, '_pack' + name)
+        gen.emit('')
+        return gen.source()
+
+    def write(self, fh, structs):
+        codecs = []
+        for name, type in structs:
+            codecs.append(self._functions(type, '_' + name) +
+                          '{0}.unpack = _unpack_{0}\n'
+                          '{0}.pack = _pack_{0}\n'.format(name))
+
+        fh.write('\n# Specialized codecs\n\n')
+        for fmt, name in self._structs.iteritems():
+            fh.write('{} = struct.Struct({!r})\n'.format(name, fmt))
+        fh.write('\n')
+        for source in self._helpers + codecs:
+            fh.write('\n{}\n'.format(source))
+
+
+def declaration_source(declaration):
+    """
+    Returns the source of the (name, type) tuple of a declaration, where
+    the type is either the name of a declared type or the source of the
+    expression building it.
+    """
+    name, type = declaration
+    if isinstance(type, (xdrtypes.ComplexType, xdrtypes.Union)):
+        type = type.name
+    return '({!r}, {})'.format(name, type)
+
+
+def write_declarations(declarations, types):
+    """
+    Writes the declarations of the enums, structures and unions of types
+    to the declarations file. Returns the names of the declared types and
+    the ones of the structures and unions among them.
+    """
+    declared, structs = [], []
+
+    for name, type in types.iteritems():
+        if name in set(['remote_procedure']):
+            continue
+        if not isinstance(type, (xdrtypes.ComplexType, xdrtypes.Enum,
+                                 xdrtypes.Union)):
+            continue
+        if name.startswith('remote_'):
+            name = name[len('remote_'):]
+        declared.append(name)
+
+        if isinstance(type, xdrtypes.Enum):
+            declarations.write('{} = enum({!r}, [\n'.format(name, name))
+            for k, v in type.values:
+                declarations.write('    ({!r}, {}),\n'.format(k, v))
+            declarations.write('])\n\n')
+            continue
+
+        structs.append(name)
+
+        if isinstance(type, xdrtypes.Union):
+            declarations.write('{} = union({!r}, {}, [\n'.format(
+                name, name, declaration_source(type.discriminant)))
+            for case, k, v in type.arms:
+                declarations.write('    ({!r}, {}),\n'.format(
+                    case, declaration_source((k, v))[1:-1]))
+            if type.default is None:
+                declarations.write('])\n\n')
+            else:
+                declarations.write('], default={})\n\n'.format(
+                    declaration_source(type.default)))
+            continue
+
+        declarations.write('{} = compound({!r}, [\n'.format(name, name))
+        for field in type.fields:
+            declarations.write('    {},\n'.format(declaration_source(field)))
+        declarations.write('])\n\n')
+
+    return declared, structs
+
+
+# Names imported from ipd.libvirt.types by the generated module, one import
+# statement per line; only the names it uses are imported
+TYPE_IMPORTS = [
+    ['char', 'short', 'int', 'hyper'],
+    ['float', 'double'],
+    ['uchar', 'ushort', 'uint', 'uhyper'],
+    ['fstring', 'string', 'fopaque', 'opaque'],
+    ['farray', 'array', 'optional'],
+    ['not_implemented', 'compound', 'enum'],
+    ['union'],
+    ['Type'],
+]
+
+
+def write_imports(fh, source):
+    """
+    Writes the imports of the types referred to by the given source.
+    """
+    for names in TYPE_IMPORTS:
+        names = [n for n in names
+                 if re.search(r'\b{}\b'.format(n), source)]
+        if names:
+            fh.write('from ipd.libvirt.types import {}\n'.format(
+                ', '.join(names)))
+
+
+def make_grammar():
+    """
+    Returns the parser of XDR protocol definitions.
+    """
     grammar_file = os.path.join(os.path.dirname(
         libvirt.__file__), 'idl.grammar')
 
     with open(grammar_file, 'rb') as fh:
-        grammar = parsley.makeGrammar(fh.read(), {
+        return parsley.makeGrammar(fh.read(), {
             'struct': Structure,
             'enum': Enumeration,
             'const': Constant,
@@ -130,16 +303,26 @@ def main():
             'declaration': Declaration,
         })
 
-    with open(args.source) as fh:
-        source = fh.read()
 
-    tokens = grammar(source).tokens()
+def load_protocol(source):
+    """
+    Parses the XDR source of a protocol definition. Returns the ordered
+    dicts of its types and of its constants.
+    """
+    tokens = make_grammar()(source).tokens()
 
     constants = OrderedDict({
         'VIR_SECURITY_MODEL_BUFLEN': 257,
         'VIR_SECURITY_LABEL_BUFLEN': 4097,
         'VIR_SECURITY_DOI_BUFLEN': 257,
         'VIR_UUID_BUFLEN': 16,
+        'VIR_TYPED_PARAM_INT': 1,
+        'VIR_TYPED_PARAM_UINT': 2,
+        'VIR_TYPED_PARAM_LLONG': 3,
+        'VIR_TYPED_PARAM_ULLONG': 4,
+        'VIR_TYPED_PARAM_DOUBLE': 5,
+        'VIR_TYPED_PARAM_BOOLEAN': 6,
+        'VIR_TYPED_PARAM_STRING': 7,
     })
 
     types = OrderedDict({k:k for k in xdrtypes.TYPES})
@@ -160,7 +343,19 @@ def main():
 
         raise
 
-    import re, sys
+    return types, constants
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    logging.setup_logging()
+
+    with open(args.source) as fh:
+        types, constants = load_protocol(fh.read())
+
+    import sys
     def to_camelcase(s):
         s = s.capitalize()
         return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), s)
@@ -176,40 +371,32 @@ def main():
             '  Command line:  gen-libvirt-protocol {}\n\n'
             '"""\n\n'.format(datetime.datetime.now().isoformat(), cmdline)
         )
+        declarations = StringIO()
+        declared, structs = write_declarations(declarations, types)
+
+        if args.codecs:
+            # The codecs are generated out of the actual types, as built by
+            # the declarations
+            namespace = dict(vars(xdrtypes))
+            exec(declarations.getvalue(), namespace)
+            names = {k: v for k, v in xdrtypes.TYPES.iteritems()
+                     if not isinstance(v, xdrtypes.TypeFactoryMeta)}
+            names.update((k, namespace[k]) for k in declared)
+            writer = CodecWriter(names)
+            writer.write(declarations, [(k, namespace[k]) for k in structs])
+            declarations.write('\n')
+
+        if args.codecs:
+            fh.write('import struct\n\n')
         fh.write('from ipd.libvirt.procedures import ProcedureBase\n')
-        fh.write('from ipd.libvirt.types import char, short, int, hyper\n')
-        fh.write('from ipd.libvirt.types import uchar, ushort, uint, uhyper\n')
-        fh.write('from ipd.libvirt.types import fstring, string, fopaque, opaque\n')
-        fh.write('from ipd.libvirt.types import farray, array, optional\n')
-        fh.write('from ipd.libvirt.types import not_implemented, compound, enum\n')
+        write_imports(fh, declarations.getvalue())
         fh.write('\n\n')
 
         fh.write('PROGRAM = {}\n'.format(hex(constants['REMOTE_PROGRAM'])))
-        fh.write('PROTOCOL_VERSION = {}\n\n'.format(hex(constants['REMOTE_PROTOCOL_VERSION'])))
-
-        for name, type in types.iteritems():
-            if name in set(['remote_procedure']):
-                continue
-            if not isinstance(type, (xdrtypes.ComplexType, xdrtypes.Enum)):
-                continue
-            if name.startswith('remote_'):
-                name = name[len('remote_'):]
-
-            if isinstance(type, xdrtypes.Enum):
-                fh.write('{} = enum({!r}, [\n'.format(name, name))
-                for k, v in type.values:
-                    fh.write('    ({!r}, {}),\n'.format(k, v))
-                fh.write('])\n\n')
-                continue
-
-            fh.write('{} = compound({!r}, [\n'.format(name, name))
-            for k, v in type.fields:
-                if isinstance(v, xdrtypes.ComplexType):
-                    v = v.name
-                    if v.startswith('remote_'):
-                        v = v[len('remote_'):]
-                fh.write('    ({!r}, {}),\n'.format(k, v))
-            fh.write('])\n\n')
+        fh.write('PROTOCOL_VERSION = {}\n\n'.format(
+            hex(constants['REMOTE_PROTOCOL_VERSION'])))
+
+        fh.write(declarations.getvalue())
 
         for k, v in types['remote_procedure']:
             _, _, k = k.lower().split('_', 2)
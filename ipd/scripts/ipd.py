@@ -246,6 +246,15 @@ def _jsonserver():
     import functools
     from txredis.client import RedisClient
     from ipd.libvirt.endpoints import TCP4LibvirtEndpoint
+    from ipd.libvirt.inventory import DomainInventory
+    from ipd.libvirt.pool import LibvirtConnectionPool
+    from ipd.notifications import Notifications
+    from ipd.projects.launcher import InstanceLauncher
+    from ipd.projects.scheduler import BuildScheduler
+    from ipd.projects.templates import TemplateCache
+    from ipd.projects.volumes import VolumeProvisioner
+    from ipd.projects.warmpool import WarmPool
+    from ipd.ssh import ConnectionManager
     from ipd.utils import ProtocolConnector
 
     # Configuration
@@ -253,7 +262,8 @@ def _jsonserver():
                                 port=16509, driver='qemu', mode='system')
 
     hosts = ('ipd{}.tic.hefr.ch'.format(i) for i in range(1, 2))
-    hosts = {h: libvirt(host=h) for h in hosts}
+    hosts = {h: DomainInventory(LibvirtConnectionPool(libvirt(host=h)))
+             for h in hosts}
 
     workdir = FilePath('workdir/manager')
 
@@ -261,7 +271,17 @@ def _jsonserver():
 
     # Business logic setup
     manager = projects.ProjectsManager(workdir, redis, IPD_MANAGER_KEY)
-    builder = projects.Builder(manager, hosts, redis)
+    notifications = Notifications(reactor, 'localhost', 6379)
+    pools = {h: inventory.pool for h, inventory in hosts.items()}
+    scheduler = BuildScheduler(pools)
+    templates = TemplateCache()
+    volumes = VolumeProvisioner(pools, templates)
+    connections = ConnectionManager()
+    launcher = InstanceLauncher(hosts, redis, notifications, volumes,
+                                templates, connections, IPD_MANAGER_KEY)
+    warm_pool = WarmPool(launcher, scheduler, templates.base_domains())
+    builder = projects.Builder(manager, redis, scheduler, launcher,
+                               warm_pool)
 
     # API resources
     api_root = RecursiveResource()
@@ -278,6 +298,12 @@ def _jsonserver():
     # Application setup
     application = service.Application('projects-manager')
     api_service.setServiceParent(application)
+    for inventory in hosts.itervalues():
+        inventory.pool.setServiceParent(application)
+        inventory.setServiceParent(application)
+    scheduler.setServiceParent(application)
+    connections.setServiceParent(application)
+    warm_pool.setServiceParent(application)
     manager.setServiceParent(application)
     builder.setServiceParent(application)
 
@@ -301,8 +327,7 @@ def _jsonserver():
 def _create_domain():
     from twisted.internet.endpoints import TCP4ClientEndpoint
     from ipd.libvirt import LibvirtFactory, remote, error
-    from lxml import etree
-    from twisted.python.filepath import FilePath
+    from ipd.projects.templates import TemplateCache, DomainNotFound
 
     point = TCP4ClientEndpoint(reactor, 'ipd1.tic.hefr.ch', 16509)
     proto = yield point.connect(LibvirtFactory())
@@ -336,15 +361,14 @@ def _create_domain():
     else:
         res = yield proto.storage_vol_delete(res.vol, 0)
 
-    volume = FilePath('workdir/volumes')
-    volume = volume.child('{}.xml'.format(base_domain))
-
-    if volume.exists():
-        with volume.open() as fh:
-            tree = etree.parse(fh)
+    templates = TemplateCache()
+    try:
+        volume = templates.volume(base_domain)
+    except DomainNotFound:
+        volume = None
 
-        tree.find('name').text = name
-        volxml = etree.tostring(tree)
+    if volume is not None:
+        volxml = volume.template.render(name=name)
 
         print volxml
 
@@ -374,21 +398,11 @@ def _create_domain():
         else:
             raise RuntimeError()
 
-    domain = FilePath('workdir/domains')
-    domain = domain.child('{}.xml'.format(base_domain))
-
-    with domain.open() as fh:
-        tree = etree.parse(fh)
-
-    tree.find('name').text = name
-
-    if volume.exists():
-        tree.find('devices/disk/source').attrib['volume'] = name
-
-    if vnc_pass:
-        tree.find('devices/graphics').attrib['passwd'] = vnc_pass
-
-    domxml = etree.tostring(tree)
+    domxml = templates.domain(base_domain).template.render(
+        name=name,
+        volume=name if volume is not None else None,
+        passwd=vnc_pass or None,
+    )
 
     print domxml
 
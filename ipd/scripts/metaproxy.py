@@ -10,6 +10,8 @@ from structlog import get_logger
 
 from ipd import logging
 from ipd.libvirt.endpoints import TCP4LibvirtEndpoint
+from ipd.libvirt.inventory import DomainInventory
+from ipd.libvirt.pool import LibvirtConnectionPool
 from ipd.metadata.utils import DomainResolver
 from ipd.metadata.revproxy import LibvirtMetaReverseProxyResource
 
@@ -54,7 +56,15 @@ def main():
         print('Transport {!r} not supported'.format(transport))
         sys.exit(1)
 
-    resolver = DomainResolver(libvirt)
+    pool = LibvirtConnectionPool(libvirt)
+    pool.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', pool.stopService)
+
+    inventory = DomainInventory(pool)
+    inventory.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', inventory.stopService)
+
+    resolver = DomainResolver(inventory)
 
     logger.msg('metaproxy.upstream', host=host, port=port)
     res = LibvirtMetaReverseProxyResource(resolver, host, port, '')
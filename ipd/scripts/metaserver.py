@@ -12,8 +12,11 @@ from structlog import get_logger
 
 from ipd import logging
 from ipd.libvirt.endpoints import TCP4LibvirtEndpoint
+from ipd.libvirt import LibvirtFactory
+from ipd.libvirt.inventory import DomainInventory
+from ipd.libvirt.pool import LibvirtConnectionPool
 from ipd.metadata import MetadataRootResource, MetadataManager
-from ipd.utils import ProtocolConnector
+from ipd.utils import ProtocolPool
 
 
 IPD_MANAGER_KEY = Key.fromFile('workdir/ipd-test-key.rsa')
@@ -33,13 +36,22 @@ def main():
     logger = get_logger()
     logger.msg('metaserver.starting')
 
-    redis = ProtocolConnector(reactor, 'localhost', 6379, RedisClient)
+    redis = ProtocolPool(reactor, 'localhost', 6379, RedisClient, size=4)
 
-    srv = MetadataManager(redis, IPD_MANAGER_KEY.public())
-    srv.register_host(
-        'ipd1.tic.hefr.ch',
+    pool = LibvirtConnectionPool(
         TCP4LibvirtEndpoint(reactor, 'ipd1.tic.hefr.ch', 16509, 'qemu', 'system'),
+        size=2, calls_per_connection=32,
+        factory=LibvirtFactory(max_in_flight=16, call_timeout=30),
     )
+    pool.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', pool.stopService)
+
+    inventory = DomainInventory(pool)
+    inventory.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', inventory.stopService)
+
+    srv = MetadataManager(redis, IPD_MANAGER_KEY.public())
+    srv.register_host('ipd1.tic.hefr.ch', inventory)
 
     site = server.Site(MetadataRootResource(srv))
 
@@ -1,14 +1,20 @@
 
+from twisted.application import service
 from twisted.conch.client.knownhosts import PlainEntry
 from twisted.conch.error import HostKeyChanged, UserRejectedKey
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, task
 from twisted.conch.ssh.keys import Key
 from twisted.conch.endpoints import SSHCommandClientEndpoint
+from twisted.python import failure
+
+from structlog import get_logger
+logger = get_logger()
 
 
 class CommandsProtocol(protocol.Protocol):
     def connectionMade(self):
         self.disconnected = None
+        self._lost = []
 
     def exec_command(self, command):
         conn = self.transport.conn
@@ -25,9 +31,20 @@ class CommandsProtocol(protocol.Protocol):
         self.transport.loseConnection()
         return d
 
+    def notify_disconnect(self):
+        """
+        Returns a deferred fired once the connection is lost.
+        """
+        d = defer.Deferred()
+        self._lost.append(d)
+        return d
+
     def connectionLost(self, reason):
         if self.disconnected:
             self.disconnected.callback(None)
+        lost, self._lost = self._lost, []
+        for d in lost:
+            d.callback(None)
 
 
 class SingleCommandProtocol(protocol.Protocol):
@@ -57,6 +74,147 @@ class MultipleCommandsClientEndpoint(SSHCommandClientEndpoint):
         )
 
 
+class SSHConnection(object):
+    """
+    An authenticated connection running at most max_channels commands at a
+    time, each on its own channel.
+    """
+
+    def __init__(self, protocol, max_channels, reactor):
+        self.protocol = protocol
+        self._reactor = reactor
+        self._semaphore = defer.DeferredSemaphore(max_channels)
+        self.last_used = reactor.seconds()
+
+    @property
+    def busy(self):
+        return (self._semaphore.tokens < self._semaphore.limit or
+                bool(self._semaphore.waiting))
+
+    def exec_command(self, command):
+        self.last_used = self._reactor.seconds()
+        d = self._semaphore.run(self.protocol.exec_command, command)
+        d.addBoth(self._used)
+        return d
+
+    def _used(self, result):
+        self.last_used = self._reactor.seconds()
+        return result
+
+    def disconnect(self):
+        return self.protocol.disconnect()
+
+
+class ConnectionManager(service.Service, object):
+    """
+    Keeps the SSH connections to the instances open, so that key exchange
+    and authentication only happen once for all the commands run with the
+    same host, port, user, client key and host key.
+
+    Concurrent requests for the same connection share a single connection
+    attempt. Connections unused for idle_timeout seconds are closed (they
+    are checked every check_interval seconds), as well as all of them when
+    the service stops.
+    """
+
+    max_channels = 8
+    idle_timeout = 300
+    check_interval = 30
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._connections = {}
+        self._connecting = {}
+        self._evicter = task.LoopingCall(self.evict_idle)
+        self._evicter.clock = reactor
+        self.hits = 0
+        self.misses = 0
+
+    def startService(self):
+        super(ConnectionManager, self).startService()
+        self._evicter.start(self.check_interval, now=False)
+
+    def stopService(self):
+        super(ConnectionManager, self).stopService()
+        if self._evicter.running:
+            self._evicter.stop()
+        connections, self._connections = self._connections, {}
+        return defer.DeferredList([c.disconnect()
+                                   for c in connections.itervalues()])
+
+    def connect(self, hostname, username, key, host_key, port=None):
+        """
+        Returns a deferred fired with an SSHConnection to hostname,
+        authenticated as username with key, if the host presents host_key.
+        """
+        cache_key = (hostname, port, username, key.fingerprint(),
+                     host_key.fingerprint())
+        connection = self._connections.get(cache_key)
+        if connection is not None:
+            self.hits += 1
+            connection.last_used = self._reactor.seconds()
+            return defer.succeed(connection)
+
+        waiters = self._connecting.get(cache_key)
+        if waiters is None:
+            self.misses += 1
+            waiters = self._connecting[cache_key] = []
+            known_hosts = KnownHostsLists([(hostname, host_key)])
+            endpoint = MultipleCommandsClientEndpoint.newConnection(
+                self._reactor, username, hostname, port, keys=[key],
+                knownHosts=known_hosts)
+            d = endpoint.connect(MultipleCommandsFactory())
+            d.addBoth(self._connected, cache_key)
+        d = defer.Deferred()
+        waiters.append(d)
+        return d
+
+    def _connected(self, result, cache_key):
+        waiters = self._connecting.pop(cache_key)
+        if isinstance(result, failure.Failure):
+            logger.msg('ssh.connect_failed', host=cache_key[0],
+                       error=result.getErrorMessage())
+        else:
+            result = SSHConnection(result, self.max_channels, self._reactor)
+            self._connections[cache_key] = result
+            d = result.protocol.notify_disconnect()
+            d.addCallback(self._lost, cache_key, result)
+            logger.msg('ssh.connected', host=cache_key[0],
+                       connections=len(self._connections))
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _lost(self, _, cache_key, connection):
+        if self._connections.get(cache_key) is connection:
+            del self._connections[cache_key]
+            logger.msg('ssh.connection_lost', host=cache_key[0])
+
+    def evict_idle(self):
+        """
+        Closes the connections which were not used for idle_timeout seconds.
+        """
+        now = self._reactor.seconds()
+        for cache_key, connection in self._connections.items():
+            if (not connection.busy and
+                    now - connection.last_used >= self.idle_timeout):
+                del self._connections[cache_key]
+                logger.msg('ssh.evicted', host=cache_key[0])
+                connection.disconnect()
+
+    def stats(self):
+        return {
+            'connections': len(self._connections),
+            'connecting': len(self._connecting),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
 class KnownHostsLists(object):
     def __init__(self, known_hosts):
         self._entries = []
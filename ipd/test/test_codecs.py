@@ -0,0 +1,291 @@
+import random
+import struct
+import xdrlib
+from cStringIO import StringIO
+
+import pytest
+
+from ipd.libvirt import remote, types
+from ipd.scripts.genproto import CodecWriter, load_protocol
+from ipd.scripts.genproto import write_declarations
+
+
+UNSUPPORTED = set([id(types.not_implemented)])
+
+# Name of the xdrlib method packing each primitive type, char and short
+# being encoded as 4 bytes integers by XDR
+PRIMITIVES = {
+    id(types.char): 'int',
+    id(types.uchar): 'uint',
+    id(types.short): 'int',
+    id(types.ushort): 'uint',
+    id(types.int): 'int',
+    id(types.uint): 'uint',
+    id(types.hyper): 'hyper',
+    id(types.uhyper): 'uhyper',
+    id(types.float): 'float',
+    id(types.double): 'double',
+    id(types.string): 'string',
+    id(types.opaque): 'opaque',
+}
+
+
+def supported(type):
+    if id(type) in UNSUPPORTED:
+        return False
+    if isinstance(type, types.ComplexType):
+        return all(supported(t) for _, t in type.fields)
+    if isinstance(type, types.Union):
+        arms = [t for _, _, t in type.arms]
+        if type.default is not None:
+            arms.append(type.default[1])
+        return (supported(type.discriminant[1]) and
+                all(t is None or supported(t) for t in arms))
+    if isinstance(type, types.Optional):
+        return supported(type.type)
+    if isinstance(type, types.ArrayBase):
+        return supported(type.items_type)
+    return True
+
+
+def reference_pack(packer, type, value):
+    """
+    Packs value with the plain xdrlib packer, field by field.
+    """
+    if isinstance(type, types.ComplexType):
+        for (_, t), v in zip(type.fields, value):
+            reference_pack(packer, t, v)
+    elif isinstance(type, types.Union):
+        d, value = value
+        reference_pack(packer, type.discriminant[1], d)
+        arms = dict((case, t) for case, _, t in type.arms)
+        t = arms[d] if d in arms else type.default[1]
+        if t is not None:
+            reference_pack(packer, t, value)
+    elif isinstance(type, types.Enum):
+        packer.pack_enum(value)
+    elif isinstance(type, types.Optional):
+        packer.pack_bool(value is not None)
+        if value is not None:
+            reference_pack(packer, type.type, value)
+    elif isinstance(type, types.ArrayBase):
+        def pack_item(item):
+            reference_pack(packer, type.items_type, item)
+        if isinstance(type, types.FixedLengthArray):
+            packer.pack_farray(type.length, value, pack_item)
+        else:
+            packer.pack_array(value, pack_item)
+    elif isinstance(type, types.FixedLengthString):
+        packer.pack_fstring(type.length, value)
+    elif isinstance(type, types.FixedLengthData):
+        packer.pack_fopaque(type.length, value)
+    else:
+        getattr(packer, 'pack_' + PRIMITIVES[id(type)])(value)
+
+
+def sample(rand, type):
+    """
+    Returns a random value of the given type.
+    """
+    if isinstance(type, types.ComplexType):
+        return type.model(*[sample(rand, t) for _, t in type.fields])
+    if isinstance(type, types.Union):
+        case, name, arm = rand.choice(type.arms)
+        return type.model(case, None if arm is None else sample(rand, arm))
+    if isinstance(type, types.Enum):
+        return rand.choice(sorted(type.ids))
+    if isinstance(type, types.Optional):
+        return rand.choice([None, sample(rand, type.type)])
+    if isinstance(type, types.ArrayBase):
+        if isinstance(type, types.FixedLengthArray):
+            length = type.length
+        else:
+            length = rand.randint(0, min(3, type.maxlength))
+        return [sample(rand, type.items_type) for _ in range(length)]
+    if isinstance(type, (types.FixedLengthString, types.FixedLengthData)):
+        return ''.join(chr(rand.randint(0, 255)) for _ in range(type.length))
+    name = PRIMITIVES[id(type)]
+    if name in ('string', 'opaque'):
+        # Never empty, as empty optional values are encoded as missing
+        return ''.join(chr(rand.randint(32, 126))
+                       for _ in range(rand.randint(1, 12)))
+    fmt = type.fixed_format
+    if name in ('float', 'double'):
+        # Only values which survive the round trip through the format
+        value, = struct.unpack('>' + fmt, struct.pack('>' + fmt,
+                                                     rand.random()))
+        return value
+    bits = struct.calcsize(fmt) * 8
+    if fmt.isupper():
+        return rand.randint(0, 2 ** bits - 1)
+    return rand.randint(-2 ** (bits - 1), 2 ** (bits - 1) - 1)
+
+
+def check_codec(type, pack, unpack, rounds=10):
+    rand = random.Random(type.name)
+    for _ in range(rounds):
+        value = sample(rand, type)
+        packer = xdrlib.Packer()
+        reference_pack(packer, type, value)
+        expected = packer.get_buffer()
+
+        stream = types.Packer()
+        pack(stream, value)
+        assert str(stream.get_buffer()) == expected
+        assert unpack(types.Unpacker(expected)) == value
+
+
+REMOTE_STRUCTS = sorted(
+    (name, value) for name, value in vars(remote).iteritems()
+    if isinstance(value, (types.ComplexType, types.Union)) and
+    supported(value))
+
+
+@pytest.fixture(scope='module')
+def generated():
+    """
+    The codecs written by gen-libvirt-protocol --codecs for the remote
+    structures, by name.
+    """
+    names = dict((k, v) for k, v in types.TYPES.iteritems()
+                 if not isinstance(v, types.TypeFactoryMeta))
+    for name, value in vars(remote).iteritems():
+        if isinstance(value, (types.ComplexType, types.Enum, types.Union)):
+            names[name] = value
+    fh = StringIO()
+    CodecWriter(names).write(fh, REMOTE_STRUCTS)
+
+    # The generated code installs the codecs on the types, restore the
+    # runtime compiled ones afterwards
+    saved = [(t, vars(t).copy()) for _, t in REMOTE_STRUCTS]
+    namespace = dict(vars(remote), struct=struct, Type=types.Type)
+    exec(compile(fh.getvalue(), '<generated codecs>', 'exec'), namespace)
+    for t, attributes in saved:
+        t.__dict__.clear()
+        t.__dict__.update(attributes)
+
+    return dict((name, (namespace['_pack_' + name],
+                        namespace['_unpack_' + name]))
+                for name, _ in REMOTE_STRUCTS)
+
+
+def test_remote_structures_are_checked():
+    assert len(REMOTE_STRUCTS) > 490
+
+
+@pytest.mark.parametrize('type,pack,values', [
+    (types.char, 'int', [-128, 0, 127]),
+    (types.short, 'int', [-32768, -1, 32767]),
+    (types.uchar, 'uint', [0, 255]),
+    (types.ushort, 'uint', [0, 65535]),
+])
+def test_small_integers_codec(type, pack, values):
+    for value in values:
+        packer = xdrlib.Packer()
+        getattr(packer, 'pack_' + pack)(value)
+        expected = packer.get_buffer()
+        assert len(expected) == 4
+
+        stream = types.Packer()
+        type.pack(stream, value)
+        assert str(stream.get_buffer()) == expected
+        assert type.unpack(types.Unpacker(expected)) == value
+
+
+@pytest.mark.parametrize('name,type', REMOTE_STRUCTS)
+def test_compiled_codec(name, type):
+    check_codec(type, type._compile_pack(), type._compile_unpack())
+
+
+@pytest.mark.parametrize('name,type', REMOTE_STRUCTS)
+def test_generated_codec(generated, name, type):
+    pack, unpack = generated[name]
+    check_codec(type, pack, unpack)
+
+
+PROTOCOL = """
+/* Typed parameters */
+const REMOTE_STRING_MAX = 4194304;
+const REMOTE_PARAMS_MAX = 16;
+
+typedef string remote_nonnull_string<REMOTE_STRING_MAX>;
+typedef remote_nonnull_string *remote_string;
+
+enum remote_param_kind {
+    REMOTE_PARAM_SIMPLE = 0,
+    REMOTE_PARAM_LIST = 1
+};
+
+union remote_typed_param_value switch (int type) {
+ case VIR_TYPED_PARAM_INT:
+ case VIR_TYPED_PARAM_BOOLEAN:
+     int i;
+ case VIR_TYPED_PARAM_ULLONG:
+     unsigned hyper ul;
+ case VIR_TYPED_PARAM_STRING:
+     remote_nonnull_string s;
+ default:
+     void;
+};
+
+struct remote_typed_param {
+    remote_nonnull_string field;
+    remote_typed_param_value value;
+    remote_string description;
+    remote_param_kind kind;
+};
+
+struct remote_get_params_ret {
+    remote_typed_param params<REMOTE_PARAMS_MAX>;
+    unsigned int flags;
+};
+"""
+
+
+@pytest.fixture(scope='module')
+def protocol():
+    """
+    The module declaring the types of PROTOCOL, as written by
+    gen-libvirt-protocol.
+    """
+    types_, _ = load_protocol(PROTOCOL)
+    fh = StringIO()
+    declared, structs = write_declarations(fh, types_)
+    assert declared == ['param_kind', 'typed_param_value', 'typed_param',
+                        'get_params_ret']
+    assert structs == ['typed_param_value', 'typed_param', 'get_params_ret']
+    namespace = dict(vars(types))
+    exec(fh.getvalue(), namespace)
+    return namespace
+
+
+def test_union_declaration(protocol):
+    union = protocol['typed_param_value']
+    assert isinstance(union, types.Union)
+    assert union.discriminant == ('type', types.int)
+    assert union.arms == [
+        (1, 'i', types.int),
+        (6, 'i', types.int),
+        (4, 'ul', types.uhyper),
+        (7, 's', types.string),
+    ]
+    assert union.default == (None, None)
+
+
+def test_union_codec(protocol):
+    union = protocol['typed_param_value']
+    check_codec(union, union.pack, union.unpack)
+
+    # The void default arm carries no value
+    data = struct.pack('>i', 3)
+    assert union.unpack(types.Unpacker(data)) == union.model(3, None)
+    stream = types.Packer()
+    union.pack(stream, union.model(3, None))
+    assert str(stream.get_buffer()) == data
+
+
+def test_parsed_structures_codecs(protocol):
+    for name in ('typed_param', 'get_params_ret'):
+        type = protocol[name]
+        assert supported(type)
+        check_codec(type, type.pack, type.unpack)
@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+from twisted.internet import defer, task
+
+from ipd.libvirt import constants, remote
+from ipd.libvirt.inventory import DomainInventory
+
+
+ListResult = namedtuple('ListResult', ['domains'])
+XMLResult = namedtuple('XMLResult', ['xml'])
+
+DOMAIN_XML = """
+<domain>
+  <devices>
+    <interface type='network'><mac address='52:54:00:00:00:01'/></interface>
+  </devices>
+</domain>
+"""
+
+
+class FakeHypervisor(object):
+    """
+    Connection pool and connection to a host running the domains of the
+    running list.
+    """
+
+    def __init__(self):
+        self.running = []
+        self.listed = 0
+
+    def run(self, func, *args, **kwargs):
+        kwargs.pop('retry', None)
+        return defer.maybeDeferred(func, self, *args, **kwargs)
+
+    def connect_list_all_domains(self, need_results, flags):
+        if flags == constants.LIST_DOMAINS_RUNNING:
+            self.listed += 1
+            return defer.succeed(ListResult(list(self.running)))
+        return defer.succeed(ListResult([]))
+
+    def domain_get_xml_desc(self, domain, flags):
+        return defer.succeed(XMLResult(DOMAIN_XML))
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    assert results, 'deferred did not fire'
+    return results[0]
+
+
+def test_lookup_waits_for_rate_limited_refresh():
+    clock = task.Clock()
+    hypervisor = FakeHypervisor()
+    inventory = DomainInventory(hypervisor, reactor=clock)
+    assert result(inventory.lookup(uuid='a' * 16)) is None
+    assert hypervisor.listed == 1
+
+    # The domain is created right after the refresh
+    clock.advance(1)
+    hypervisor.running.append(remote.nonnull_domain.model(
+        'instance', 'b' * 16, 1))
+    first = inventory.lookup(uuid='b' * 16)
+    second = inventory.lookup(mac='52:54:00:00:00:01')
+    assert not first.called
+    assert hypervisor.listed == 1
+
+    clock.advance(inventory.min_refresh_interval - 1)
+    assert hypervisor.listed == 2
+    assert result(first).name == 'instance'
+    assert result(second).name == 'instance'
+
+
+def test_lookup_of_missing_domain_returns_none():
+    clock = task.Clock()
+    hypervisor = FakeHypervisor()
+    inventory = DomainInventory(hypervisor, reactor=clock)
+    inventory.refresh()
+
+    d = inventory.lookup(uuid='a' * 16)
+    clock.advance(inventory.min_refresh_interval)
+    assert result(d) is None
+    assert hypervisor.listed == 2
@@ -0,0 +1,100 @@
+import pytest
+from twisted.internet import defer, error as net_error, task
+from twisted.test.proto_helpers import StringTransport
+
+from ipd.libvirt.pool import LibvirtConnectionPool
+
+
+class FakeClient(object):
+    def __init__(self, supported=True):
+        self.transport = StringTransport()
+        self.supported = supported
+        self.disconnected = defer.Deferred()
+
+    def connect_supports_feature(self, feature):
+        if self.supported:
+            return defer.succeed(None)
+        return defer.fail(net_error.ConnectionLost())
+
+    def notify_disconnect(self):
+        return self.disconnected
+
+
+class FakeEndpoint(object):
+    """
+    Endpoint whose connection attempts are fired by the tests.
+    """
+
+    def __init__(self):
+        self.attempts = []
+
+    def connect(self, factory):
+        d = defer.Deferred()
+        self.attempts.append(d)
+        return d
+
+
+def make_pool(size=1):
+    endpoint = FakeEndpoint()
+    pool = LibvirtConnectionPool(endpoint, size, reactor=task.Clock())
+    return pool, endpoint
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    assert results, 'deferred did not fire'
+    return results[0]
+
+
+def test_waiters_fail_when_connection_fails():
+    pool, endpoint = make_pool()
+    first = pool.acquire()
+    second = pool.acquire()
+    assert len(endpoint.attempts) == 1
+
+    endpoint.attempts[0].errback(net_error.ConnectionRefusedError())
+    result(first).trap(net_error.ConnectionRefusedError)
+    result(second).trap(net_error.ConnectionRefusedError)
+    assert pool._waiters == []
+
+
+def test_waiters_wait_for_pending_connections():
+    pool, endpoint = make_pool(size=2)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert len(endpoint.attempts) == 2
+
+    endpoint.attempts[0].errback(net_error.ConnectionRefusedError())
+    assert not first.called
+
+    client = FakeClient()
+    endpoint.attempts[1].callback(client)
+    assert result(first) is client
+    assert not second.called
+
+
+def test_client_closed_when_setup_fails():
+    pool, endpoint = make_pool()
+    d = pool.acquire()
+    client = FakeClient(supported=False)
+    endpoint.attempts[0].callback(client)
+
+    result(d).trap(net_error.ConnectionLost)
+    assert client.transport.disconnecting
+    assert pool._connections == set()
+
+
+@pytest.mark.parametrize('retry,calls', [(False, 1), (True, 2)])
+def test_retry_on_lost_connection(retry, calls):
+    pool, endpoint = make_pool()
+    made = []
+
+    def func(client):
+        made.append(client)
+        return defer.fail(net_error.ConnectionLost())
+
+    d = pool.run(func, retry=retry)
+    endpoint.attempts[0].callback(FakeClient())
+    result(d).trap(net_error.ConnectionLost)
+    assert len(made) == calls
@@ -0,0 +1,195 @@
+import struct
+
+import pytest
+from twisted.internet import defer, task
+from twisted.test.proto_helpers import StringTransport
+
+from ipd.libvirt import constants, error, remote
+from ipd.libvirt.protocol import LibvirtFactory
+
+
+def connect(**kwargs):
+    clock = task.Clock()
+    proto = LibvirtFactory(clock=clock, **kwargs).buildProtocol(None)
+    proto.makeConnection(StringTransport())
+    return proto, clock
+
+
+def sent_serials(proto):
+    """
+    Returns the serials of the calls written to the transport of proto.
+    """
+    data = proto.transport.value()
+    serials = []
+    while data:
+        length, = struct.unpack_from('>I', data)
+        header = proto.header_struct.unpack_from(data, 4)
+        serials.append(header[4])
+        data = data[length:]
+    return serials
+
+
+def receive(proto, packet):
+    data = packet.get_buffer()
+    struct.pack_into('>I', data, 0, len(data))
+    proto.dataReceived(str(data))
+
+
+def reply(proto, serial, hostname):
+    packet = proto.make_packet(
+        remote.PROGRAM, remote.PROTOCOL_VERSION, remote.ConnectGetHostname.id,
+        constants.packet_type.REPLY, serial, constants.status.OK)
+    remote.connect_get_hostname_ret.pack(
+        packet, remote.connect_get_hostname_ret.model(hostname))
+    receive(proto, packet)
+
+
+def reply_register(proto, serial, failed=False):
+    status = constants.status.ERROR if failed else constants.status.OK
+    packet = proto.make_packet(
+        remote.PROGRAM, remote.PROTOCOL_VERSION,
+        remote.ConnectDomainEventRegisterAny.id,
+        constants.packet_type.REPLY, serial, status)
+    if failed:
+        remote.error.pack(packet, remote.error.model(
+            1, 0, 'failed', 2, None, None, None, None, 0, 0, None))
+    receive(proto, packet)
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    assert results, 'deferred did not fire'
+    return results[0]
+
+
+def test_calls_beyond_max_in_flight_are_queued():
+    proto, clock = connect(max_in_flight=1)
+    first = proto.connect_get_hostname()
+    second = proto.connect_get_hostname()
+    third = proto.connect_get_hostname()
+
+    assert sent_serials(proto) == [0]
+    assert proto._remote.in_flight == 1
+    assert proto._remote.queued == 2
+
+    reply(proto, 0, 'a')
+    assert result(first).hostname == 'a'
+    assert sent_serials(proto) == [0, 1]
+    assert not second.called
+
+    # The queued calls are sent in the order they were made
+    reply(proto, 1, 'b')
+    assert result(second).hostname == 'b'
+    assert sent_serials(proto) == [0, 1, 2]
+
+    reply(proto, 2, 'c')
+    assert result(third).hostname == 'c'
+    assert proto._remote.in_flight == 0
+    assert proto._remote.queued == 0
+
+
+def test_timed_out_call_fails():
+    proto, clock = connect(call_timeout=10)
+    d = proto.connect_get_hostname()
+
+    clock.advance(9)
+    assert not d.called
+    clock.advance(1)
+
+    with pytest.raises(error.CallTimeout):
+        result(d).raiseException()
+    assert proto._remote._pending_calls == {}
+    assert not clock.getDelayedCalls()
+
+
+def test_late_reply_is_ignored():
+    proto, clock = connect(max_in_flight=1, call_timeout=10)
+    first = proto.connect_get_hostname()
+    clock.advance(5)
+    second = proto.connect_get_hostname()
+    clock.advance(5)
+    result(first).trap(error.CallTimeout)
+
+    # The queued call is sent as soon as the first one timed out
+    assert sent_serials(proto) == [0, 1]
+
+    reply(proto, 0, 'late')
+    assert not second.called
+    assert proto._remote.in_flight == 1
+
+    reply(proto, 1, 'b')
+    assert result(second).hostname == 'b'
+
+
+def test_cancel_queued_call():
+    proto, clock = connect(max_in_flight=1, call_timeout=10)
+    first = proto.connect_get_hostname()
+    second = proto.connect_get_hostname()
+
+    second.cancel()
+    result(second).trap(defer.CancelledError)
+    assert proto._remote.queued == 0
+    assert len(clock.getDelayedCalls()) == 1
+
+    # The cancelled call is never sent
+    reply(proto, 0, 'a')
+    assert result(first).hostname == 'a'
+    assert sent_serials(proto) == [0]
+
+
+def test_cancel_sent_call():
+    proto, clock = connect(max_in_flight=1, call_timeout=10)
+    first = proto.connect_get_hostname()
+    second = proto.connect_get_hostname()
+
+    first.cancel()
+    result(first).trap(defer.CancelledError)
+    assert proto._remote._pending_calls.keys() == [
+        (remote.ConnectGetHostname.id, 1)]
+    assert sent_serials(proto) == [0, 1]
+    assert len(clock.getDelayedCalls()) == 1
+
+    # The reply to the cancelled call is dropped
+    reply(proto, 0, 'a')
+    assert not second.called
+    reply(proto, 1, 'b')
+    assert result(second).hostname == 'b'
+
+
+def test_program_uses_clock_of_protocol():
+    proto, clock = connect()
+    assert proto._remote._clock is clock
+    assert proto._keepalive._clock is clock
+
+
+def test_subscribers_wait_for_registration():
+    proto, clock = connect()
+    lifecycle = constants.domain_event_id.LIFECYCLE
+    first = proto.subscribe(lifecycle, lambda event: None)
+    second = proto.subscribe(lifecycle, lambda event: None)
+
+    # The server is asked once, the second subscriber waits for it
+    assert sent_serials(proto) == [0]
+    assert not second.called
+
+    reply_register(proto, 0)
+    assert result(first) is None
+    assert result(second) is None
+
+
+def test_failed_registration_removes_waiting_subscribers():
+    proto, clock = connect()
+    lifecycle = constants.domain_event_id.LIFECYCLE
+    first = proto.subscribe(lifecycle, lambda event: None)
+    second = proto.subscribe(lifecycle, lambda event: None)
+
+    reply_register(proto, 0, failed=True)
+    result(first).trap(error.RemoteError)
+    result(second).trap(error.RemoteError)
+    procedure_id = remote.DomainEventLifecycle.id
+    assert proto._remote._event_listeners[procedure_id] == []
+
+    # The next subscriber registers again
+    proto.subscribe(lifecycle, lambda event: None)
+    assert sent_serials(proto) == [0, 1]
@@ -0,0 +1,115 @@
+from collections import namedtuple
+
+from twisted.internet import defer, task
+
+from ipd.projects.scheduler import BuildScheduler
+
+
+GiB = 1024 * 1024
+
+NodeInfo = namedtuple('NodeInfo', ['cpus', 'memory'])
+MemoryStats = namedtuple('MemoryStats', ['params', 'nparams'])
+MemoryParam = namedtuple('MemoryParam', ['field', 'value'])
+
+
+class FakeHypervisor(object):
+    """
+    Connection pool and connection to a host whose free memory is set by
+    the tests. Refreshes can be held with the hold attribute, to be
+    resumed once it is fired.
+    """
+
+    def __init__(self, free):
+        self.free = free
+        self.hold = None
+
+    def acquire(self):
+        return defer.succeed(self)
+
+    def release(self, virt):
+        pass
+
+    def node_get_info(self):
+        # The stats are taken when the refresh started
+        info = NodeInfo(4, 16 * GiB)
+        params = [MemoryParam('free', self.free),
+                  MemoryParam('cached', 0)]
+        d = defer.succeed(None) if self.hold is None else self.hold
+        d.addCallback(lambda _: info)
+        self._stats = MemoryStats(params, len(params))
+        return d
+
+    def node_get_memory_stats(self, nparams, cell, flags):
+        return defer.succeed(self._stats)
+
+
+def make_scheduler(free=8 * GiB):
+    hypervisor = FakeHypervisor(free)
+    scheduler = BuildScheduler({'host': hypervisor}, reactor=task.Clock())
+    scheduler.refresh()
+    return scheduler, hypervisor, scheduler.hosts['host']
+
+
+def place(scheduler, memory):
+    placements = []
+    scheduler.place(1, memory).addCallback(placements.append)
+    placement, = placements
+    return placement
+
+
+def test_memory_of_running_build_is_counted_once():
+    scheduler, hypervisor, host = make_scheduler()
+    placement = place(scheduler, 2 * GiB)
+    assert host.free_memory(0) == 6 * GiB
+
+    # The domain boots, the memory stats only include it once refreshed
+    hypervisor.free -= 2 * GiB
+    scheduler.started(placement)
+    assert host.free_memory(0) == 6 * GiB
+    scheduler.refresh()
+    assert host.free_memory(0) == 6 * GiB
+
+    # Release refreshes the host as well
+    hypervisor.free += 2 * GiB
+    scheduler.release(placement)
+    assert host.free_memory(0) == 8 * GiB
+    assert host.builds == []
+
+
+def test_memory_of_booting_build_stays_reserved():
+    scheduler, hypervisor, host = make_scheduler()
+    placement = place(scheduler, 2 * GiB)
+    scheduler.refresh()
+    assert host.free_memory(0) == 6 * GiB
+
+    # A refresh started before the domain was running did not see it
+    hypervisor.hold = defer.Deferred()
+    scheduler.refresh()
+    hypervisor.hold, hold = None, hypervisor.hold
+    hypervisor.free -= 2 * GiB
+    scheduler.started(placement)
+    hold.callback(None)
+    assert host.available_memory == 8 * GiB
+    assert host.free_memory(0) == 6 * GiB
+
+    scheduler.refresh()
+    assert host.free_memory(0) == 6 * GiB
+
+
+def test_released_booting_build_frees_its_reservation():
+    scheduler, hypervisor, host = make_scheduler()
+    placement = place(scheduler, 2 * GiB)
+    scheduler.release(placement)
+    assert host.free_memory(0) == 8 * GiB
+
+
+def test_builds_are_queued_until_memory_is_available():
+    scheduler, hypervisor, host = make_scheduler(free=4 * GiB)
+    first = place(scheduler, 2 * GiB)
+    placements = []
+    scheduler.place(1, 2 * GiB).addCallback(placements.append)
+    assert placements == []
+    assert scheduler.queued == 1
+
+    scheduler.release(first)
+    assert len(placements) == 1
@@ -1,8 +1,10 @@
 import string
 import random
+from collections import OrderedDict
 
 from twisted.internet.protocol import Factory
 from twisted.internet import defer, endpoints
+from twisted.python import failure
 
 
 PASSWORD_CHARS = string.ascii_letters + string.digits + string.punctuation
@@ -12,6 +14,110 @@ def generate_password(length):
     return ''.join((random.choice(PASSWORD_CHARS) for _ in xrange(length)))
 
 
+def timeout(reactor, d, seconds):
+    """
+    Cancels the given deferred if it did not fire after the given amount of
+    seconds.
+    """
+    call = reactor.callLater(seconds, d.cancel)
+
+    def cancel_timeout(result):
+        if call.active():
+            call.cancel()
+        return result
+
+    d.addBoth(cancel_timeout)
+    return d
+
+
+class DeferredCache(object):
+    """
+    Caches the results of functions returning deferreds for ttl seconds,
+    keeping at most size entries (the least recently used ones are evicted
+    first). Concurrent misses for the same key share a single call; failures
+    are passed to all the waiting callers but are not cached.
+    """
+
+    def __init__(self, size=1024, ttl=60, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, func, *args, **kwargs):
+        """
+        Returns a deferred fired with the cached value for key, or with the
+        result of func(*args, **kwargs) if there is none.
+        """
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            if expires > self._reactor.seconds():
+                self._entries[key] = expires, value
+                self.hits += 1
+                return defer.succeed(value)
+
+        d = defer.Deferred()
+        waiters = self._pending.get(key)
+        if waiters is None:
+            self.misses += 1
+            waiters = self._pending[key] = [d]
+            call = defer.maybeDeferred(func, *args, **kwargs)
+            call.addBoth(self._loaded, key, waiters)
+        else:
+            self.coalesced += 1
+            waiters.append(d)
+        return d
+
+    def _loaded(self, result, key, waiters):
+        # The key was not invalidated while loading
+        if self._pending.get(key) is waiters:
+            del self._pending[key]
+            if not isinstance(result, failure.Failure):
+                self._store(key, result)
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _store(self, key, value):
+        self._entries[key] = self._reactor.seconds() + self.ttl, value
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drops the cached value for key. A call currently loading it still
+        fires its waiters, but its result is not cached.
+        """
+        self._entries.pop(key, None)
+        self._pending.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+
 class ProtocolConnector(object):
     def __init__(self, reactor, host, port, protocol):
         self._endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port)
@@ -27,3 +133,56 @@ class ProtocolConnector(object):
 
     def __call__(self):
         return self.get_connection()
+
+
+class ProtocolPool(object):
+    """
+    Like ProtocolConnector, but spreads the callers over up to size
+    connections, which are established lazily (the first caller waits for
+    a connection, the later ones get one of the established connections
+    while the pool grows in the background) and replaced when lost.
+
+    Protocols sending their requests without waiting for the previous
+    replies (as the redis client does) pipeline them on each connection.
+    """
+
+    def __init__(self, reactor, host, port, protocol, size=2):
+        self._endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port)
+        self._factory = Factory()
+        self._factory.protocol = protocol
+        self.size = size
+        self._connections = []
+        self._connecting = 0
+        self._waiters = []
+        self._next = 0
+
+    def get_connection(self):
+        self._connections = [c for c in self._connections
+                             if c.transport.connected]
+        if len(self._connections) + self._connecting < self.size:
+            self._connecting += 1
+            d = self._endpoint.connect(self._factory)
+            d.addCallbacks(self._connected, self._connection_failed)
+        if not self._connections:
+            d = defer.Deferred()
+            self._waiters.append(d)
+            return d
+        self._next = (self._next + 1) % len(self._connections)
+        return defer.succeed(self._connections[self._next])
+
+    def _connected(self, protocol):
+        self._connecting -= 1
+        self._connections.append(protocol)
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(protocol)
+
+    def _connection_failed(self, reason):
+        self._connecting -= 1
+        if not self._connecting and not self._connections:
+            waiters, self._waiters = self._waiters, []
+            for d in waiters:
+                d.errback(reason)
+
+    def __call__(self):
+        return self.get_connection()